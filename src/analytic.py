@@ -0,0 +1,153 @@
+import numpy as np
+from scipy.stats import norm, binom
+from src.methods import MultiTest
+from src.utils import distribute_means_BH_exp
+
+'''
+Exact evaluation of the BH experiment with the deterministic `NormalMeanHypotheses` generator.
+The hypotheses form a few groups (the nulls, and the alternatives sharing each of the mean values
+of `distribute_means_BH_exp`) of independent, identically distributed p values, so the distribution
+of the numbers V and S of false and true rejections can be computed without sampling.
+'''
+
+# Costs in seconds, calibrated on the cells of the default grid (see `benchmark_analytic` of `run_benchmark.py`).
+# Exact evaluation: per group of hypotheses for Bonferroni, per group at each step of a step-up procedure,
+# and per operation on the state of the step-up recursion
+GROUP_COST = 2e-4
+STEP_GROUP_COST = 9e-5
+STATE_OPERATION_COST = 5e-10
+# Vectorized simulation: per cell, and per replication (constant and per hypothesis) for the first method
+# and for each other method
+SIMULATION_CELL_COST = 2e-4
+SIMULATION_REPLICATION_COST = (1.6e-7, 4.2e-8)
+SIMULATION_METHOD_COST = (6e-8, 5.5e-9)
+
+# Critical values of the supported step-up methods
+STEP_UP_THRESHOLDS = {'Hochberg': MultiTest.HochbergThresholds, 'BH': MultiTest.BHThresholds}
+
+def rejection_probability(mean, t):
+    '''
+    Probability that the two-sided z-test p value of N(mean, 1) data is at most t
+    '''
+    c = norm.isf(np.asarray(t)/2.)
+    return norm.sf(c-mean) + norm.cdf(-c-mean)
+
+def _groups_BH_exp(L, m_0, m, mode):
+    '''
+    Returns the sizes and means of the groups of i.i.d. hypotheses, nulls first
+    '''
+    alt_means, counts = np.unique(distribute_means_BH_exp(m-m_0, L, mode), return_counts=True)
+    return [m_0]+list(counts), [0.]+list(alt_means)
+
+def _joint_pmf(probs, sizes, m_0, m):
+    '''
+    Collapses the probabilities of the numbers of rejections in each group,
+    an array with one axis per group (nulls first), into the joint pmf P[V, S]
+    '''
+    counts = np.indices(probs.shape)
+    V = counts[0]
+    S = counts[1:].sum(axis=0) if len(sizes) > 1 else np.zeros_like(V)
+    pmf = np.bincount((V*(m-m_0+1)+S).ravel(), weights=probs.ravel(), minlength=(m_0+1)*(m-m_0+1))
+    return pmf.reshape(m_0+1, m-m_0+1)
+
+def _product_binomial(sizes, success_probs):
+    '''
+    Joint pmf of independent Binomial(sizes[g], success_probs[g]), with one axis per group
+    '''
+    probs = np.ones(())
+    for size, prob in zip(sizes, success_probs):
+        probs = np.multiply.outer(probs, binom.pmf(np.arange(size+1), size, prob))
+    return probs
+
+def bonferroni_joint_pmf(L, m_0, m, mode, alpha=0.05):
+    '''
+    Exact joint pmf P[V, S] of the Bonferroni method
+    '''
+    sizes, means = _groups_BH_exp(L, m_0, m, mode)
+    probs = _product_binomial(sizes, [rejection_probability(mean, alpha/m) for mean in means])
+    return _joint_pmf(probs, sizes, m_0, m)
+
+def step_up_joint_pmf(L, m_0, m, mode, thresh):
+    '''
+    Exact joint pmf P[V, S] of the step-up procedure with increasing critical values `thresh`.
+    Recursion over the critical values from the largest one: the state is the number of p values
+    of each group below the i-th critical value, which are thinned binomially to the (i-1)-th one.
+    The procedure stops at the first (largest) i with at least i p values below the i-th critical value,
+    and then rejects exactly these p values.
+    '''
+    sizes, means = _groups_BH_exp(L, m_0, m, mode)
+    cdfs = np.array([rejection_probability(mean, thresh) for mean in means]) # (groups, m)
+    probs = _product_binomial(sizes, cdfs[:, -1])
+    total = np.indices(probs.shape).sum(axis=0)
+    pmf = np.zeros((m_0+1, m-m_0+1))
+    for i in range(m, 0, -1):
+        stopped = total >= i
+        pmf += _joint_pmf(np.where(stopped, probs, 0.), sizes, m_0, m)
+        probs = np.where(stopped, 0., probs)
+        if i == 1: break
+        for g, size in enumerate(sizes):
+            ratio = cdfs[g, i-2]/cdfs[g, i-1] if cdfs[g, i-1] > 0 else 0.
+            thinning = binom.pmf(np.arange(size+1).reshape(1, -1), np.arange(size+1).reshape(-1, 1), ratio)
+            probs = np.moveaxis(np.tensordot(probs, thinning, axes=([g], [0])), -1, g)
+    pmf[0, 0] += probs.sum() # No rejection
+    return pmf
+
+def moments_from_joint_pmf(pmf, criteria):
+    '''
+    Returns a dictionary mapping each criterion to its first two moments [E[X], E[X^2]],
+    from the joint pmf P[V, S] of the numbers of false and true rejections
+    '''
+    m_0, m_1 = pmf.shape[0]-1, pmf.shape[1]-1
+    V, S = np.indices(pmf.shape)
+    output = dict()
+    for crit in criteria:
+        if crit == 'power':
+            assert m_1 > 0, 'No non-null hypothesis, cannot calculate power'
+            values = S/m_1
+        elif crit == 'type1': values = V
+        elif crit == 'type2': values = m_1-S
+        elif crit == 'fdr': values = V/np.maximum(V+S, 1)
+        elif crit == 'fwer': values = (V > 0).astype(float)
+        else: raise ValueError(f'Unsupported criterion: {crit}')
+        output[crit] = np.array([np.sum(pmf*values), np.sum(pmf*values*values)])
+    return output
+
+def analytic_applies(methods):
+    '''
+    Whether the exact evaluation supports all `methods`
+    '''
+    return all(method == 'Bonferroni' or method in STEP_UP_THRESHOLDS for method in methods)
+
+def analytic_cost(L, m_0, m, mode, methods):
+    '''
+    Estimated time (in seconds) of the exact evaluation of a cell, comparable with `simulation_cost`
+    '''
+    sizes, _ = _groups_BH_exp(L, m_0, m, mode)
+    state_size = np.prod([size+1 for size in sizes])
+    num_step_up = sum(method in STEP_UP_THRESHOLDS for method in methods)
+    step_cost = STEP_GROUP_COST*len(sizes) + STATE_OPERATION_COST*state_size*sum(size+1 for size in sizes)
+    return GROUP_COST*len(sizes)*(len(methods)-num_step_up) + num_step_up*m*step_cost
+
+def simulation_cost(num_rep, m, num_methods):
+    '''
+    Estimated time (in seconds) of the vectorized simulation of a cell, comparable with `analytic_cost`
+    '''
+    per_replication = SIMULATION_REPLICATION_COST[0] + SIMULATION_REPLICATION_COST[1]*m
+    per_method = SIMULATION_METHOD_COST[0] + SIMULATION_METHOD_COST[1]*m
+    return SIMULATION_CELL_COST + num_rep*(per_replication + (num_methods-1)*per_method)
+
+def simulate_cell_analytic(L, m_0, m, mode, num_rep, methods, criteria, alpha=0.05):
+    '''
+    Exact counterpart of `simulate_cell_BH_exp` in streaming mode.
+    Returns, for each method and criterion, the expected sufficient statistics of `num_rep`
+    replications [num_rep, num_rep*E[X], num_rep*E[X^2]]: the mean is exact and the se is the one
+    that a simulation with `num_rep` replications would have.
+    '''
+    output = dict()
+    for method in methods:
+        if method == 'Bonferroni': pmf = bonferroni_joint_pmf(L, m_0, m, mode, alpha)
+        else: pmf = step_up_joint_pmf(L, m_0, m, mode, STEP_UP_THRESHOLDS[method](m, alpha))
+        moments = moments_from_joint_pmf(pmf, criteria)
+        output[method] = {crit: np.array([num_rep, num_rep*first, num_rep*second])
+                          for crit, (first, second) in moments.items()}
+    return output
@@ -2,13 +2,105 @@ import os
 import time
 import math
 import json
+import hashlib
 import numpy as np
-from tqdm import tqdm
-from src.utils import mean_and_se, generate_params_BH_exp, \
-                      generate_filename_BH_exp, generate_jsonname_BH_exp
-from src.constants import RAW_OUTPUT_DIR, PROCESSED_OUTPUT_DIR
+from src.utils import mean_and_se, mean_and_se_from_stats, generate_params_BH_exp, \
+                      generate_jsonname_BH_exp, generate_nrepsname_BH_exp, parse_criteria
+from concurrent.futures import ThreadPoolExecutor
+from src.store import RawStore
+from src.results import ExperimentResults
+from src.constants import RAW_OUTPUT_DIR, PROCESSED_OUTPUT_DIR, ANALYSIS_MANIFEST
 
-def main_analyze(filename='params.json', params=None, print_params=True):
+class AnalysisManifest:
+    '''
+    Record of the raw store entries already aggregated by the analysis (saved in `ANALYSIS_MANIFEST`):
+    the position in the store index up to which it was read, the index entry of each `RawStore.key` read so far,
+    the identity of the part of each data file they point to, and the summary (mean, se, nrep) of the keys
+    already analyzed. The index being append-only, an update only reads its new lines, whose keys are the outputs
+    added or rewritten since the last analysis; the keys not analyzed yet (e.g. outside of the grid of an earlier
+    analysis) keep their entry. The manifest is reset if the index or a data file is not the one it was read from
+    (e.g. a raw store recreated with another seed).
+    '''
+    def __init__(self, path=ANALYSIS_MANIFEST):
+        self.path = path
+        self._reset()
+        if os.path.exists(path):
+            with open(path, 'r') as file: manifest = json.load(file)
+            if 'files' in manifest: # Older manifests are read again from scratch
+                self.index, self.files = manifest['index'], manifest['files']
+                self.entries = {tuple(json.loads(key)): entry for key, entry in manifest['entries'].items()}
+                self.summaries = {tuple(json.loads(key)): tuple(value)
+                                  for key, value in manifest['summaries'].items()}
+
+    def _reset(self):
+        self.index, self.files, self.entries, self.summaries = {'offset': 0, 'last': None}, dict(), dict(), dict()
+
+    def _same_index(self, store):
+        '''
+        Whether the index of `store` still starts with the part already read
+        '''
+        if self.index['last'] is None: return self.index['offset'] == 0
+        last = self.index['last'].encode()+b'\n'
+        if not os.path.exists(store.index_path) or os.path.getsize(store.index_path) < self.index['offset']:
+            return False
+        with open(store.index_path, 'rb') as file:
+            file.seek(self.index['offset']-len(last))
+            return file.read(len(last)) == last
+
+    @staticmethod
+    def _file_identity(path, size, block=2**16):
+        '''
+        Identity of the first `size` bytes of a data file: its size and the hash of its first and last `block` bytes,
+        or None if the file is shorter
+        '''
+        if not os.path.exists(path) or os.path.getsize(path) < size: return None
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            digest.update(file.read(min(size, block)))
+            file.seek(max(size-block, 0))
+            digest.update(file.read(size-max(size-block, 0)))
+        return {'size': size, 'hash': digest.hexdigest()}
+
+    def _same_files(self, store):
+        '''
+        Whether the data files of `store` still start with the parts the known entries point to
+        '''
+        return all(self._file_identity(store.data_path(criterion), identity['size']) == identity
+                   for criterion, identity in self.files.items())
+
+    def update(self, store):
+        '''
+        Reads the entries of the index of `store` (a `RawStore`) appended since the last update,
+        drops their summaries, and returns a reader of the store on every entry known
+        '''
+        if not self._same_index(store) or not self._same_files(store): self._reset()
+        entries, offset, last = store.read_index(self.index['offset'])
+        if entries: self.index = {'offset': offset, 'last': last}
+        for key in entries: self.summaries.pop(key, None)
+        self.entries.update(entries)
+        ends = dict()
+        for key, entry in self.entries.items():
+            end = entry['offset']+entry['length']*np.dtype(entry['dtype']).itemsize
+            ends[key[-1]] = max(ends.get(key[-1], 0), end)
+        self.files = {criterion: self._file_identity(store.data_path(criterion), end)
+                      for criterion, end in ends.items()}
+        return store.open(index=self.entries)
+
+    def summary(self, reader, key):
+        '''
+        Summary (mean, se, nrep) of the output `key`, computed from `reader` if not already known
+        '''
+        if key not in self.summaries: self.summaries[key] = summary_from_store(reader, key)
+        return self.summaries[key]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        entries = {json.dumps(list(key)): entry for key, entry in self.entries.items()}
+        summaries = {json.dumps(list(key)): list(value) for key, value in self.summaries.items()}
+        with open(self.path, 'w') as file:
+            json.dump({'index': self.index, 'files': self.files, 'entries': entries, 'summaries': summaries}, file)
+
+def main_analyze(filename='params.json', params=None, print_params=True, results=None, processed=None):
     '''
     Main function to analyze the raw output and use that to generate processed ones.
     Will be run by the `if __name__ == '__main__'` of this script.
@@ -22,6 +114,16 @@ def main_analyze(filename='params.json', params=None, print_params=True):
         if None: load json file from filename as params.
     print_params : Optional (bool)
         prints parameters
+    results : Optional (ExperimentResults)
+        if not None: in-memory outputs of the simulation, used instead of the raw store
+    processed : Optional (dict)
+        if not None: filled with the processed output (means, ses, nreps) of each L, to be passed to the plotting.
+        The json files are then only written if `params['save_processed']` (default: True),
+        in a background thread if `params['async_save']`.
+
+    Without `results`, the analysis is incremental unless `params['incremental']` is False:
+    only the outputs added to the raw store since the last analysis are read (see `AnalysisManifest`),
+    and only the json files whose content changed are rewritten.
 
     RETURNS
     -------
@@ -39,37 +141,97 @@ def main_analyze(filename='params.json', params=None, print_params=True):
         print(' ratio_s: ', params['ratio_s'])
         print(' num_rep: ', params['num_rep'])
         print(' methods: ', params['methods'])
-        print(f" criterion: {params['criterion']}")
+        print(f" criteria: {', '.join(parse_criteria(params['criterion']))}")
         print(f" alpha: {params['alpha']}")
         print('=======================================================')
     time_setup = time.perf_counter()-time1
     time_process = 0
     time_save = 0
+    manifest = None
+    if results is not None: store = None
+    elif params.get('incremental', True):
+        manifest = AnalysisManifest()
+        store = manifest.update(RawStore(RAW_OUTPUT_DIR))
+    else: store = RawStore(RAW_OUTPUT_DIR).open()
+    save = processed is None or params.get('save_processed', True)
+    writer = ThreadPoolExecutor(max_workers=1) if processed is not None and params.get('async_save') else None
     for L in params['L_s']:
         time1 = time.perf_counter()
         print(f' Processing for L = {L} ...')
-        means = dict()
-        ses = dict()
-        generator = generate_params_BH_exp([L], params['m_s'], params['ratio_s'], params['mode_s'], params['methods'])
+        processed_L = analyze_L(params, L, store, results=results, manifest=manifest)
+        if processed is not None: processed[L] = processed_L
         time2 = time.perf_counter()
-        for (_, m, r, mode, method) in tqdm(list(generator)):
-            m_0 = int(np.rint(m*float(r)).astype('int'))
-            filename = generate_filename_BH_exp(L, m_0, m, mode, params['num_rep'], method, params['criterion'])
-            test_result = np.array(np.load(f'{RAW_OUTPUT_DIR}/{filename}', allow_pickle=True))
-            mean, se = mean_and_se(test_result)
-            means.setdefault(r, dict()).setdefault(mode, dict()).setdefault(method, []).append(mean)
-            ses.setdefault(r, dict()).setdefault(mode, dict()).setdefault(method, []).append(se)
+        if save and writer is not None: writer.submit(save_analysis_L, params, L, processed_L)
+        elif save: save_analysis_L(params, L, processed_L)
         time3 = time.perf_counter()
-        jsonname_means, jsonname_ses = generate_jsonname_BH_exp(L)
-        with open(f'{PROCESSED_OUTPUT_DIR}/{jsonname_means}', 'w') as f_mean:
-            json.dump(means, f_mean, indent=4)
-        with open(f'{PROCESSED_OUTPUT_DIR}/{jsonname_ses}', 'w') as f_se:
-            json.dump(ses, f_se, indent=4)
-        time4 = time.perf_counter()
-        time_setup += time2-time1
-        time_process += time3-time2
-        time_save += time4-time3
+        time_process += time2-time1
+        time_save += time3-time2
+    if writer is not None: writer.shutdown(wait=True)
+    if manifest is not None: manifest.save()
     return [['Set ups', time_setup], ['Process data', time_process], ['Save data', time_save]]
 
+def summary_from_store(reader, key):
+    '''
+    Summary (mean, se, nrep) of the output `key` of an opened `RawStore`
+    '''
+    values, entry = reader.view(key)
+    if entry['kind'] == 'stats': return (*mean_and_se_from_stats(values), int(values[0]))
+    return (*mean_and_se(reader.get(key)), entry['length'])
+
+def analyze_L(params, L, store=None, results=None, manifest=None):
+    '''
+    Computes the means and ses of every criterion, and the numbers of replications,
+    of all cells and methods of one value of L, from the in-memory `results` (an `ExperimentResults`)
+    if given, and otherwise from an opened `RawStore` (opened here if None),
+    through `manifest` (an `AnalysisManifest`) if given, which only reads the outputs it does not know.
+    Returns a tuple (means, ses, nreps): means and ses map each criterion to a nested dictionary
+    ratio -> mode -> method -> list over m, and nreps is one such nested dictionary.
+    '''
+    if results is None and store is None: store = RawStore(RAW_OUTPUT_DIR).open()
+    criteria = parse_criteria(params['criterion'])
+    def summary(m, r, mode, method, crit):
+        if results is not None: return results.summary(ExperimentResults.key(L, r, mode, method, m), crit)
+        m_0 = int(np.rint(m*float(r)).astype('int'))
+        key = RawStore.key(L, m_0, m, mode, params['num_rep'], method, crit)
+        return manifest.summary(store, key) if manifest is not None else summary_from_store(store, key)
+    summaries = {(m, r, mode, method, crit): summary(m, r, mode, method, crit)
+                 for (_, m, r, mode, method) in generate_params_BH_exp([L], params['m_s'], params['ratio_s'],
+                                                                       params['mode_s'], params['methods'])
+                 for crit in criteria}
+    def nested(crit, field):
+        return {r: {mode: {method: [summaries[m, r, mode, method, crit][field] for m in params['m_s']]
+                           for method in params['methods']}
+                    for mode in params['mode_s']}
+                for r in params['ratio_s']}
+    means = {crit: nested(crit, 0) for crit in criteria}
+    ses = {crit: nested(crit, 1) for crit in criteria}
+    nreps = nested(criteria[0], 2) # Number of replications actually used (adaptive mode)
+    return means, ses, nreps
+
+def save_analysis_L(params, L, processed):
+    '''
+    Saves the processed output (means, ses, nreps) of `analyze_L` as json files,
+    leaving the files already holding the same content untouched
+    '''
+    os.makedirs(PROCESSED_OUTPUT_DIR, exist_ok=True)
+    means, ses, nreps = processed
+    for crit in parse_criteria(params['criterion']):
+        jsonname_means, jsonname_ses = generate_jsonname_BH_exp(L, criterion=crit)
+        _write_json(f'{PROCESSED_OUTPUT_DIR}/{jsonname_means}', means[crit])
+        _write_json(f'{PROCESSED_OUTPUT_DIR}/{jsonname_ses}', ses[crit])
+    _write_json(f'{PROCESSED_OUTPUT_DIR}/{generate_nrepsname_BH_exp(L)}', nreps)
+
+def _write_json(filename, obj):
+    '''
+    Writes `obj` in the json file `filename` unless it already holds it. Returns whether it was written.
+    '''
+    text = json.dumps(obj, indent=4)
+    if os.path.exists(filename):
+        with open(filename, 'r') as file:
+            if file.read() == text: return False
+    with open(filename, 'w') as file:
+        file.write(text)
+    return True
+
 if __name__ == '__main__':
     main_analyze()
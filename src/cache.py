@@ -0,0 +1,108 @@
+import os
+import json
+import hashlib
+import functools
+import numpy as np
+from src.constants import CACHE_DIR
+from src.seeding import StreamSeed
+
+# Source files whose content determines the simulated outputs
+CODE_FILES = ('methods.py', 'simulation.py', 'seeding.py', 'utils.py')
+
+@functools.lru_cache(maxsize=None)
+def code_version():
+    '''
+    Hash of the content of the files in `CODE_FILES`
+    '''
+    digest = hashlib.sha256()
+    for name in CODE_FILES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+def cache_key_BH_exp(generator, L, m_0, m, mode, num_rep, method, criterion, alpha, seed, kind='reps',
+                     options=None):
+    '''
+    Content-addressed key of one raw output of the BH experiment.
+    `seed` is either an integer, a `np.random.SeedSequence` or a `StreamSeed`,
+    and `kind` is 'reps' for per-replication values or 'stats' for sufficient statistics.
+    `options` is a json-serializable dictionary of any other option changing the output.
+    '''
+    if isinstance(seed, np.random.SeedSequence): seed = [seed.entropy, list(seed.spawn_key)]
+    elif isinstance(seed, StreamSeed): seed = seed.fields()
+    fields = [generator, float(np.round(float(L), 1)), int(m_0), int(m), mode, int(num_rep),
+              method, criterion, float(alpha), seed, kind, options, code_version()]
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+class ResultCache:
+    '''
+    Content-addressed cache of raw outputs, one `.npy` file per key in `directory`.
+    The cache is bounded to `max_bytes` by evicting the least recently used files,
+    hits refreshing the modification time of their file.
+    '''
+    def __init__(self, directory=CACHE_DIR, max_bytes=2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return f'{self.directory}/{key}.npy'
+
+    def get(self, key):
+        '''
+        Returns the cached array of `key`, or None if missing or invalid
+        '''
+        path = self.path(key)
+        try:
+            values = np.load(path)
+        except (OSError, ValueError):
+            if os.path.exists(path): os.remove(path)
+            return None
+        os.utime(path)
+        return values
+
+    def put(self, key, values):
+        '''
+        Caches the array `values` under `key`, writing atomically
+        '''
+        temp_path = f'{self.directory}/{key}.{os.getpid()}.tmp.npy'
+        np.save(temp_path, np.asarray(values))
+        os.replace(temp_path, self.path(key))
+
+    def get_all(self, keys):
+        '''
+        Returns the cached outputs {method: {criterion: array}} of `keys`, a dictionary mapping
+        (method, criterion) to cache keys, or None if any of them is missing
+        '''
+        output = dict()
+        for (method, crit), key in keys.items():
+            values = self.get(key)
+            if values is None: return None
+            output.setdefault(method, dict())[crit] = values
+        return output
+
+    def put_all(self, keys, output):
+        '''
+        Caches the outputs {method: {criterion: array}} of a simulation under `keys`
+        '''
+        for (method, crit), key in keys.items():
+            self.put(key, output[method][crit])
+
+    def evict(self):
+        '''
+        Removes the least recently used files until the cache fits in `max_bytes`.
+        Returns the number of removed files.
+        '''
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy') or name.endswith('.tmp.npy'): continue
+            stat = os.stat(f'{self.directory}/{name}')
+            files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes: break
+            os.remove(f'{self.directory}/{name}')
+            total -= size
+            removed += 1
+        return removed
@@ -1,4 +1,9 @@
 RAW_OUTPUT_DIR = 'results/raw'
 PROCESSED_OUTPUT_DIR = 'results/processed'
 PLOTTING_DIR = 'results/plots'
+CACHE_DIR = 'cache' # Outside of `results` so that it survives `make clean-generated`
 COLORS = ['#1E3888', '#47A8BD', '#F5E663', '#FFAD69', '#A52422']
+PROFILE_REPORT = 'results/profile_report' # Saved as .json and .csv
+BENCHMARK_DIR = 'benchmarks' # Outside of `results` so that it survives `make clean-generated`
+SHARD_DIR = 'results/shards' # Partial results files of the shards of a sweep
+ANALYSIS_MANIFEST = 'results/processed/analysis_manifest.json' # Raw outputs already aggregated
@@ -1,5 +1,8 @@
 import math
+import functools
 import numpy as np
+from scipy.stats import norm
+from src.profiling import stage
 
 class MultipleHypotheses:
     '''
@@ -43,10 +46,22 @@ class NormalMeanHypotheses(MultipleHypotheses):
         self.means = np.array([0.]*num_null+list(alt_means))
         self.sigma = sigma
 
-    def generate_data(self, size=None):
+    def generate_data(self, size=None, out=None):
+        if out is not None:
+            # Same draws as `rng.normal`, written in place (in float64)
+            self.rng.standard_normal(out=out, dtype=out.dtype)
+            out *= self.sigma
+            return self.shift_means(out)
         if size == None: return self.rng.normal(self.means, self.sigma, size=self.num_hypo)
         else: return self.rng.normal(self.means, self.sigma, size=(size, self.num_hypo))
 
+    def shift_means(self, out):
+        '''
+        Adds the means of the hypotheses to the centered data `out`, in place
+        '''
+        out += self.means
+        return out
+
 class NormalMeanHypothesesProbabilistic(MultipleHypotheses):
     '''
     Similar-variance 1D Normal distribution hypotheses
@@ -61,13 +76,102 @@ class NormalMeanHypothesesProbabilistic(MultipleHypotheses):
         self.alt_probs = np.array(alt_probs)
         self.sigma = sigma
 
-    def generate_data(self, size=None):
-        means_alt = np.random.choice(a=self.alt_means, size=self.num_alt if size is None else size*self.num_alt, \
-                                    replace=True, p=self.alt_probs)
-        if size is None: means = np.hstack((np.zeros((self.num_null, )), means_alt))
-        else: means = np.hstack((np.zeros((size, self.num_null)), means_alt.reshape(size, self.num_alt)))
-        output = np.random.normal(means, self.sigma)
-        return output
+    def generate_data(self, size=None, out=None):
+        '''
+        Draws the data from the instance generator `self.rng`.
+        The alternative means are drawn with a single categorical draw of group indices,
+        and the noise is written in place into `out` (allocated if None)
+        '''
+        if out is None: out = np.empty((self.num_hypo, ) if size is None else (size, self.num_hypo))
+        self.rng.standard_normal(out=out, dtype=out.dtype)
+        if self.sigma != 1.: out *= self.sigma
+        return self.shift_means(out)
+
+    def shift_means(self, out):
+        '''
+        Draws the alternative means and adds them to the centered data `out`, in place
+        '''
+        groups = self.rng.choice(len(self.alt_means), size=out.shape[:-1]+(self.num_alt, ), p=self.alt_probs)
+        out[..., self.num_null:] += self.alt_means[groups]
+        return out
+
+
+# Number of set bits of each byte, for numpy versions without `np.bitwise_count`
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount(bits):
+    '''
+    Element-wise number of set bits of a uint8 array
+    '''
+    if hasattr(np, 'bitwise_count'): return np.bitwise_count(bits)
+    return _POPCOUNT_TABLE[bits]
+
+class PackedDecisions:
+    '''
+    Decisions of a method on m hypotheses (rows of 1's for rejection and 0's otherwise),
+    packed 8 per byte along the hypotheses with `np.packbits`, which takes 8 times less memory
+    than boolean decisions and 64 times less than the int64 ones of `MultiTest`.
+    Numbers of rejections among any subset of hypotheses are counted with popcounts.
+    '''
+    def __init__(self, bits, m):
+        self.bits = bits
+        self.m = m
+
+    @staticmethod
+    def pack(decision):
+        decision = np.asarray(decision)
+        return PackedDecisions(np.packbits(decision.astype(bool, copy=False), axis=-1), decision.shape[-1])
+
+    @property
+    def shape(self):
+        return self.bits.shape[:-1]+(self.m, )
+
+    def unpack(self):
+        return np.unpackbits(self.bits, axis=-1, count=self.m).astype(bool)
+
+    def count(self, mask=None):
+        '''
+        Number of rejections of each row, among the hypotheses where the 1d array `mask` is nonzero if given
+        '''
+        bits = self.bits
+        if mask is not None: bits = bits & np.packbits(np.asarray(mask).astype(bool))
+        return popcount(bits).sum(axis=-1, dtype=np.int64)
+
+class MultiTestWorkspace:
+    '''
+    Preallocated buffers for the in-place methods of `MultiTest`,
+    reused across calls on p value matrices of at most `s` rows and exactly `m` columns.
+    `dtype` ('float64' or 'float32') is the precision of the p value buffers.
+    '''
+    def __init__(self, s, m, dtype='float64'):
+        self.s = s
+        self.m = m
+        self.dtype = np.dtype(dtype)
+        self.p_values = np.empty((s, m), dtype=dtype) # Input buffer for callers generating p values in place
+        self.candidates = np.empty((s, m), dtype=dtype)
+        self.passed = np.empty((s, m), dtype=bool)
+        self.decision = np.empty((s, m), dtype=bool)
+        self.index = np.empty(s, dtype=np.intp)
+        self.any = np.empty(s, dtype=bool)
+        self.cutoffs = np.empty(s)
+        self._thresholds = dict()
+
+    def thresholds(self, method, alpha, scale='p'):
+        '''
+        Critical values of the non-adaptive procedure `method` (see `PROCEDURES`),
+        with tolerance for step-up and step-down procedures (only the last one for single step procedures),
+        preceded by -inf standing for no rejection, computed once per alpha.
+        If `scale` is 'z', the critical values are transformed to the scale of the statistics -|z|
+        of the two-sided z-test (see `MultiTest.ZThresholds`), which are compared in the same way.
+        '''
+        key = (method, alpha, scale)
+        if key not in self._thresholds:
+            thresh = procedure_thresholds(method, self.m, alpha)
+            if PROCEDURES[method]['step'] == 'single': thresh = thresh[-1:]
+            else: thresh = thresh+1e-9
+            if scale == 'z': thresh = MultiTest.ZThresholds(thresh)
+            self._thresholds[key] = np.concatenate(([-np.inf], thresh))
+        return self._thresholds[key]
 
 
 class MultiTest():
@@ -118,24 +222,268 @@ class MultiTest():
     
     @staticmethod
     def HochbergMethodFast(p_values, alpha):
+        return MultiTest.ProcedureMethod(p_values, alpha, 'Hochberg')
+
+    @staticmethod
+    def BHMethodFast(p_values, alpha):
+        return MultiTest.ProcedureMethod(p_values, alpha, 'BH')
+
+    @staticmethod
+    def HochbergThresholds(m, alpha):
+        ''' Critical values alpha/(m-i+1), i = 1, ..., m, of the Hochberg step-up procedure '''
+        return alpha / np.arange(m, 0, -1)
+
+    @staticmethod
+    def BHThresholds(m, alpha):
+        ''' Critical values alpha*i/m, i = 1, ..., m, of the BH step-up procedure '''
+        return alpha * np.arange(1, m+1) / m
+
+    @staticmethod
+    def BonferroniThresholds(m, alpha):
+        ''' Critical values alpha/m of the Bonferroni (single step) procedure '''
+        return np.full(m, alpha/m)
+
+    @staticmethod
+    def HolmThresholds(m, alpha):
+        ''' Critical values alpha/(m-i+1), i = 1, ..., m, of the Holm step-down procedure '''
+        return alpha / np.arange(m, 0, -1)
+
+    @staticmethod
+    def BYThresholds(m, alpha):
+        ''' Critical values alpha*i/(m*c(m)), c(m) = 1+1/2+...+1/m, of the Benjamini-Yekutieli step-up procedure '''
+        return alpha * np.arange(1, m+1) / (m * np.sum(1/np.arange(1, m+1)))
+
+    @staticmethod
+    def StoreyNullProportion(p_values, scale='p', lam=0.5):
+        '''
+        Storey's estimate min(1, (#{p > lam}+1)/((1-lam)*m)) of the proportion of null hypotheses of each row,
+        dividing the critical values of the Storey-adaptive BH procedure.
+        If `scale` is 'z', `p_values` are the statistics -|z| (see `ZThresholds`).
+        '''
+        if len(p_values.shape) == 1: p_values = np.array(p_values).reshape(1, -1)
+        m = p_values.shape[-1]
+        lam_ = lam if scale == 'p' else MultiTest.ZThresholds(lam)
+        return np.minimum((np.count_nonzero(p_values > lam_, axis=1)+1)/((1-lam)*m), 1.)
+
+    @staticmethod
+    def ZThresholds(thresh):
+        '''
+        Transforms p value critical values to critical values of the statistics -|z| of the two-sided z-test:
+        the p value 2*sf(|z|) is at most t if and only if -|z| <= -isf(t/2).
+        Any procedure comparing sorted p values with critical values gives the same decisions
+        when run on -|z| with the transformed critical values.
+        '''
+        return -norm.isf(np.asarray(thresh)/2)
+
+    @staticmethod
+    def _stepCounts(passed, step, index, flags):
+        '''
+        Numbers of rejections of the rows of a step-up (`step` 'up') or step-down (`step` 'down') procedure,
+        written into `index`, from `passed`, whether each sorted candidate passes its critical value:
+        the step-up procedure rejects the k smallest p values, k being the largest index such that the k-th
+        smallest p value passes the k-th critical value, and the step-down procedure rejects them until
+        the first one that does not pass its critical value. `flags` is a boolean buffer of one value per row.
+        Shared by all the step-up and step-down methods.
+        '''
+        K = passed.shape[1]
+        if step == 'up':
+            np.argmax(passed[:, ::-1], axis=1, out=index)
+            np.any(passed, axis=1, out=flags)
+            np.subtract(K, index, out=index)
+            np.multiply(index, flags, out=index)
+        else:
+            np.argmin(passed, axis=1, out=index)
+            np.all(passed, axis=1, out=flags)
+            np.putmask(index, flags, K)
+        return index
+
+    @staticmethod
+    def StepMethodPartial(p_values, thresh, step='up', tolerance=1e-9):
+        '''
+        Step-up (`step` 'up') or step-down (`step` 'down') procedure with increasing critical values `thresh`
+        (of length m, or of shape (s, m) for critical values depending on the row), without full sort.
+        A row has at most as many rejections as p values below its largest critical value,
+        so only the K smallest p values of each row are selected (with `np.partition`) and sorted,
+        K being the largest number of such candidates over the rows.
+        The number k of rejections of each row is given by `_stepCounts`,
+        and the rejected hypotheses are exactly those passing the k-th critical value.
+        '''
         if len(p_values.shape) == 1: p_values = np.array(p_values).reshape(1, -1)
-        p_values_ = np.sort(np.asarray(p_values), axis=1)
         s, m = p_values.shape
-        zeros_row = np.zeros((s, 1), dtype=p_values.dtype)
-        padded_pvals = np.hstack((zeros_row, p_values_))
-        thresh = (alpha / np.arange(m+1, 0, -1)).reshape(1, -1)
-        mask = (padded_pvals <= thresh+1e-9).astype('float') + (thresh/2)
-        pval_cutoffs = padded_pvals[np.arange(0, s), np.argmax(mask, axis=1).astype('int')]
-        return (p_values <= pval_cutoffs.reshape(-1, 1)).astype('int')
+        thresh = np.asarray(thresh)+tolerance
+        K = np.count_nonzero(p_values <= thresh[..., -1:], axis=1).max(initial=0)
+        if K == 0: return np.zeros((s, m), dtype='int')
+        if K < m: candidates = np.partition(p_values, K-1, axis=1)[:, :K]
+        else: candidates = np.array(p_values)
+        candidates.sort(axis=1)
+        passed = candidates <= thresh[..., :K]
+        k = MultiTest._stepCounts(passed, step, np.empty(s, dtype=np.intp), np.empty(s, dtype=bool))
+        cutoffs = np.where(k > 0, np.broadcast_to(thresh, (s, m))[np.arange(s), k-1], -np.inf)
+        return (p_values <= cutoffs.reshape(-1, 1)).astype('int')
 
     @staticmethod
-    def BHMethodFast(p_values, alpha):
+    def StepUpMethodPartial(p_values, thresh):
+        return MultiTest.StepMethodPartial(p_values, thresh, step='up')
+
+    @staticmethod
+    def StepDownMethodPartial(p_values, thresh):
+        return MultiTest.StepMethodPartial(p_values, thresh, step='down')
+
+    @staticmethod
+    def ProcedureMethod(p_values, alpha, procedure, scale='p'):
+        '''
+        Applies the registered procedure `procedure` (see `PROCEDURES`) with level `alpha`,
+        its critical values being taken from the table shared by all calls with the same m and alpha.
+        If `scale` is 'z', `p_values` are the statistics -|z| of two-sided z-tests (see `ZThresholds`).
+        '''
+        if procedure not in PROCEDURES: raise ValueError(f'Unknown procedure: {procedure}')
         if len(p_values.shape) == 1: p_values = np.array(p_values).reshape(1, -1)
-        p_values_ = np.sort(np.asarray(p_values), axis=1)
+        entry = PROCEDURES[procedure]
+        thresh = procedure_thresholds(procedure, p_values.shape[-1], alpha)
+        if entry['adaptive'] is not None:
+            thresh = np.minimum(thresh/entry['adaptive'](p_values, scale).reshape(-1, 1), 1.)
+        if entry['step'] == 'single':
+            if scale == 'z': thresh = MultiTest.ZThresholds(thresh)
+            return (p_values <= thresh[..., -1:]).astype('int')
+        if scale == 'z': return MultiTest.StepMethodPartial(p_values, MultiTest.ZThresholds(thresh+1e-9),
+                                                            step=entry['step'], tolerance=0.)
+        return MultiTest.StepMethodPartial(p_values, thresh, step=entry['step'])
+
+    @staticmethod
+    def HochbergMethodPartial(p_values, alpha):
+        m = p_values.shape[-1]
+        return MultiTest.StepUpMethodPartial(p_values, MultiTest.HochbergThresholds(m, alpha))
+
+    @staticmethod
+    def BHMethodPartial(p_values, alpha):
+        m = p_values.shape[-1]
+        return MultiTest.StepUpMethodPartial(p_values, MultiTest.BHThresholds(m, alpha))
+
+    @staticmethod
+    def BonferroniMethodInPlace(p_values, alpha, out):
+        '''
+        Bonferroni method writing boolean (or uint8) decisions into `out`
+        '''
+        return np.less_equal(p_values, alpha/p_values.shape[-1], out=out)
+
+    @staticmethod
+    def SelectCandidatesInPlace(p_values, largest, workspace):
+        '''
+        Selects and sorts into `workspace.candidates` the K smallest p values of each row,
+        K being the largest number of p values below `largest` over the rows,
+        as in `StepUpMethodPartial`. The sorted candidates can be shared by all step-up methods
+        whose largest critical value (with tolerance) is at most `largest`.
+        Returns K.
+        '''
         s, m = p_values.shape
-        zeros_row = np.zeros((s, 1), dtype=p_values.dtype)
-        padded_pvals = np.hstack((zeros_row, p_values_))
-        thresh = (alpha * np.arange(0, m+1) / m).reshape(1, -1)
-        mask = (padded_pvals <= thresh+1e-9).astype('float') + (thresh/2)
-        pval_cutoffs = padded_pvals[np.arange(0, s), np.argmax(mask, axis=1).astype('int')]
-        return (p_values <= pval_cutoffs.reshape(-1, 1)).astype('int')
+        assert m == workspace.m and s <= workspace.s, 'P values do not fit in the workspace'
+        np.less_equal(p_values, largest, out=workspace.passed[:s])
+        K = max(workspace.passed[:s].sum(axis=1, out=workspace.index[:s]).max(), 1)
+        candidates = workspace.candidates[:s]
+        np.copyto(candidates, p_values)
+        if K < m: candidates.partition(K-1, axis=1)
+        candidates[:, :K].sort(axis=1)
+        return K
+
+    @staticmethod
+    def StepFromCandidatesInPlace(p_values, thresh, K, workspace, step='up', out=None):
+        '''
+        Step-up (`step` 'up') or step-down (`step` 'down') procedure from the candidates selected by
+        `SelectCandidatesInPlace`, with `thresh` from `MultiTestWorkspace.thresholds`,
+        using only the buffers of `workspace`.
+        Rejects the p values below the k-th critical value, k being the number of rejections.
+        Writes boolean (or uint8) decisions into `out`, or into `workspace.decision` if None.
+        '''
+        s = p_values.shape[0]
+        if out is None: out = workspace.decision[:s]
+        index, any_passed, cutoffs = workspace.index[:s], workspace.any[:s], workspace.cutoffs[:s]
+        passed = workspace.passed[:s, :K]
+        np.less_equal(workspace.candidates[:s, :K], thresh[1:K+1], out=passed)
+        MultiTest._stepCounts(passed, step, index, any_passed)
+        np.take(thresh, index, out=cutoffs)
+        return np.less_equal(p_values, cutoffs.reshape(-1, 1), out=out)
+
+    @staticmethod
+    def StepUpFromCandidatesInPlace(p_values, thresh, K, workspace, out=None):
+        return MultiTest.StepFromCandidatesInPlace(p_values, thresh, K, workspace, step='up', out=out)
+
+    @staticmethod
+    def _stepUpMethodInPlace(p_values, thresh, workspace, out=None):
+        '''
+        Same as `StepUpMethodPartial` using only the buffers of `workspace`
+        '''
+        K = MultiTest.SelectCandidatesInPlace(p_values, thresh[-1], workspace)
+        return MultiTest.StepUpFromCandidatesInPlace(p_values, thresh, K, workspace, out=out)
+
+    @staticmethod
+    def HochbergMethodInPlace(p_values, alpha, workspace, out=None):
+        return MultiTest._stepUpMethodInPlace(p_values, workspace.thresholds('Hochberg', alpha), workspace, out=out)
+
+    @staticmethod
+    def BHMethodInPlace(p_values, alpha, workspace, out=None):
+        return MultiTest._stepUpMethodInPlace(p_values, workspace.thresholds('BH', alpha), workspace, out=out)
+
+    @staticmethod
+    def SharedMethodsInPlace(p_values, alpha, methods, workspace, scale='p'):
+        '''
+        Applies several registered procedures (see `PROCEDURES`) to the same p values in place:
+        selects and sorts the candidates once, then yields (method, decisions) for each method in `methods`.
+        The decisions are written in `workspace.decision`,
+        so they are only valid until the next method is yielded.
+        Adaptive procedures, whose critical values depend on the row, go through `ProcedureMethod` instead.
+        If `scale` is 'z', `p_values` are the statistics -|z| of two-sided z-tests instead of p values
+        (see `MultiTestWorkspace.thresholds`).
+        '''
+        s = p_values.shape[0]
+        for method in methods:
+            if method not in PROCEDURES: raise ValueError(f'Unknown procedure: {method}')
+        stepwise = [method for method in methods
+                    if PROCEDURES[method]['step'] != 'single' and PROCEDURES[method]['adaptive'] is None]
+        if stepwise:
+            with stage('sort'):
+                largest = max(workspace.thresholds(method, alpha, scale)[-1] for method in stepwise)
+                K = MultiTest.SelectCandidatesInPlace(p_values, largest, workspace)
+        for method in methods:
+            with stage('step-up'):
+                entry = PROCEDURES[method]
+                if entry['adaptive'] is not None:
+                    decision = np.not_equal(MultiTest.ProcedureMethod(p_values, alpha, method, scale=scale), 0,
+                                            out=workspace.decision[:s])
+                elif entry['step'] == 'single':
+                    thresh = workspace.thresholds(method, alpha, scale)
+                    decision = np.less_equal(p_values, thresh[-1], out=workspace.decision[:s])
+                else:
+                    thresh = workspace.thresholds(method, alpha, scale)
+                    decision = MultiTest.StepFromCandidatesInPlace(p_values, thresh, K, workspace, step=entry['step'])
+            yield method, decision
+
+# Registry of the multiple testing procedures, by name: function (m, alpha) of the increasing critical values,
+# step ('single', 'up' or 'down'), and for adaptive procedures, function (p_values, scale) of the factor
+# of each row dividing the critical values (None otherwise).
+PROCEDURES = dict()
+
+@functools.lru_cache(maxsize=None)
+def procedure_thresholds(procedure, m, alpha):
+    '''
+    Table of the critical values of `procedure` for m hypotheses and level alpha,
+    computed once per process and shared by all cells (read-only).
+    '''
+    thresh = np.array(PROCEDURES[procedure]['thresholds'](m, alpha), dtype=float)
+    thresh.flags.writeable = False
+    return thresh
+
+def register_procedure(name, thresholds, step='up', adaptive=None):
+    '''
+    Registers the procedure `name`, which can then be used as a method of the experiment
+    (see `MultiTest.ProcedureMethod` and `MultiTest.SharedMethodsInPlace`)
+    '''
+    if step not in ('single', 'up', 'down'): raise ValueError(f'Invalid step: {step}')
+    PROCEDURES[name] = {'thresholds': thresholds, 'step': step, 'adaptive': adaptive}
+    procedure_thresholds.cache_clear()
+
+register_procedure('Bonferroni', MultiTest.BonferroniThresholds, step='single')
+register_procedure('Hochberg', MultiTest.HochbergThresholds, step='up')
+register_procedure('BH', MultiTest.BHThresholds, step='up')
+register_procedure('Holm', MultiTest.HolmThresholds, step='down')
+register_procedure('BY', MultiTest.BYThresholds, step='up')
+register_procedure('Storey', MultiTest.BHThresholds, step='up', adaptive=MultiTest.StoreyNullProportion)
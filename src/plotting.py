@@ -2,14 +2,30 @@ import os
 import time
 import math
 import json
+import hashlib
+import functools
+import matplotlib
 import numpy as np
-import matplotlib.pyplot as plt
-from src.utils import generate_jsonname_BH_exp, generate_plotname_BH_exp
+from concurrent.futures import ProcessPoolExecutor
+from src.utils import generate_jsonname_BH_exp, generate_plotname_BH_exp, parse_criteria
 from src.constants import PROCESSED_OUTPUT_DIR, PLOTTING_DIR
 
+# Name and y ticks (None for automatic ones) of the plot of each criterion
+CRITERIA_PLOTTING = {
+    'power': ('Power', [0, 0.2, 0.4, 0.6, 0.8, 1.0]),
+    'fdr': ('FDR', [0, 0.2, 0.4, 0.6, 0.8, 1.0]),
+    'fwer': ('FWER', [0, 0.2, 0.4, 0.6, 0.8, 1.0]),
+    'type1': ('number of type I errors', None),
+    'type2': ('number of type II errors', None)
+}
+
+# Key of the png metadata holding the hash of the inputs of a figure (see `figure_hash`)
+PLOT_HASH_KEY = 'InputHash'
+
 def plot_BH_exp(results, ratio_s, mode_s, m_s, method_s, 
                 filename, plotname, rownames, colnames, 
-                patterns=None, colors=None, xticks=None, yticks=None):
+                patterns=None, colors=None, xticks=None, yticks=None, metadata=None):
+    from matplotlib import pyplot as plt
     m = len(ratio_s)
     n = len(mode_s)
     _, axes = plt.subplots(m, n, figsize=(3*n+0.25, 3*m+0.25))
@@ -37,11 +53,13 @@ def plot_BH_exp(results, ratio_s, mode_s, m_s, method_s,
         for ind, name in enumerate(colnames):
             axes[-1][ind].set_xlabel(name)
     plt.tight_layout()
-    plt.savefig(filename, bbox_inches='tight')
+    plt.savefig(filename, bbox_inches='tight', metadata=metadata)
     plt.close()
 
 def plot_BH_exp_ses_hist(results, ratio_s, mode_s, m_s, method_s,
-                         filename='histogram.png', plotname=None, colors=None, transparency=0.5, bins=20):
+                         filename='histogram.png', plotname=None, colors=None, transparency=0.5, bins=20,
+                         metadata=None):
+    from matplotlib import pyplot as plt
     # Load data from dictionary `results`
     m = len(ratio_s)
     n = len(mode_s)
@@ -66,10 +84,10 @@ def plot_BH_exp_ses_hist(results, ratio_s, mode_s, m_s, method_s,
     if plotname: plt.title(plotname)
     plt.legend()
     plt.grid(True, linestyle='--', alpha=0.7)
-    plt.savefig(filename)
+    plt.savefig(filename, metadata=metadata)
     plt.close()
 
-def main_plotting(filename='params.json', params=None, print_params=True):
+def main_plotting(filename='params.json', params=None, print_params=True, processed=None):
     '''
     Main function take processed output and produce plots.
     Will be run by the `if __name__ == '__main__'` of this script.
@@ -83,6 +101,12 @@ def main_plotting(filename='params.json', params=None, print_params=True):
         if None: load json file from filename as params.
     print_params : Optional (bool)
         prints parameters
+    processed : Optional (dict)
+        if not None: processed output (means, ses, nreps) of each L from `main_analyze`,
+        used instead of the json files
+
+    The figures whose inputs are unchanged are skipped unless `params['lazy_plots']` is False,
+    and the others are rendered in a pool of `params['n_jobs']` processes (see `plot_figures`).
 
     RETURNS
     -------
@@ -101,39 +125,117 @@ def main_plotting(filename='params.json', params=None, print_params=True):
         print(' ratio_s: ', params['ratio_s'])
         print(' methods: ', params['methods'])
         print(' configs: ', params['mode_s'])
-        print(f" criterion: {params['criterion']}")
+        print(f" criteria: {', '.join(parse_criteria(params['criterion']))}")
         print(f" alpha: {params['alpha']}")
         print('==============================================')
-    colors = {'Bonferroni' : '#A52422', 'Hochberg': '#F5E663', 'BH': '#47A8BD'}
+
+    # Main plotting loop
+    figures = [figure for L in params['L_s'] for figure in figures_L(params, L, None if processed is None
+                                                                      else processed[L])]
+    rendered = plot_figures(figures, n_jobs=params.get('n_jobs'), lazy=params.get('lazy_plots', True))
+    if print_params: print(f' Plotted {len(rendered)} figures ({len(figures)-len(rendered)} unchanged)')
+
+    # Return time
+    return [['Plotting', time.perf_counter()-start_time]]
+
+def plot_L(params, L, processed_L=None):
+    '''
+    Plots the processed output of every criterion for one value of L,
+    given as (means, ses, nreps) by `analyze_L` or read from the json files if None,
+    skipping the figures whose inputs are unchanged unless `params['lazy_plots']` is False
+    '''
+    return plot_figures(figures_L(params, L, processed_L), lazy=params.get('lazy_plots', True))
+
+def figures_L(params, L, processed_L=None):
+    '''
+    Figures of every criterion for one value of L (see `plot_L`),
+    as a list of (plotting function, keyword arguments) pairs
+    '''
+    colors = {'Bonferroni' : '#A52422', 'Hochberg': '#F5E663', 'BH': '#47A8BD',
+              'Holm': '#6B4E71', 'BY': '#3A7D44', 'Storey': '#F08A4B'}
 
     # Directory handling
     if 'outdir' not in params: plotting_dir = PLOTTING_DIR
     else: plotting_dir = f"results/{params['outdir']}"
     os.makedirs(plotting_dir, exist_ok=True)
 
-    # Main plotting loop
-    for L in params['L_s']:
-        jsonname_means, jsonname_ses = generate_jsonname_BH_exp(L)
-        plotname_means, plotname_ses = generate_plotname_BH_exp(L, pdf=False)
-        with open(f'{PROCESSED_OUTPUT_DIR}/{jsonname_means}', 'r') as file:
-            means = json.load(file)
-            plot_BH_exp(means, params['ratio_s'], params['mode_s'], params['m_s'], params['methods'], 
-                        filename = f'{plotting_dir}/{plotname_means}',  
-                        plotname = 'Plot of Power as a function of number of hypotheses', 
-                        rownames = [str(np.round(float(ratio)*100, 1))+'% null' for ratio in params['ratio_s']],
-                        colnames = ['Config '+config for config in params['mode_s']],
-                        patterns = {'Bonferroni' : ':', 'Hochberg': '--', 'BH': '-'},
-                        colors = colors,
-                        xticks = params['m_s'], yticks = [0, 0.2, 0.4, 0.6, 0.8, 1.0])
-        with open(f'{PROCESSED_OUTPUT_DIR}/{jsonname_ses}', 'r') as file:
-            ses = json.load(file)
-            plot_BH_exp_ses_hist(ses, params['ratio_s'], params['mode_s'], params['m_s'], params['methods'],
-                                 filename=f'{plotting_dir}/{plotname_ses}', plotname='Histogram of se',
-                                 colors = colors,
-                                 transparency=0.5, bins=20)
-    
-    # Return time
-    return [['Plotting', time.perf_counter()-start_time]]
+    # Figures of each criterion
+    figures = []
+    for crit in parse_criteria(params['criterion']):
+        name, yticks = CRITERIA_PLOTTING[crit]
+        jsonname_means, jsonname_ses = generate_jsonname_BH_exp(L, criterion=crit)
+        plotname_means, plotname_ses = generate_plotname_BH_exp(L, pdf=False, criterion=crit)
+        if processed_L is None:
+            with open(f'{PROCESSED_OUTPUT_DIR}/{jsonname_means}', 'r') as file: means = json.load(file)
+            with open(f'{PROCESSED_OUTPUT_DIR}/{jsonname_ses}', 'r') as file: ses = json.load(file)
+        else: means, ses = processed_L[0][crit], processed_L[1][crit]
+        figures.append((plot_BH_exp, dict(
+            results = means, ratio_s = params['ratio_s'], mode_s = params['mode_s'], m_s = params['m_s'],
+            method_s = params['methods'],
+            filename = f'{plotting_dir}/{plotname_means}',
+            plotname = f'Plot of {name} as a function of number of hypotheses',
+            rownames = [str(np.round(float(ratio)*100, 1))+'% null' for ratio in params['ratio_s']],
+            colnames = ['Config '+config for config in params['mode_s']],
+            patterns = {'Bonferroni' : ':', 'Hochberg': '--', 'BH': '-',
+                        'Holm': ':', 'BY': '-.', 'Storey': '-.'},
+            colors = colors,
+            xticks = params['m_s'], yticks = yticks)))
+        figures.append((plot_BH_exp_ses_hist, dict(
+            results = ses, ratio_s = params['ratio_s'], mode_s = params['mode_s'], m_s = params['m_s'],
+            method_s = params['methods'],
+            filename = f'{plotting_dir}/{plotname_ses}', plotname = f'Histogram of se of {name}',
+            colors = colors,
+            transparency = 0.5, bins = 20)))
+    return figures
+
+@functools.lru_cache(maxsize=None)
+def _code_version():
+    with open(os.path.abspath(__file__), 'rb') as file: return hashlib.sha256(file.read()).hexdigest()
+
+def figure_hash(function, kwargs):
+    '''
+    Hash of the inputs of a figure: its plotting function and arguments, and the code of this file
+    '''
+    fields = [_code_version(), function.__name__, kwargs]
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+def _saved_hash(filename):
+    '''
+    Hash of the inputs of the figure saved in `filename`, None if there is none
+    '''
+    from PIL import Image
+    try:
+        with Image.open(filename) as image: return image.text.get(PLOT_HASH_KEY)
+    except (OSError, AttributeError):
+        return None
+
+def use_agg_backend():
+    '''
+    Initializer of the plotting worker processes
+    '''
+    matplotlib.use('Agg', force=True)
+
+def _render(function, kwargs, digest):
+    function(**kwargs, metadata={PLOT_HASH_KEY: digest})
+
+def plot_figures(figures, n_jobs=None, lazy=True):
+    '''
+    Renders the figures given as (plotting function, keyword arguments) pairs, the hash of the inputs of each
+    (see `figure_hash`) being saved in its png metadata. If `lazy`, the figures whose saved hash is that of
+    their inputs are skipped. With `n_jobs` > 1, the figures are rendered in a pool of processes on the
+    Agg backend. Returns the names of the files rendered.
+    '''
+    todo = []
+    for function, kwargs in figures:
+        digest = figure_hash(function, kwargs)
+        if not lazy or _saved_hash(kwargs['filename']) != digest: todo.append((function, kwargs, digest))
+    n_jobs = min(n_jobs or 1, len(todo))
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=use_agg_backend) as pool:
+            for future in [pool.submit(_render, *figure) for figure in todo]: future.result()
+    else:
+        for figure in todo: _render(*figure)
+    return [kwargs['filename'] for _, kwargs, _ in todo]
 
 if __name__ == '__main__':
     main_plotting()
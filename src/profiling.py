@@ -0,0 +1,103 @@
+import os
+import csv
+import json
+import time
+import contextlib
+import tracemalloc
+
+# Shared by the disabled profiler, so that instrumented code costs nothing when not profiling
+_NULL_STAGE = contextlib.nullcontext()
+
+class Profiler:
+    '''
+    Per-cell and per-stage timers and allocation counters of the simulation.
+    Instrumented code wraps each stage (e.g. 'generate', 'pvalue', 'sort', 'step-up', 'reduce', 'save')
+    in `with stage(name):`, and the cell being simulated is set with `set_cell`.
+    For each (cell, stage), records the number of calls, the total time,
+    and the largest peak of memory allocated during one call (with `tracemalloc`, unless enabled with
+    `memory=False`: tracing every allocation slows down the stages, so their times are best measured without it).
+    Stages must not be nested. Only the current process is profiled, so use a single job.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.cell = None
+        self.records = dict()
+
+    def enable(self, memory=True):
+        self.enabled = True
+        self.memory = memory
+        self.records = dict()
+        if memory and not tracemalloc.is_tracing(): tracemalloc.start()
+
+    def disable(self):
+        self.enabled = False
+        self.cell = None
+        if self.memory and tracemalloc.is_tracing(): tracemalloc.stop()
+
+    def set_cell(self, L, m_0, m, mode, num_rep):
+        if self.enabled: self.cell = (float(L), int(m_0), int(m), mode, int(num_rep))
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        if self.memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter()-start
+            peak = tracemalloc.get_traced_memory()[1]-base if self.memory else 0
+            record = self.records.setdefault((self.cell, name), [0, 0., 0])
+            record[0] += 1
+            record[1] += elapsed
+            record[2] = max(record[2], peak)
+
+    def stage(self, name):
+        return self._stage(name) if self.enabled else _NULL_STAGE
+
+    def report(self):
+        '''
+        Returns the records as a list of rows (dictionaries), one per cell and stage
+        '''
+        rows = []
+        for (cell, name), (calls, seconds, peak) in self.records.items():
+            row = dict(zip(('L', 'm_0', 'm', 'mode', 'num_rep'), cell if cell is not None else (None, )*5))
+            row.update(stage=name, calls=calls, seconds=seconds, peak_bytes=peak)
+            rows.append(row)
+        return rows
+
+    def summary(self):
+        '''
+        Returns the total time and largest peak memory of each stage, for each (m, num_rep)
+        '''
+        output = dict()
+        for row in self.report():
+            key = (row['m'], row['num_rep'], row['stage'])
+            seconds, peak = output.get(key, (0., 0))
+            output[key] = (seconds+row['seconds'], max(peak, row['peak_bytes']))
+        return output
+
+    def save(self, filename):
+        '''
+        Saves the report as `filename`.json and `filename`.csv
+        '''
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        rows = self.report()
+        with open(f'{filename}.json', 'w') as file:
+            json.dump(rows, file, indent=4)
+        with open(f'{filename}.csv', 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=['L', 'm_0', 'm', 'mode', 'num_rep', 'stage', 'calls',
+                                                     'seconds', 'peak_bytes'])
+            writer.writeheader()
+            writer.writerows(rows)
+
+# Profiler of the current process
+PROFILER = Profiler()
+
+def stage(name):
+    '''
+    Context manager timing the stage `name` of the current cell if profiling is enabled
+    '''
+    return PROFILER.stage(name)
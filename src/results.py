@@ -0,0 +1,48 @@
+import numpy as np
+from src.utils import mean_and_se, mean_and_se_from_stats
+
+class ExperimentResults:
+    '''
+    In-memory outputs of the BH experiment, handed from the simulation to the analysis
+    without going through the raw store.
+    Maps each (L, ratio, mode, method, m) to the outputs of its cell and method,
+    a dictionary keyed by criterion, together with their kind ('reps' for per-replication values,
+    'stats' for sufficient statistics).
+    '''
+    def __init__(self):
+        self.outputs = dict()
+        self.kinds = dict()
+
+    @staticmethod
+    def key(L, r, mode, method, m):
+        return (float(np.round(float(L), 1)), r, mode, method, int(m))
+
+    def __contains__(self, key):
+        return key in self.outputs
+
+    def __len__(self):
+        return len(self.outputs)
+
+    def add(self, L, r, mode, m, output, kind):
+        '''
+        Records the outputs {method: {criterion: values}} of one cell
+        '''
+        for method, method_output in output.items():
+            key = ExperimentResults.key(L, r, mode, method, m)
+            self.outputs[key] = method_output
+            self.kinds[key] = kind
+
+    def update(self, other):
+        '''
+        Merges the results of another `ExperimentResults`, e.g. of a worker process
+        '''
+        self.outputs.update(other.outputs)
+        self.kinds.update(other.kinds)
+
+    def summary(self, key, criterion):
+        '''
+        Mean, se and number of replications of `criterion` for `key`, as computed from the raw store
+        '''
+        values = self.outputs[key][criterion]
+        if self.kinds[key] == 'stats': return (*mean_and_se_from_stats(values), int(values[0]))
+        return (*mean_and_se(np.asarray(values)), len(values))
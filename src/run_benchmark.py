@@ -1,72 +1,283 @@
+import os
+import sys
 import json
 import time
+import platform
 import argparse
+import tracemalloc
+import subprocess
 import numpy as np
+import scipy
+from scipy.stats import norm
+from src.methods import MultiTest, MultiTestWorkspace
+from src.simulation import main_simulation, _generator_BH_exp, _p_values_in_place, PVALUE_MODES
 from src.run_experiment import main_experiment
+from src.results import ExperimentResults
+from src.constants import BENCHMARK_DIR
+
+SUITES = ('methods', 'generators', 'pvalues', 'analytic', 'end_to_end')
+
+# The row-by-row methods are only benchmarked up to this number of rows
+SLOW_METHOD_MAX_ROWS = 1000
+
+def time_function(function, setup=None, repeat=7, warmup=1):
+    '''
+    Times `function(*setup())` `repeat` times after `warmup` untimed calls,
+    `setup` (untimed) preparing fresh arguments for each call.
+    The peak memory allocated during one call is measured with `tracemalloc` in an additional call,
+    so that tracing does not slow down the timed calls.
+    Returns a dictionary with the median, interquartile range, min and max of the times (in seconds),
+    the number of repetitions and the peak memory (in bytes).
+    '''
+    if setup is None: setup = lambda: ()
+    for _ in range(warmup): function(*setup())
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter()-start)
+    args = setup()
+    tracing = tracemalloc.is_tracing()
+    if not tracing: tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]-base
+    if not tracing: tracemalloc.stop()
+    q1, median, q3 = np.percentile(times, [25, 50, 75])
+    return {'median': float(median), 'iqr': float(q3-q1), 'min': float(np.min(times)),
+            'max': float(np.max(times)), 'repeat': repeat, 'peak_bytes': int(peak)}
+
+def _data_BH_exp(s, m, prob_alt_hypo=False, seed=17):
+    '''
+    Test statistics of s replications of a cell of the BH experiment (L=5, half nulls, equal groups)
+    '''
+    rng = np.random.default_rng(seed)
+    return _generator_BH_exp(5.0, m//2, m, 'E', prob_alt_hypo, rng).generate_data(size=s)
+
+def _method_functions(alpha):
+    '''
+    Functions (p_values, workspace) of each benchmarked method of `MultiTest`, and whether they are row-by-row
+    '''
+    def shared(p_values, workspace):
+        for _ in MultiTest.SharedMethodsInPlace(p_values, alpha, ['Bonferroni', 'Hochberg', 'BH'], workspace): pass
+    return {
+        'BonferroniMethod': (lambda p, w: MultiTest.BonferroniMethod(p, alpha), False),
+        'HochbergMethod': (lambda p, w: MultiTest.HochbergMethod(p, alpha), True),
+        'BHMethod': (lambda p, w: MultiTest.BHMethod(p, alpha), True),
+        'HochbergMethodFast': (lambda p, w: MultiTest.HochbergMethodFast(p, alpha), False),
+        'BHMethodFast': (lambda p, w: MultiTest.BHMethodFast(p, alpha), False),
+        'HochbergMethodPartial': (lambda p, w: MultiTest.HochbergMethodPartial(p, alpha), False),
+        'BHMethodPartial': (lambda p, w: MultiTest.BHMethodPartial(p, alpha), False),
+        'HochbergMethodInPlace': (lambda p, w: MultiTest.HochbergMethodInPlace(p, alpha, w), False),
+        'BHMethodInPlace': (lambda p, w: MultiTest.BHMethodInPlace(p, alpha, w), False),
+        'SharedMethodsInPlace': (shared, False),
+    }
+
+def benchmark_methods(s_s, m_s, alpha=0.05, repeat=7, warmup=1):
+    '''
+    Microbenchmarks of each method of `MultiTest` on s replications of m p values, for s in `s_s` and m in `m_s`
+    '''
+    output = dict()
+    for m in m_s:
+        for s in s_s:
+            p_values = 1-2*np.abs(norm.cdf(_data_BH_exp(s, m))-0.5)
+            workspace = MultiTestWorkspace(s, m)
+            for name, (function, slow) in _method_functions(alpha).items():
+                if slow and s > SLOW_METHOD_MAX_ROWS: continue
+                output[f'methods/{name}/s={s}/m={m}'] = \
+                    time_function(function, lambda: (p_values, workspace), repeat=repeat, warmup=warmup)
+    return output
+
+def benchmark_generators(s_s, m_s, repeat=7, warmup=1):
+    '''
+    Benchmarks of the deterministic and probabilistic generation of s replications of m test statistics
+    '''
+    output = dict()
+    for m in m_s:
+        for s in s_s:
+            for prob_alt_hypo in [False, True]:
+                generator = _generator_BH_exp(5.0, m//2, m, 'E', prob_alt_hypo, np.random.default_rng(17))
+                out = np.empty((s, m))
+                name = 'probabilistic' if prob_alt_hypo else 'deterministic'
+                output[f'generators/{name}/s={s}/m={m}'] = \
+                    time_function(lambda: generator.generate_data(size=s, out=out), repeat=repeat, warmup=warmup)
+    return output
+
+def benchmark_pvalues(s_s, m_s, repeat=7, warmup=1):
+    '''
+    Benchmarks of the p value layers of the vectorized simulation (see `_p_values_in_place`)
+    on s replications of m test statistics
+    '''
+    output = dict()
+    for m in m_s:
+        for s in s_s:
+            data, buffer = _data_BH_exp(s, m), np.empty((s, m))
+            def setup():
+                np.copyto(buffer, data)
+                return (buffer, )
+            for pvalue in PVALUE_MODES:
+                output[f'pvalues/{pvalue}/s={s}/m={m}'] = \
+                    time_function(lambda x: _p_values_in_place(x, pvalue=pvalue), setup, repeat=repeat, warmup=warmup)
+    return output
+
+def benchmark_analytic(params, repeat=3, warmup=1):
+    '''
+    Benchmarks of the simulation of the whole experiment of `params` with the deterministic generation,
+    evaluating exactly the cells where it is estimated faster (see `_use_analytic_BH_exp`) or simulating all of them.
+    The first should not be slower than the second.
+    '''
+    output = dict()
+    for analytic in [True, False]:
+        case = dict(params, vectorize=True, n_jobs=1, prob_alt_hypo=False, saving=False, cache=False,
+                    analytic=analytic)
+        def run(): main_simulation(params=case, print_params=False, results=ExperimentResults())
+        output[f"analytic/{'chosen' if analytic else 'simulated'}"] = time_function(run, repeat=repeat, warmup=warmup)
+    return output
+
+def benchmark_end_to_end(params, repeat=3, warmup=1, plots=False):
+    '''
+    Benchmarks of the simulation and analysis of the whole experiment of `params` (see `main_experiment`),
+    vectorized or not, on 1 or 2 jobs, with deterministic or probabilistic generation.
+    Outputs are handed in memory and nothing is written to `results/`, unless `plots`:
+    every figure is then also rendered at each run.
+    The warmup run also starts the workers of the parallel cases.
+    '''
+    output = dict()
+    for vec in [False, True]:
+        for n_jobs in [1, 2]:
+            for prob in [False, True]:
+                name = f"{'vec'  if vec else 'unvec'}_"+\
+                       f"{'par'  if n_jobs>1 else 'unpar'}_"+\
+                       f"{'prob' if prob else 'des'}"
+                case = dict(params, vectorize=vec, n_jobs=n_jobs, prob_alt_hypo=prob, saving=False,
+                            save_processed=False, cache=False, plots=plots, lazy_plots=False)
+                print(f'Running experiment {name} ... ')
+                output[f"end_to_end{'_plots' if plots else ''}/{name}"] = \
+                    time_function(lambda: main_experiment(case, printing=False), repeat=repeat, warmup=warmup)
+    return output
+
+def machine_info():
+    '''
+    Description of the machine and software versions, saved with the benchmark results
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'platform': platform.platform(), 'machine': platform.machine(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'scipy': scipy.__version__, 'commit': commit, 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+def save_benchmark(benchmarks, config, filename):
+    '''
+    Saves the benchmark results with the machine info and configuration as json
+    '''
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename, 'w') as file:
+        json.dump({'machine': machine_info(), 'config': config, 'benchmarks': benchmarks}, file, indent=4)
+
+def compare_benchmarks(old, new, threshold=0.1):
+    '''
+    Compares the median times of the benchmarks common to two saved runs (dictionaries as saved by
+    `save_benchmark`). A benchmark regresses if its median time grows by more than `threshold` (relative).
+    Returns a list of (name, old median, new median, ratio, regressed), and the names of the regressions.
+    '''
+    rows, regressions = [], []
+    for name in old['benchmarks']:
+        if name not in new['benchmarks']: continue
+        old_median, new_median = old['benchmarks'][name]['median'], new['benchmarks'][name]['median']
+        ratio = new_median/old_median if old_median > 0 else np.inf
+        regressed = ratio > 1+threshold
+        rows.append((name, old_median, new_median, ratio, regressed))
+        if regressed: regressions.append(name)
+    return rows, regressions
+
+def print_benchmarks(benchmarks):
+    width = max(len(name) for name in benchmarks)
+    print(f"{'benchmark':<{width}}  {'median (ms)':>12}  {'iqr (ms)':>10}  {'peak (MB)':>10}")
+    for name, record in benchmarks.items():
+        print(f"{name:<{width}}  {record['median']*1e3:>12.3f}  {record['iqr']*1e3:>10.3f}  "+\
+              f"{record['peak_bytes']/2**20:>10.2f}")
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--seed', '-s', help='Experiment randomization seed (default: 17)', 
-                        action='store', default=17)
+    parser.add_argument('--suites', help=f"Benchmark suites to run, comma-separated (default: {','.join(SUITES)})",
+                        action='store', default=','.join(SUITES))
+    parser.add_argument('--s_s', help='Numbers of replications of the microbenchmarks, comma-separated \
+                        (default: 100,1000,10000)', action='store', default='100,1000,10000')
+    parser.add_argument('--m_s', help='Numbers of hypotheses of the microbenchmarks, comma-separated \
+                        (default: 4,64,1024)', action='store', default='4,64,1024')
+    parser.add_argument('--repeat', '-r', help='Timed repetitions of each microbenchmark (default: 7)',
+                        action='store', type=int, default=7)
+    parser.add_argument('--repeat_end_to_end', help='Timed repetitions of each end-to-end benchmark (default: 3)',
+                        action='store', type=int, default=3)
+    parser.add_argument('--seed', '-s', help='Experiment randomization seed (default: 17)',
+                        action='store', type=int, default=17)
     parser.add_argument('--alpha', '-a', help='P value threshold (default: 0.05)', action='store',
-                         default=0.05)
-    parser.add_argument('--num_rep', '-n', help='Experiment sample size (default: 20000)', 
-                        action='store', default=20000)
+                        type=float, default=0.05)
+    parser.add_argument('--num_rep', '-n', help='Experiment sample size of the end-to-end benchmarks \
+                        (default: 2000)', action='store', type=int, default=2000)
     parser.add_argument('--criterion', '-c', help='Performance criterion (default: power)',
                         action='store', default='power')
     parser.add_argument('--infile', '-i', help='Input json file for experiment parameters \
-                        that will be plotted: L_s, m_s, ratio_s, mode_s, and methods \
+                        of the end-to-end benchmarks: L_s, m_s, ratio_s, mode_s, and methods \
                         (default: params.json)', action='store', default='params.json')
+    parser.add_argument('--outfile', '-o', help=f'Output json file of the results \
+                        (default: {BENCHMARK_DIR}/benchmark_<date>.json)', action='store', default=None)
+    parser.add_argument('--plots', help='Also render every figure in the end-to-end benchmarks \
+                        (by default, they time the computation only)', action='store_true')
+    parser.add_argument('--compare', help='Compare two saved runs OLD NEW instead of benchmarking, \
+                        exiting with status 1 if there is a regression', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--threshold', help='Relative growth of the median time flagged as a regression \
+                        by --compare (default: 0.1)', action='store', type=float, default=0.1)
     return parser.parse_args()
 
 if __name__ == '__main__':
 
     # Parsing input arguments
     args = parse_arguments()
-    with open(args.infile, 'r') as file:
-        params = json.load(file)
-    params['seed'] = args.seed
-    params['num_rep'] = args.num_rep
-    params['criterion'] = args.criterion
-    params['alpha'] = args.alpha
-
-    # Run the cases
-    times = dict()
-    for vec in [False, True]:
-        for n_jobs in [1, 2]:
-            for prob in [True, False]:
-                name = f"{'vec'  if vec else 'unvec'}_"+\
-                       f"{'par'  if n_jobs>1 else 'unpar'}_"+\
-                       f"{'prob' if prob else 'des'}"
-                params['outdir'] = f'benchmark_plots/{name}'
-                params['vectorize'] = vec
-                params['n_jobs'] = n_jobs
-                params['prob_alt_hypo'] = prob
-                print(f'Running experiment {name} ... ')
-                times.setdefault(vec, dict())\
-                     .setdefault(n_jobs, dict())[prob] = \
-                     np.round(main_experiment(params=params, printing=False), 3)
-                
-    # Print output
-    time_vec_par = f'{times[True][2][False]}/{times[True][2][True]}'
-    time_vec_unpar = f'{times[True][1][False]}/{times[True][1][True]}'
-    time_unvec_par = f'{times[False][2][False]}/{times[False][2][True]}'
-    time_unvec_unpar = f'{times[False][1][False]}/{times[False][1][True]}'
-    time_vec_par = time_vec_par + ' '*(14-len(time_vec_par))
-    time_vec_unpar = time_vec_unpar + ' '*(14-len(time_vec_unpar))
-    time_unvec_par = time_unvec_par + ' '*(14-len(time_unvec_par))
-    time_unvec_unpar = time_unvec_unpar + ' '*(14-len(time_unvec_unpar))
-    print()
-    print()
-    print('Timing of the runs (deterministic/probabilistic alt. hypo. p value generation):')
-    print()
-    print(f'                     Unvectorized           Vectorized')
-    print(f'               +----------------------+----------------------+')
-    print(f'               |                      |                      |')
-    print(f'Unparallelized |    {time_unvec_unpar}    |    {time_vec_unpar}    |')
-    print(f'               |                      |                      |')
-    print(f'               +----------------------+----------------------+')
-    print(f'               |                      |                      |')
-    print(f'Parallelized   |    {time_unvec_par}    |    {time_vec_par}    |')
-    print(f'               |                      |                      |')
-    print(f'               +----------------------+----------------------+')
+
+    # Compare two saved runs
+    if args.compare:
+        with open(args.compare[0], 'r') as file: old = json.load(file)
+        with open(args.compare[1], 'r') as file: new = json.load(file)
+        different = [key for key in old['machine'] if key not in ['commit', 'date'] \
+                     and old['machine'][key] != new['machine'].get(key)]
+        if different:
+            print(f"Warning: the runs differ in {', '.join(different)}")
+        rows, regressions = compare_benchmarks(old, new, threshold=args.threshold)
+        width = max([len(row[0]) for row in rows], default=9)
+        print(f"{'benchmark':<{width}}  {'old (ms)':>10}  {'new (ms)':>10}  {'ratio':>6}")
+        for name, old_median, new_median, ratio, regressed in rows:
+            print(f"{name:<{width}}  {old_median*1e3:>10.3f}  {new_median*1e3:>10.3f}  {ratio:>6.2f}"+\
+                  ('  REGRESSION' if regressed else ''))
+        print(f'{len(regressions)} regression(s) past {args.threshold:.0%} out of {len(rows)} benchmarks')
+        sys.exit(1 if regressions else 0)
+
+    # Run the suites
+    suites = args.suites.split(',')
+    s_s = [int(s) for s in args.s_s.split(',')]
+    m_s = [int(m) for m in args.m_s.split(',')]
+    benchmarks = dict()
+    if 'methods' in suites:
+        benchmarks.update(benchmark_methods(s_s, m_s, alpha=args.alpha, repeat=args.repeat))
+    if 'generators' in suites:
+        benchmarks.update(benchmark_generators(s_s, m_s, repeat=args.repeat))
+    if 'pvalues' in suites:
+        benchmarks.update(benchmark_pvalues(s_s, m_s, repeat=args.repeat))
+    if 'analytic' in suites or 'end_to_end' in suites:
+        with open(args.infile, 'r') as file:
+            params = json.load(file)
+        params.update(seed=args.seed, num_rep=args.num_rep, criterion=args.criterion, alpha=args.alpha)
+    if 'analytic' in suites:
+        benchmarks.update(benchmark_analytic(params, repeat=args.repeat_end_to_end))
+    if 'end_to_end' in suites:
+        benchmarks.update(benchmark_end_to_end(params, repeat=args.repeat_end_to_end, plots=args.plots))
+
+    # Print and save output
+    print_benchmarks(benchmarks)
+    outfile = args.outfile or f"{BENCHMARK_DIR}/benchmark_{time.strftime('%Y%m%d-%H%M%S')}.json"
+    save_benchmark(benchmarks, vars(args), outfile)
+    print(f'Saved in {outfile}')
@@ -1,34 +1,136 @@
+import os
 import json
-import time
 import argparse
 import numpy as np
-from src.run_experiment import main_experiment
-from matplotlib import pyplot as plt
+from scipy.stats import norm, t as student_t
+from src.methods import MultiTest
+from src.simulation import main_simulation, simulate_BH_exp, simulate_cell_BH_exp, _generator_BH_exp
+from src.results import ExperimentResults
+from src.profiling import PROFILER
+from src.run_benchmark import time_function
+
+# Methods of `MultiTest` timed on their own in the sweeps
+COMPLEXITY_METHODS = ['BonferroniMethod', 'HochbergMethodFast', 'BHMethodFast', 'BHMethodPartial']
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--seed', '-s', help='Experiment randomization seed (default: 17)', 
-                        action='store', default=17)
+    parser.add_argument('--seed', '-s', help='Experiment randomization seed (default: 17)',
+                        action='store', type=int, default=17)
     parser.add_argument('--alpha', '-a', help='P value threshold (default: 0.05)', action='store',
-                         default=0.05)
-    parser.add_argument('--outdir', '-o', help='Output directory in `results/` (default: plots)', 
+                         type=float, default=0.05)
+    parser.add_argument('--outdir', '-o', help='Output directory in `results/` (default: plots)',
                         action='store', default='plots')
     parser.add_argument('--num_reps', '-n',
-                        help='Experiment sample sizes, comma-separated (default: [200, 630, 2000])', 
+                        help='Sample sizes of the num_rep sweep, comma-separated (default: [200, 630, 2000, 6300, 20000])',
                         action='append', type=lambda s: [int(x) for x in s.split(',')])
-    parser.add_argument('--n_jobs', '-j', help='Number of thres to use (default: 1 - unparallel)', 
-                        action='store', default=1)
-    parser.add_argument('--unvectorized', '-u', help='Option to run unvectorized baseline', 
+    parser.add_argument('--m_s', '-m', help='Numbers of hypotheses of the m sweep, comma-separated \
+                        (default: 16,64,256,1024,4096)', action='store', default='16,64,256,1024,4096')
+    parser.add_argument('--n_jobs_s', '-j', help='Numbers of jobs of the n_jobs sweep, comma-separated \
+                        (default: 1,2,4)', action='store', default='1,2,4')
+    parser.add_argument('--fixed_num_rep', help='Sample size of the m sweep and of the n_jobs sweep (default: 2000)',
+                        action='store', type=int, default=2000)
+    parser.add_argument('--fixed_m', help='Number of hypotheses of the num_rep sweep (default: 256)',
+                        action='store', type=int, default=256)
+    parser.add_argument('--repeat', '-r', help='Timed repetitions of each point, of which the median is kept \
+                        (default: 3)', action='store', type=int, default=3)
+    parser.add_argument('--no_plots', '--no-plots', help='Only save the fits, without plotting the sweeps',
+                        action='store_true')
+    parser.add_argument('--unvectorized', '-u', help='Option to run unvectorized baseline',
                         action='store_true')
     parser.add_argument('--probabilistic', '-p', help='Run probabilistic alt. hypo. generation \
                         instead of deterministic one', action='store_true')
     parser.add_argument('--criterion', '-c', help='Performance criterion (default: power)',
                         action='store', default='power')
     parser.add_argument('--infile', '-i', help='Input json file for experiment parameters \
-                        that will be plotted: L_s, m_s, ratio_s, mode_s, and methods \
+                        of the n_jobs sweep: L_s, m_s, ratio_s, mode_s, and methods \
                         (default: params.json)', action='store', default='params.json')
     return parser.parse_args()
 
+def fit_power_law(x, y, level=0.95):
+    '''
+    Least squares fit of log(y) = log(c) + b*log(x).
+    Returns a dictionary with the exponent b, its `level` confidence interval (student t, n-2 degrees of freedom),
+    and the prefactor c. With two points, the interval is infinite.
+    '''
+    log_x, log_y = np.log(np.asarray(x, dtype=float)), np.log(np.asarray(y, dtype=float))
+    n = len(log_x)
+    b, a = np.polyfit(log_x, log_y, 1)
+    if n > 2:
+        residuals = log_y-(a+b*log_x)
+        se = np.sqrt(residuals @ residuals/(n-2)/np.sum((log_x-log_x.mean())**2))
+        half_width = student_t.ppf((1+level)/2, n-2)*se
+    else:
+        half_width = np.inf
+    return {'exponent': float(b), 'ci_low': float(b-half_width), 'ci_high': float(b+half_width),
+            'prefactor': float(np.exp(a))}
+
+def _run_cell(m, num_rep, args):
+    '''
+    Simulates a cell with m hypotheses, half of them null, with the three methods of the experiment
+    '''
+    methods = ['Bonferroni', 'Hochberg', 'BH']
+    if args.unvectorized:
+        for method in methods:
+            simulate_BH_exp(5.0, m//2, m, 'E', num_rep, method, args.criterion, alpha=args.alpha, saving=False,
+                            vectorize=False, prob_alt_hypo=args.probabilistic, seed=args.seed)
+    else:
+        simulate_cell_BH_exp(5.0, m//2, m, 'E', num_rep, methods, args.criterion, alpha=args.alpha,
+                             saving=False, prob_alt_hypo=args.probabilistic, seed=args.seed)
+
+def _time_stages(m, num_rep, args):
+    '''
+    Times the simulation of a cell with m hypotheses (see `_run_cell`), each of its stages
+    (see `src/profiling.py`), and each method of `COMPLEXITY_METHODS` on its p values.
+    The total is timed with the profiler disabled and the stages without tracing the allocations,
+    which slows them down; the peak memory of each stage is measured in a separate traced run.
+    Returns a dictionary mapping 'total', each stage and each method to the median of the times,
+    and a dictionary mapping each stage to its peak memory (in bytes).
+    '''
+    output = {'total': time_function(lambda: _run_cell(m, num_rep, args), repeat=args.repeat)['median']}
+    records = []
+    for _ in range(args.repeat):
+        PROFILER.enable(memory=False)
+        _run_cell(m, num_rep, args)
+        PROFILER.disable()
+        record = dict()
+        for row in PROFILER.report():
+            record[row['stage']] = record.get(row['stage'], 0.)+row['seconds']
+        records.append(record)
+    output.update({key: float(np.median([record[key] for record in records])) for key in records[0]})
+    PROFILER.enable(memory=True)
+    _run_cell(m, num_rep, args)
+    PROFILER.disable()
+    peaks = dict()
+    for row in PROFILER.report(): peaks[row['stage']] = max(peaks.get(row['stage'], 0), row['peak_bytes'])
+    rng = np.random.default_rng(args.seed)
+    data = _generator_BH_exp(5.0, m//2, m, 'E', args.probabilistic, rng).generate_data(size=num_rep)
+    p_values = 1-2*np.abs(norm.cdf(data)-0.5)
+    for name in COMPLEXITY_METHODS:
+        method = getattr(MultiTest, name)
+        output[name] = time_function(lambda: method(p_values, args.alpha), repeat=args.repeat)['median']
+    return output, peaks
+
+def _time_simulation(params, n_jobs, args):
+    '''
+    Median time of the simulation of the whole experiment of `params` on `n_jobs` jobs,
+    over the grid of cells, with the outputs kept in memory
+    '''
+    case = dict(params, n_jobs=n_jobs, schedule='grid', saving=False, cache=False, analytic=False)
+    def run(): main_simulation(params=case, print_params=False, results=ExperimentResults())
+    return time_function(run, repeat=args.repeat)['median']
+
+def _fit_sweep(x, times):
+    '''
+    Fits the power law exponent of each timed stage and method of a sweep
+    '''
+    return {key: fit_power_law(x, [point[key] for point in times])
+            for key in times[0] if all(point[key] > 0 for point in times)}
+
+def _print_fits(title, fits):
+    print(f'{title}:')
+    for key, fit in fits.items():
+        print(f"   [{key}]: {fit['exponent']:.3f} ({fit['ci_low']:.3f}, {fit['ci_high']:.3f})")
+
 if __name__ == '__main__':
 
     # Parsing input arguments
@@ -36,29 +138,86 @@ if __name__ == '__main__':
     with open(args.infile, 'r') as file:
         params = json.load(file)
     params['seed'] = args.seed
-    params['num_rep'] = args.num_reps
     params['criterion'] = args.criterion
     params['alpha'] = args.alpha
-    params['outdir'] = args.outdir
     params['vectorize'] = not args.unvectorized
-    params['n_jobs'] = args.n_jobs
     params['prob_alt_hypo'] = args.probabilistic
+    params['num_rep'] = args.fixed_num_rep
 
-    # Parsing size
-    if args.num_reps is None: num_reps = [200, 630, 2000]
+    # Parsing sizes
+    if args.num_reps is None: num_reps = [200, 630, 2000, 6300, 20000]
     else: num_reps = [x for group in args.num_reps for x in group]
+    m_s = [int(m) for m in args.m_s.split(',')]
+    n_jobs_s = [int(n_jobs) for n_jobs in args.n_jobs_s.split(',')]
 
-    # Run experiment
-    times = []
+    # Sweep num_rep, at fixed m
+    times_num_rep, peaks_num_rep = [], []
     for num_rep in num_reps:
-        print(f'Running with sample size {num_rep} ... ')
-        params['num_rep'] = num_rep
-        times.append(main_experiment(params=params, printing=False))
-    plt.plot(num_reps, times)
-    plt.xscale('log')
-    plt.yscale('log')
-    plt.xlabel('Sample size (log scale)')
-    plt.ylabel('Runtime (log scale)')
-    plt.title('Runtime as a function of sample size', fontweight='bold')
-    plt.savefig(f'results/{args.outdir}/complexity_plot.png', bbox_inches='tight')
-    plt.close()
+        print(f'Running with sample size {num_rep} (m={args.fixed_m}) ... ')
+        times, peaks = _time_stages(args.fixed_m, num_rep, args)
+        times_num_rep.append(times)
+        peaks_num_rep.append(peaks)
+
+    # Sweep m, at fixed num_rep
+    times_m, peaks_m = [], []
+    for m in m_s:
+        print(f'Running with {m} hypotheses (num_rep={args.fixed_num_rep}) ... ')
+        times, peaks = _time_stages(m, args.fixed_num_rep, args)
+        times_m.append(times)
+        peaks_m.append(peaks)
+
+    # Sweep n_jobs, on the experiment of the input file
+    times_n_jobs = []
+    for n_jobs in n_jobs_s:
+        print(f'Running the simulation on {n_jobs} jobs (num_rep={args.fixed_num_rep}) ... ')
+        times_n_jobs.append(_time_simulation(params, n_jobs, args))
+
+    # Fit exponents: in num_rep, in m, and in m*log(m) (exponent 1 for O(s*m*log(m)) methods)
+    fits = {'num_rep': _fit_sweep(num_reps, times_num_rep),
+            'm': _fit_sweep(m_s, times_m),
+            'm_log_m': _fit_sweep([m*np.log(m) for m in m_s], times_m)}
+    speedup = [times_n_jobs[0]/time_n_jobs for time_n_jobs in times_n_jobs]
+    efficiency = [s/(n_jobs/n_jobs_s[0]) for s, n_jobs in zip(speedup, n_jobs_s)]
+    _print_fits(f'Exponents in num_rep (m={args.fixed_m}), 95% CI', fits['num_rep'])
+    _print_fits(f'Exponents in m (num_rep={args.fixed_num_rep}), 95% CI', fits['m'])
+    _print_fits(f'Exponents in m*log(m) (num_rep={args.fixed_num_rep}), 95% CI', fits['m_log_m'])
+    print(f'Parallel efficiency (relative to {n_jobs_s[0]} job(s)):')
+    for n_jobs, time_n_jobs, s, e in zip(n_jobs_s, times_n_jobs, speedup, efficiency):
+        print(f'   [{n_jobs} jobs]: {np.round(time_n_jobs, 3)}s, speedup {s:.2f}, efficiency {e:.2f}')
+
+    # Plot the sweeps
+    os.makedirs(f'results/{args.outdir}', exist_ok=True)
+    if not args.no_plots:
+        from matplotlib import pyplot as plt
+        fig, axes = plt.subplots(1, 3, figsize=(18, 5))
+        for ax, x, times, xlabel in [(axes[0], num_reps, times_num_rep, 'Sample size'),
+                                     (axes[1], m_s, times_m, 'Number of hypotheses m')]:
+            for key in times[0]:
+                if all(point[key] > 0 for point in times):
+                    ax.plot(x, [point[key] for point in times], marker='o', label=key)
+            ax.set_xscale('log')
+            ax.set_yscale('log')
+            ax.set_xlabel(f'{xlabel} (log scale)')
+            ax.set_ylabel('Runtime (log scale)')
+            ax.legend(fontsize='small')
+        axes[0].set_title(f'Runtime as a function of sample size (m={args.fixed_m})', fontweight='bold')
+        axes[1].set_title(f'Runtime as a function of m (num_rep={args.fixed_num_rep})', fontweight='bold')
+        axes[2].plot(n_jobs_s, speedup, marker='o', label='speedup')
+        axes[2].plot(n_jobs_s, [n_jobs/n_jobs_s[0] for n_jobs in n_jobs_s], linestyle='--', label='ideal')
+        axes[2].set_xlabel('Number of jobs')
+        axes[2].set_ylabel('Speedup')
+        axes[2].set_title('Parallel speedup of the simulation', fontweight='bold')
+        axes[2].legend(fontsize='small')
+        plt.savefig(f'results/{args.outdir}/complexity_plot.png', bbox_inches='tight')
+        plt.close()
+
+    # Save the fits next to the plot
+    output = {'num_rep': {'fixed_m': args.fixed_m, 'values': num_reps, 'times': times_num_rep,
+                          'peak_bytes': peaks_num_rep},
+              'm': {'fixed_num_rep': args.fixed_num_rep, 'values': m_s, 'times': times_m, 'peak_bytes': peaks_m},
+              'n_jobs': {'fixed_num_rep': args.fixed_num_rep, 'values': n_jobs_s, 'times': times_n_jobs,
+                         'speedup': speedup, 'efficiency': efficiency},
+              'fits': fits}
+    with open(f'results/{args.outdir}/complexity_fit.json', 'w') as file:
+        json.dump(output, file, indent=4)
+    print(f"Saved in results/{args.outdir}/{'' if args.no_plots else 'complexity_plot.png and '}complexity_fit.json")
@@ -1,29 +1,84 @@
 import sys
 import json
 import time
+import asyncio
 import argparse
 import numpy as np
-from src.simulation import main_simulation
-from src.analyze import main_analyze
-from src.plotting import main_plotting
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from src.simulation import main_simulation, simulate_L
+from src.analyze import main_analyze, analyze_L, save_analysis_L
+from src.plotting import main_plotting, plot_L, use_agg_backend
+from src.cache import ResultCache
+from src.results import ExperimentResults
+from src.profiling import PROFILER
+from src.constants import PROFILE_REPORT
+from src.seeding import SEEDING_MODES
+from src.shards import parse_shard, run_shard
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('--seed', '-s', help='Experiment randomization seed (default: 17)', 
-                        action='store', default=17)
+                        action='store', type=int, default=17)
     parser.add_argument('--alpha', '-a', help='P value threshold (default: 0.05)', action='store',
-                         default=0.05)
+                         type=float, default=0.05)
     parser.add_argument('--outdir', '-o', help='Output directory in `results/` (default: plots)', 
                         action='store', default='plots')
     parser.add_argument('--num_rep', '-n', help='Experiment sample size (default: 20000)', 
-                        action='store', default=20000)
+                        action='store', type=int, default=20000)
     parser.add_argument('--n_jobs', '-j', help='Number of thres to use (default: 1 - unparallel)', 
-                        action='store', default=1)
+                        action='store', type=int, default=1)
+    parser.add_argument('--schedule', '-g', help='Parallelize over the values of L only (L) or over \
+                        the whole parameter grid, with one independent seed per cell (grid) (default: L)',
+                        action='store', choices=['L', 'grid'], default='L')
     parser.add_argument('--unvectorized', '-u', help='Option to run unvectorized baseline', 
                         action='store_true')
     parser.add_argument('--probabilistic', '-p', help='Run probabilistic alt. hypo. generation \
                         instead of deterministic one', action='store_true')
-    parser.add_argument('--criterion', '-c', help='Performance criterion (default: power)',
+    parser.add_argument('--chunk_size', '-k', help='Run in memory-bounded streaming mode, simulating \
+                        this many replications at a time (default: None - all at once)',
+                        action='store', type=int, default=None)
+    parser.add_argument('--se_tol', '-t', help='Adaptive mode: run each cell in batches of CHUNK_SIZE \
+                        (default: 1000) replications until the se of every criterion is below SE_TOL, \
+                        with at least 2000 and at most NUM_REP replications (default: None - fixed NUM_REP)',
+                        action='store', type=float, default=None)
+    parser.add_argument('--cache', '-C', help='Reuse the raw outputs of unchanged cells from the result \
+                        cache `cache/`, and cache the newly simulated ones', action='store_true')
+    parser.add_argument('--cache_size_mb', help='Size bound of the result cache in MB (default: 1024)',
+                        action='store', type=int, default=1024)
+    parser.add_argument('--pvalue', help='P value layer of the vectorized simulation: 1-2|cdf-0.5| as in the \
+                        original experiment (cdf), 2*sf(|z|) through erfc (erfc), or no p value, comparing |z| \
+                        with transformed critical values (z) (default: cdf)', action='store',
+                        choices=['cdf', 'erfc', 'z'], default='cdf')
+    parser.add_argument('--float32', help='Simulate data and p values in single precision', action='store_true')
+    parser.add_argument('--pipeline', '-P', help='Pipeline the experiment over the values of L: analyze \
+                        and plot each L (in a separate process) while the next ones are simulating',
+                        action='store_true')
+    parser.add_argument('--async_save', help='Write the raw store and processed json files in background \
+                        threads, the stages passing their outputs in memory', action='store_true')
+    parser.add_argument('--no_raw', help='Do not write the raw store (the stages pass their outputs in memory)',
+                        action='store_true')
+    parser.add_argument('--batch', '-b', help='Simulate the cells with the same L and m in batches, \
+                        drawing them from one random generator (vectorized, non-streaming only)', action='store_true')
+    parser.add_argument('--save_decisions', help='Also save the decisions of every replication, bitpacked, \
+                        in the raw store (vectorized simulation only)', action='store_true')
+    parser.add_argument('--no_analytic', help='Simulate every cell, instead of evaluating exactly the cells \
+                        of the deterministic generation where it is cheaper', action='store_true')
+    parser.add_argument('--seeding', help='Seeding of the cells: legacy (every cell seeded with SEED, sharing \
+                        its noise) or stream (each block of replications of each cell drawn from its own \
+                        stream, keyed by SEED and the cell, so outputs do not depend on the schedule, jobs, \
+                        chunks or batches) (default: legacy)', action='store', choices=SEEDING_MODES, default='legacy')
+    parser.add_argument('--shard', help='Only simulate shard I (from 0) out of N of the grid, as I/N, saving its \
+                        sufficient statistics in results/shards, to be merged with `python -m src.shards merge`',
+                        action='store', default=None)
+    parser.add_argument('--no_plots', '--no-plots', help='Do not plot, e.g. to time the computation only',
+                        action='store_true')
+    parser.add_argument('--redraw', help='Redraw every figure, instead of only the figures whose processed \
+                        inputs changed', action='store_true')
+    parser.add_argument('--profile', help='Time each stage of each cell and record its peak memory, \
+                        saving the report in results/profile_report.json and .csv (single job, not with -P)',
+                        action='store_true')
+    parser.add_argument('--criterion', '-c', help='Performance criteria, comma-separated, all computed \
+                        in a single simulation pass: power, type1, type2, fdr, fwer (default: power)',
                         action='store', default='power')
     parser.add_argument('--infile', '-i', help='Input json file for experiment parameters \
                         that will be plotted: L_s, m_s, ratio_s, mode_s, and methods \
@@ -35,14 +90,20 @@ def main_experiment(params, printing=True):
     Main function to run the experiment.
     Will be run by the `if __name__ == '__main__'` of this script.
     Takes in a dictionary of keyword-parameter pairs.
+    The stages hand their outputs to the next ones in memory,
+    the raw store and processed json files being only written for later use.
     Returns the total runtime.
     '''
     # Running 3 steps of the experiment
     timestart = time.perf_counter()
     times = []
-    times.append(['Simulation', main_simulation(params=params, print_params=printing)])
-    times.append(['Process data', main_analyze(params=params, print_params=printing)])
-    times.append(['Plotting', main_plotting(params=params, print_params=printing)])
+    if params.get('profile'): PROFILER.enable()
+    results, processed = ExperimentResults(), dict()
+    times.append(['Simulation', main_simulation(params=params, print_params=printing, results=results)])
+    times.append(['Process data', main_analyze(params=params, print_params=printing, results=results,
+                                               processed=processed)])
+    if params.get('plots', True):
+        times.append(['Plotting', main_plotting(params=params, print_params=printing, processed=processed)])
 
     # Print out the time records
     if printing:
@@ -52,6 +113,73 @@ def main_experiment(params, printing=True):
             for sub_step, step_time in step_times:
                 print(f'      [{sub_step}]: {np.round(step_time, 3)}s')
 
+    # Save and print out the stage profile
+    if params.get('profile'):
+        PROFILER.disable()
+        PROFILER.save(PROFILE_REPORT)
+        if printing:
+            print('Stage profile (total time, largest peak memory):')
+            for (m, num_rep, stage), (seconds, peak) in sorted(PROFILER.summary().items()):
+                print(f'   [m={m}, num_rep={num_rep}] [{stage}]: {np.round(seconds, 3)}s, {peak/2**20:.2f}MB')
+
+    # Returns runtime
+    return time.perf_counter()-timestart
+
+def _timed(function, *args):
+    time1 = time.perf_counter()
+    output = function(*args)
+    return output, time.perf_counter()-time1
+
+async def _pipeline(params):
+    '''
+    Runs the stages of each value of L as soon as the previous stage of that L is done:
+    simulation in a pool of `params['n_jobs']` threads, analysis in the event loop's default executor,
+    and plotting (unless `params['plots']` is False) in a separate process with matplotlib's Agg backend.
+    The outputs of each stage are handed to the next one in memory, and the processed json files
+    are written in the background unless `params['save_processed']` is False.
+    Returns the total busy time of each stage.
+    '''
+    loop = asyncio.get_running_loop()
+    n_jobs = params['n_jobs'] if params['n_jobs'] not in [0, None] else 1
+    times = {'Simulation': 0., 'Process data': 0., 'Plotting': 0.}
+    saves = []
+    with ThreadPoolExecutor(max_workers=n_jobs) as simulation_pool, \
+         ProcessPoolExecutor(max_workers=1, initializer=use_agg_backend) as plotting_pool:
+        if params.get('plots', True): # Starts the plotting process before any simulation thread
+            plotting_pool.submit(int)
+        async def run_L(L):
+            results, step_time = await loop.run_in_executor(simulation_pool, _timed, simulate_L, params, L,
+                                                            ExperimentResults())
+            times['Simulation'] += step_time
+            processed_L, step_time = await loop.run_in_executor(None, _timed, analyze_L, params, L, None, results)
+            times['Process data'] += step_time
+            if params.get('save_processed', True):
+                saves.append(loop.run_in_executor(None, save_analysis_L, params, L, processed_L))
+            if params.get('plots', True):
+                times['Plotting'] += (await loop.run_in_executor(plotting_pool, _timed, plot_L, params, L,
+                                                                 processed_L))[1]
+        await asyncio.gather(*(run_L(L) for L in params['L_s']))
+        await asyncio.gather(*saves)
+    return times
+
+def main_experiment_pipelined(params, printing=True):
+    '''
+    Pipelined version of `main_experiment`: the simulation of later values of L overlaps with the analysis
+    and plotting of earlier ones, so that the runtime gets close to the largest stage time instead of their sum.
+    The values of L are simulated with the 'L' schedule (see `main_simulation`).
+    Returns the total runtime.
+    '''
+    timestart = time.perf_counter()
+    times = asyncio.run(_pipeline(params))
+    if params.get('cache'): ResultCache(max_bytes=params.get('cache_size_mb', 1024)*2**20).evict()
+
+    # Print out the time records
+    if printing:
+        print('Runtime decomposition (busy time of each stage, overlapping):')
+        for step, step_time in times.items():
+            print(f'   Step [{step}]: {np.round(step_time, 3)}s')
+        print(f'   Total: {np.round(time.perf_counter()-timestart, 3)}s')
+
     # Returns runtime
     return time.perf_counter()-timestart
 
@@ -68,7 +196,26 @@ if __name__ == '__main__':
     params['outdir'] = args.outdir
     params['vectorize'] = not args.unvectorized
     params['n_jobs'] = args.n_jobs
+    params['schedule'] = args.schedule
     params['prob_alt_hypo'] = args.probabilistic
+    params['chunk_size'] = args.chunk_size
+    params['se_tol'] = args.se_tol
+    params['cache'] = args.cache
+    params['cache_size_mb'] = args.cache_size_mb
+    params['analytic'] = not args.no_analytic
+    params['pvalue'] = args.pvalue
+    params['dtype'] = 'float32' if args.float32 else 'float64'
+    params['save_decisions'] = args.save_decisions
+    params['batch'] = args.batch
+    params['async_save'] = args.async_save
+    params['saving'] = not args.no_raw
+    params['profile'] = args.profile
+    params['seeding'] = args.seeding
+    params['plots'] = not args.no_plots
+    params['lazy_plots'] = not args.redraw
+    if args.profile: params['n_jobs'] = 1 # Only the current process is profiled
 
     # Run experiment
-    main_experiment(params=params)
+    if args.shard is not None: print(f'Saved shard {args.shard} in {run_shard(params, *parse_shard(args.shard))}')
+    elif args.pipeline: main_experiment_pipelined(params=params)
+    else: main_experiment(params=params)
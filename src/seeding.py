@@ -0,0 +1,71 @@
+import json
+import hashlib
+import numpy as np
+
+# Seeding schemes of the simulation: 'legacy' seeds the generator of every cell with the experiment seed
+# (the cells share their noise), 'stream' draws each block of replications of each cell from its own stream
+SEEDING_MODES = ('legacy', 'stream')
+
+# Number of replications drawn from each stream of a cell
+BLOCK_SIZE = 1000
+
+def cell_key(L, m_0, m, mode, prob_alt_hypo):
+    '''
+    Words identifying a cell of the BH experiment, stable across grids, processes and machines
+    '''
+    fields = [float(np.round(float(L), 1)), int(m_0), int(m), mode, bool(prob_alt_hypo)]
+    digest = hashlib.sha256(json.dumps(fields).encode()).digest()
+    return tuple(int.from_bytes(digest[i:i+4], 'little') for i in range(0, 16, 4))
+
+class StreamSeed:
+    '''
+    Seed of the random streams of one cell.
+    Block b, made of the replications b*block_size to (b+1)*block_size-1, is drawn from its own streams,
+    seeded by `np.random.SeedSequence(seed, spawn_key=key+(b, ))`, so that any block of any cell
+    can be regenerated on its own, in any order, on any process or machine.
+    '''
+    def __init__(self, seed, key, block_size=BLOCK_SIZE):
+        self.seed = int(seed)
+        self.key = tuple(key)
+        self.block_size = block_size
+
+    def sequence(self, block):
+        return np.random.SeedSequence(self.seed, spawn_key=self.key+(int(block), ))
+
+    def rngs(self, block):
+        '''
+        Generators of the noise and of the random means of `block`
+        '''
+        return tuple(np.random.default_rng(child) for child in self.sequence(block).spawn(2))
+
+    def fields(self):
+        '''
+        Json-serializable description, e.g. for cache keys
+        '''
+        return ['stream', self.seed, list(self.key), self.block_size]
+
+def cell_stream_seed(seed, L, m_0, m, mode, prob_alt_hypo, block_size=BLOCK_SIZE):
+    return StreamSeed(seed, cell_key(L, m_0, m, mode, prob_alt_hypo), block_size=block_size)
+
+def generate_rows(stream_seed, make_generator, start, out):
+    '''
+    Writes the rows start to start+len(out)-1 of the data of a cell into `out`, block by block,
+    `make_generator(rng)` building the hypotheses generator of the cell (whose random means use `rng`).
+    In each block, the noise and the random means are drawn from two streams, each in row order,
+    so a row only depends on the rows before it in its block: a block overlapping `out` partly is drawn
+    up to its last row in `out`, and its first rows are dropped if they are before `start`.
+    Chunks aligned on the blocks are thus generated without any extra draw.
+    '''
+    stop, size = start+out.shape[0], stream_seed.block_size
+    for block in range(start // size, (stop-1) // size + 1):
+        block_start = block*size
+        low, high = max(start, block_start), min(stop, block_start+size)
+        if low == block_start: rows = out[low-start:high-start]
+        else: rows = np.empty((high-block_start, out.shape[1]), dtype=out.dtype)
+        noise_rng, means_rng = stream_seed.rngs(block)
+        generator = make_generator(means_rng)
+        noise_rng.standard_normal(out=rows, dtype=rows.dtype)
+        if generator.sigma != 1.: rows *= generator.sigma
+        generator.shift_means(rows)
+        if low != block_start: out[low-start:high-start] = rows[low-block_start:]
+    return out
@@ -0,0 +1,142 @@
+import os
+import glob
+import json
+import time
+import platform
+import argparse
+import numpy as np
+from joblib import Parallel, delayed
+from src.simulation import _simulate_task_BH_exp, _cell_cost_BH_exp
+from src.utils import generate_cells_BH_exp, sufficient_stats
+from src.store import RawStore
+from src.analyze import main_analyze
+from src.constants import RAW_OUTPUT_DIR, SHARD_DIR
+
+# Version of the format of the partial results files
+SHARD_FORMAT = 1
+
+# Parameters determining the outputs, which must agree between the shards of a sweep
+SHARD_PARAMS = ('L_s', 'm_s', 'ratio_s', 'mode_s', 'methods', 'num_rep', 'criterion', 'alpha', 'seed', 'seeding',
+                'prob_alt_hypo', 'vectorize', 'chunk_size', 'se_tol', 'analytic', 'pvalue', 'dtype')
+
+def parse_shard(text):
+    '''
+    Parses a shard 'i/N' into (i, N), with shards numbered from 0 to N-1
+    '''
+    shard, num_shards = (int(x) for x in text.split('/'))
+    if not 0 <= shard < num_shards: raise ValueError(f'Invalid shard: {text}')
+    return shard, num_shards
+
+def shard_filename(shard, num_shards):
+    return f'{SHARD_DIR}/shard_{shard}_of_{num_shards}.json'
+
+def shard_cells(params, shard, num_shards):
+    '''
+    Cells (L, m, ratio, mode) of the grid of `params` in shard `shard` out of `num_shards`.
+    The split only depends on the grid and `params['num_rep']`: the cells are dealt from the most to the least
+    expensive (estimated by `_cell_cost_BH_exp`, ties in grid order) to the least loaded shard,
+    all methods of a cell staying in the same shard to share its generated data.
+    '''
+    cells = list(generate_cells_BH_exp(params['L_s'], params['m_s'], params['ratio_s'], params['mode_s']))
+    costs = [_cell_cost_BH_exp(params['num_rep'], cell[1], len(params['methods'])) for cell in cells]
+    loads, assignment = np.zeros(num_shards), dict()
+    for index in sorted(range(len(cells)), key=lambda index: (-costs[index], index)):
+        assignment[index] = int(np.argmin(loads))
+        loads[assignment[index]] += costs[index]
+    return [cell for index, cell in enumerate(cells) if assignment[index] == shard]
+
+def _cell_stats_BH_exp(output, kind):
+    '''
+    Sufficient statistics of the outputs {method: {criterion: values}} of one cell,
+    given as per-replication values (`kind` 'reps') or already as sufficient statistics ('stats')
+    '''
+    return {method: {crit: np.asarray(values, dtype=float) if kind == 'stats' else sufficient_stats(values)
+                     for crit, values in method_output.items()}
+            for method, method_output in output.items()}
+
+def run_shard(params, shard, num_shards, filename=None):
+    '''
+    Simulates the cells of one shard of the grid (see `shard_cells`), on `params['n_jobs']` processes,
+    and saves their sufficient statistics in a self-describing partial results file
+    (by default `results/shards/shard_<i>_of_<N>.json`), to be combined with `merge_shards`.
+    Every cell is seeded as in `main_simulation` (with `params['seed']`, or its own streams
+    if `params['seeding']` is 'stream'), so the merged shards give the same outputs as a single run.
+    Returns the name of the file.
+    '''
+    start = time.perf_counter()
+    cells = shard_cells(params, shard, num_shards)
+    task_params = dict(params, saving=False, cache=False, save_decisions=False)
+    n_jobs = params.get('n_jobs') if params.get('n_jobs') not in [0, None] else 1
+    outputs = Parallel(n_jobs=n_jobs, batch_size=1)(delayed(_simulate_task_BH_exp)(task_params, cell, params['seed'],
+                                                                                   params['methods'])
+                                                    for cell in cells)
+    records = []
+    for cell, (output, kind) in zip(cells, outputs):
+        l, m, r, mode = cell
+        m_0 = int(np.rint(m*float(r)).astype('int'))
+        for method, method_stats in _cell_stats_BH_exp(output, kind).items():
+            for crit, stats in method_stats.items():
+                records.append({'L': l, 'm_0': m_0, 'm': m, 'ratio': r, 'mode': mode, 'method': method,
+                                'criterion': crit, 'stats': stats.tolist()})
+    description = {'format': SHARD_FORMAT, 'shard': shard, 'num_shards': num_shards,
+                   'params': {key: params.get(key) for key in SHARD_PARAMS}, 'cells': cells, 'records': records,
+                   'host': platform.node(), 'runtime': time.perf_counter()-start}
+    filename = filename or shard_filename(shard, num_shards)
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename, 'w') as file:
+        json.dump(description, file)
+    return filename
+
+def merge_shards(filenames):
+    '''
+    Combines the partial results files of the shards of one sweep.
+    Checks that they come from the same parameters and cover every cell of the grid exactly once,
+    and adds up the sufficient statistics of the records with the same key.
+    Returns the parameters of the sweep and a dictionary mapping each `RawStore.key` to its statistics.
+    '''
+    params, num_shards, shards, cells, stats = None, None, set(), set(), dict()
+    for filename in filenames:
+        with open(filename, 'r') as file: description = json.load(file)
+        if description['format'] != SHARD_FORMAT: raise ValueError(f'Unsupported shard format in {filename}')
+        if params is None: params, num_shards = description['params'], description['num_shards']
+        elif description['params'] != params or description['num_shards'] != num_shards:
+            raise ValueError(f'{filename} does not belong to the same sweep as {filenames[0]}')
+        if description['shard'] in shards: raise ValueError(f"Shard {description['shard']} given twice")
+        shards.add(description['shard'])
+        cells.update(tuple(cell) for cell in description['cells'])
+        for record in description['records']:
+            key = RawStore.key(record['L'], record['m_0'], record['m'], record['mode'], params['num_rep'],
+                               record['method'], record['criterion'])
+            stats[key] = stats.get(key, 0.)+np.array(record['stats'], dtype=float)
+    if params is None: raise ValueError('No shard to merge')
+    grid = list(generate_cells_BH_exp(params['L_s'], params['m_s'], params['ratio_s'], params['mode_s']))
+    missing = [cell for cell in grid if tuple(cell) not in cells]
+    if missing: raise ValueError(f'Missing shards {sorted(set(range(num_shards))-shards)}: {len(missing)} cells')
+    return params, stats
+
+def save_merged(stats):
+    '''
+    Writes the merged statistics in the raw store, as read by `main_analyze`
+    '''
+    RawStore(RAW_OUTPUT_DIR).append_many([(*key, values, 'stats') for key, values in stats.items()])
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', help='merge: combine the partial results files of the shards of a sweep \
+                        (run with `python -m src.run_experiment --shard i/N`) into the raw store',
+                        choices=['merge'])
+    parser.add_argument('files', help=f'Partial results files (default: {SHARD_DIR}/shard_*_of_*.json)', nargs='*')
+    parser.add_argument('--analyze', help='Also run the analysis of the merged sweep', action='store_true')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+
+    # Parsing input arguments
+    args = parse_arguments()
+    filenames = args.files or sorted(glob.glob(f'{SHARD_DIR}/shard_*_of_*.json'))
+
+    # Merge the shards
+    params, stats = merge_shards(filenames)
+    save_merged(stats)
+    print(f'Merged {len(filenames)} shards ({len(stats)} outputs) into {RAW_OUTPUT_DIR}')
+    if args.analyze: main_analyze(params=params, print_params=False)
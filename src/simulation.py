@@ -1,26 +1,51 @@
 import os
 import time
 import json
+import functools
 import numpy as np
 from scipy.stats import norm
+from scipy.special import ndtr, erfc
 from joblib import Parallel, delayed
-from src.methods import NormalMeanHypotheses, NormalMeanHypothesesProbabilistic, MultiTest
-from src.utils import compare_reject_result, distribute_means_BH_exp, \
-                      generate_filename_BH_exp, generate_params_BH_exp
-from src.constants import RAW_OUTPUT_DIR
+from concurrent.futures import ThreadPoolExecutor
+from src.methods import NormalMeanHypotheses, NormalMeanHypothesesProbabilistic, MultiTest, MultiTestWorkspace, \
+                        PackedDecisions, PROCEDURES
+from src.utils import compare_reject_result, distribute_means_BH_exp, merge_stats, reject_stats, \
+                      stats_converged, generate_cells_BH_exp, parse_criteria
+from src.store import RawStore
+from src.results import ExperimentResults
+from src.profiling import PROFILER, stage
+from src.seeding import StreamSeed, cell_stream_seed, generate_rows
+from src.cache import ResultCache, cache_key_BH_exp
+from src.analytic import analytic_applies, analytic_cost, simulation_cost, simulate_cell_analytic
+from src.constants import RAW_OUTPUT_DIR, CACHE_DIR
 from tqdm import tqdm
 
+# Default number of replications per batch in adaptive mode
+ADAPTIVE_BATCH_SIZE = 1000
+
+# Minimum number of replications before adaptive mode may stop
+MIN_ADAPTIVE_REPLICATIONS = 2000
+
+# Maximum number of simulated statistics (rows times m) of a batch of cells in batched mode
+BATCH_ELEMENTS = 2**22
+
+# Transforms of the z statistics by the in-place p value layer (see `_p_values_in_place`)
+PVALUE_MODES = ('cdf', 'erfc', 'z')
+
 dict_methods = {
     'Bonferroni': MultiTest.BonferroniMethod,
     'Hochberg': MultiTest.HochbergMethod,
     'BH':MultiTest.BHMethod
 }
 
-dict_methods_fast = {
-    'Bonferroni': MultiTest.BonferroniMethod,
-    'Hochberg': MultiTest.HochbergMethodFast,
-    'BH':MultiTest.BHMethodFast
-}
+def control_method_BH_exp(method, vectorize):
+    '''
+    Method of the simulation: the unvectorized baseline of `dict_methods`, or any procedure registered in
+    `src.methods.PROCEDURES` at vectorized speed (also for procedures without unvectorized version)
+    '''
+    if not vectorize and method in dict_methods: return dict_methods[method]
+    if method not in PROCEDURES: raise ValueError(f'Unknown method: {method}')
+    return functools.partial(MultiTest.ProcedureMethod, procedure=method)
 
 def probabilistic_alt_distribution(L, mode):
     a = np.array([L/4., L/2., 3*L/4., L])
@@ -30,33 +55,256 @@ def probabilistic_alt_distribution(L, mode):
     else: raise ValueError(f"Invalid mode in put: {mode}")
     return a, p
 
+def _generator_BH_exp(L, m_0, m, mode, prob_alt_hypo, rng):
+    '''
+    Builds the hypotheses generator of the BH experiment for one cell
+    '''
+    if not prob_alt_hypo:
+        alt_means = distribute_means_BH_exp(m-m_0, L, mode)
+        return NormalMeanHypotheses(m_0, alt_means, sigma=1., rng=rng)
+    a, p = probabilistic_alt_distribution(L, mode)
+    return NormalMeanHypothesesProbabilistic(m_0, num_alt=m-m_0, alt_means=a, alt_probs=p, rng=rng)
+
+def _rng_generator_BH_exp(L, m_0, m, mode, prob_alt_hypo, seed):
+    '''
+    Hypotheses generator of a cell drawing all its replications sequentially from `np.random.default_rng(seed)`,
+    or None if `seed` is a `StreamSeed` (see `_generate_rows_BH_exp`)
+    '''
+    if isinstance(seed, StreamSeed): return None
+    return _generator_BH_exp(L, m_0, m, mode, prob_alt_hypo, np.random.default_rng(seed=seed))
+
+def _generate_rows_BH_exp(L, m_0, m, mode, prob_alt_hypo, seed, generator, start, out):
+    '''
+    Generates the replications start to start+len(out)-1 of a cell into `out`:
+    from the streams of each block if `seed` is a `StreamSeed` (see `src/seeding.py`),
+    and otherwise as the next draws of `generator`
+    '''
+    if isinstance(seed, StreamSeed):
+        return generate_rows(seed, lambda rng: _generator_BH_exp(L, m_0, m, mode, prob_alt_hypo, rng), start, out)
+    return generator.generate_data(size=out.shape[0], out=out)
+
 def simulate_BH_exp(L, m_0, m, mode, num_rep, method, criterion, alpha=0.05, saving=True, \
-                    vectorize=False, prob_alt_hypo=True, seed=17):
+                    vectorize=False, prob_alt_hypo=True, seed=17, chunk_size=None, se_tol=None):
     
+    # Streaming (and adaptive) mode only keeps sufficient statistics
+    if chunk_size is not None or se_tol is not None:
+        return simulate_BH_exp_streaming(L, m_0, m, mode, num_rep, method, criterion, alpha=alpha,
+                                         saving=saving, vectorize=vectorize, prob_alt_hypo=prob_alt_hypo,
+                                         seed=seed, chunk_size=chunk_size or ADAPTIVE_BATCH_SIZE,
+                                         se_tol=se_tol)
+
     # Generate data
-    rng = np.random.default_rng(seed=seed)
-    if not prob_alt_hypo:
-        alt_means = distribute_means_BH_exp(m-m_0, L, mode)
-        generator = NormalMeanHypotheses(m_0, alt_means, sigma=1., rng=rng)
-    else:
-        a, p = probabilistic_alt_distribution(L, mode)
-        generator = NormalMeanHypothesesProbabilistic(m_0, num_alt=m-m_0, alt_means=a, alt_probs=p, rng=rng)
+    generator = _rng_generator_BH_exp(L, m_0, m, mode, prob_alt_hypo, seed)
     test = lambda data: 1-2*np.abs(norm.cdf(data)-0.5)
-    p_values = generator.generate_p_values(test, size=num_rep)
+    with stage('generate'):
+        if generator is not None: p_values = generator.generate_p_values(test, size=num_rep)
+        else: p_values = test(_generate_rows_BH_exp(L, m_0, m, mode, prob_alt_hypo, seed, None, 0,
+                                                    np.empty((num_rep, m))))
 
     # Run hypothesis test
-    control_method = dict_methods_fast[method] if vectorize else dict_methods[method]
-    decision = control_method(p_values, alpha)
+    criteria = parse_criteria(criterion)
+    control_method = control_method_BH_exp(method, vectorize)
+    with stage('step-up'): decision = control_method(p_values, alpha)
     ground_truth = np.array([0]*m_0+[1]*(m-m_0))
-    result = compare_reject_result(ground_truth, decision)
+    with stage('reduce'): result = compare_reject_result(ground_truth, decision, criteria=criteria)
     
     # Save in csv
     if saving:
-        filename = generate_filename_BH_exp(L, m_0, m, mode, num_rep, method, criterion)
-        np.save(f'{RAW_OUTPUT_DIR}/{filename}', result[criterion])
+        with stage('save'):
+            for crit in criteria:
+                RawStore(RAW_OUTPUT_DIR).append(L, m_0, m, mode, num_rep, method, crit, result[crit])
     return result
 
-def _main_simulation_L(params, L=None):
+def simulate_BH_exp_streaming(L, m_0, m, mode, num_rep, method, criterion, alpha=0.05, saving=True, \
+                              vectorize=False, prob_alt_hypo=True, seed=17, chunk_size=10000, se_tol=None):
+    '''
+    Memory-bounded version of `simulate_BH_exp`.
+    Draws, tests and scores the replications in chunks of at most `chunk_size` rows,
+    and only keeps the running sufficient statistics [count, sum, sum of squares]
+    of each criterion (see `reject_stats`), so that at most one chunk is held in memory at a time.
+    If `seed` is a `StreamSeed`, the chunks are drawn from the streams of its blocks, and the result agrees
+    with `mean_and_se` on the full output of `simulate_BH_exp` for the same seed.
+    Otherwise they are drawn sequentially from the same generator, which only gives the same draws as a single
+    full draw with the deterministic generator: the probabilistic one interleaves the noise and the random means
+    of each chunk, so its result is then a different (equally valid) sample.
+    If `se_tol` is not None, stops early (adaptive mode) as soon as the se of every criterion
+    is below `se_tol` after at least `MIN_ADAPTIVE_REPLICATIONS` replications,
+    `num_rep` being then the maximum number of replications.
+
+    RETURNS
+    -------
+    Dictionary mapping each criterion to its sufficient statistics,
+    whose counts are the numbers of replications actually used
+    '''
+    assert chunk_size > 0, 'Chunk size must be positive'
+    criteria = parse_criteria(criterion)
+    generator = _rng_generator_BH_exp(L, m_0, m, mode, prob_alt_hypo, seed)
+    test = lambda data: 1-2*np.abs(norm.cdf(data)-0.5)
+    control_method = control_method_BH_exp(method, vectorize)
+
+    # Main loop over chunks
+    stats = dict()
+    for start in range(0, num_rep, chunk_size):
+        with stage('generate'):
+            rows = min(chunk_size, num_rep-start)
+            if generator is not None: p_values = generator.generate_p_values(test, size=rows)
+            else: p_values = test(_generate_rows_BH_exp(L, m_0, m, mode, prob_alt_hypo, seed, None, start,
+                                                        np.empty((rows, m))))
+        with stage('step-up'): decision = control_method(p_values, alpha)
+        with stage('reduce'): stats = merge_stats(stats, reject_stats(decision, m_0, criteria=criteria))
+        if se_tol is not None and stats_converged(stats, se_tol, MIN_ADAPTIVE_REPLICATIONS): break
+
+    # Save the statistics
+    if saving:
+        with stage('save'):
+            for crit in criteria:
+                RawStore(RAW_OUTPUT_DIR).append(L, m_0, m, mode, num_rep, method, crit, stats[crit], kind='stats')
+    return stats
+
+def _p_values_in_place(data, pvalue='cdf'):
+    '''
+    Two-sided z-test statistics of `data`, overwriting it, according to `pvalue`:
+    'cdf' for the p values 1-2|Phi(data)-0.5| (bit-identical to the original experiment),
+    'erfc' for the p values 2*sf(|data|) = erfc(|data|/sqrt(2)), cheaper and accurate in the tails,
+    'z' for the statistics -|data|, to be compared with critical values on the z scale
+    (see `MultiTestWorkspace.thresholds`) without computing any p value.
+    '''
+    if pvalue == 'cdf':
+        ndtr(data, out=data)
+        data -= 0.5
+        np.abs(data, out=data)
+        data *= -2.
+        data += 1.
+    elif pvalue == 'erfc':
+        np.abs(data, out=data)
+        data *= 1/np.sqrt(2.)
+        erfc(data, out=data)
+    elif pvalue == 'z':
+        np.abs(data, out=data)
+        np.negative(data, out=data)
+    else: raise ValueError(f'Unsupported p value mode: {pvalue}')
+    return data
+
+def simulate_cell_BH_exp(L, m_0, m, mode, num_rep, methods, criterion, alpha=0.05, saving=True, \
+                         prob_alt_hypo=True, seed=17, chunk_size=None, workspace=None, se_tol=None, \
+                         pvalue='cdf', dtype='float64', save_decisions=False):
+    '''
+    Shared-draw version of `simulate_BH_exp` for all `methods` of one cell (L, m_0, m, mode).
+    The p values are generated once and each row is sorted once for all step-up methods.
+    Since `simulate_BH_exp` uses the same seed for every method, the per-method outputs
+    (and saved files) are the same as calling the vectorized `simulate_BH_exp` for each method.
+    Data, p values and decisions are computed in place in the buffers of `workspace`
+    (a `MultiTestWorkspace`), which can be passed to be reused across cells with the same m.
+    If `se_tol` is not None, replications are run in batches of `chunk_size` (adaptive mode)
+    until the se of every criterion of every method is below `se_tol` after at least
+    `MIN_ADAPTIVE_REPLICATIONS` replications, or `num_rep` is reached.
+    `pvalue` selects the p value layer (see `_p_values_in_place`), and `dtype` ('float64' or 'float32')
+    the precision of the data and p values; the defaults reproduce `simulate_BH_exp`.
+    If `save_decisions`, the decisions of every replication are also saved, as `PackedDecisions`
+    from which the criteria are computed.
+    If `seed` is a `StreamSeed` (see `src/seeding.py`), the outputs do not depend on `chunk_size`.
+
+    RETURNS
+    -------
+    Dictionary mapping each method to its result, a dictionary keyed by criterion
+    whose values are sufficient statistics in streaming or adaptive mode
+    '''
+    streaming = chunk_size is not None or se_tol is not None
+    criteria = parse_criteria(criterion)
+    generator = _rng_generator_BH_exp(L, m_0, m, mode, prob_alt_hypo, seed)
+    ground_truth = np.array([0]*m_0+[1]*(m-m_0))
+
+    # Main loop, with a single chunk unless streaming
+    size = min(chunk_size or ADAPTIVE_BATCH_SIZE, num_rep) if streaming else num_rep
+    if workspace is None or workspace.m != m or workspace.s < size or workspace.dtype != np.dtype(dtype):
+        workspace = MultiTestWorkspace(size, m, dtype=dtype)
+    scale = 'z' if pvalue == 'z' else 'p'
+    output = {method: dict() for method in methods}
+    packed = {method: [] for method in methods}
+    for start in range(0, num_rep, size):
+        rows = min(size, num_rep-start)
+        with stage('generate'):
+            data = _generate_rows_BH_exp(L, m_0, m, mode, prob_alt_hypo, seed, generator, start,
+                                         workspace.p_values[:rows])
+        with stage('pvalue'): p_values = _p_values_in_place(data, pvalue=pvalue)
+        for method, decision in MultiTest.SharedMethodsInPlace(p_values, alpha, methods, workspace, scale=scale):
+            with stage('reduce'):
+                if save_decisions:
+                    decision = PackedDecisions.pack(decision)
+                    packed[method].append(decision.bits)
+                if not streaming: output[method] = compare_reject_result(ground_truth, decision, criteria=criteria)
+                else: output[method] = merge_stats(output[method], reject_stats(decision, m_0, criteria=criteria))
+        if se_tol is not None and all(stats_converged(output[method], se_tol, MIN_ADAPTIVE_REPLICATIONS)
+                                       for method in methods): break
+
+    # Save the per-method outputs
+    if saving:
+        with stage('save'):
+            for method in methods:
+                for crit in criteria:
+                    RawStore(RAW_OUTPUT_DIR).append(L, m_0, m, mode, num_rep, method, crit, output[method][crit],
+                                                    kind='stats' if streaming else 'reps')
+                if save_decisions:
+                    RawStore(RAW_OUTPUT_DIR).append(L, m_0, m, mode, num_rep, method, 'decisions',
+                                                    PackedDecisions(np.concatenate(packed[method]), m), kind='packed')
+    return output
+
+def simulate_batch_BH_exp(L, m, cells, num_rep, methods, criterion, alpha=0.05, saving=True, \
+                          prob_alt_hypo=True, seed=17, workspace=None, pvalue='cdf', dtype='float64', \
+                          seeding='legacy'):
+    '''
+    Batched version of `simulate_cell_BH_exp` for several cells with the same L and m,
+    given as a list `cells` of (ratio, mode). The cells have the same number of hypotheses and critical values,
+    so their data are generated as one batch of num_rep rows per cell, into the buffers of `workspace`,
+    and each method is applied once to the whole batch.
+    With `seeding` 'legacy', the cells are drawn from one random generator, so their outputs are distributed as,
+    but not equal to, those of `simulate_cell_BH_exp` with the same seed (which draws the same noise for every cell).
+    With `seeding` 'stream', each cell is drawn from its own streams (see `src/seeding.py`),
+    so its outputs are equal to those of `simulate_cell_BH_exp` with its `StreamSeed`.
+
+    RETURNS
+    -------
+    Dictionary mapping each (ratio, mode) to the outputs of its methods, a dictionary keyed by criterion
+    '''
+    criteria = parse_criteria(criterion)
+    rng = np.random.default_rng(seed=seed)
+    m_0s = [int(np.rint(m*float(r)).astype('int')) for r, _ in cells]
+    blocks = [slice(b*num_rep, (b+1)*num_rep) for b in range(len(cells))]
+    size = len(cells)*num_rep
+    if workspace is None or workspace.m != m or workspace.s < size or workspace.dtype != np.dtype(dtype):
+        workspace = MultiTestWorkspace(size, m, dtype=dtype)
+
+    # Generate the data of all cells at once, then add the means of each cell
+    PROFILER.set_cell(L, -1, m, 'batch', num_rep) # Stages of the whole batch
+    with stage('generate'):
+        data = workspace.p_values[:size]
+        if seeding == 'stream':
+            for block, m_0, (_, mode) in zip(blocks, m_0s, cells):
+                cell_seed = cell_stream_seed(seed, L, m_0, m, mode, prob_alt_hypo)
+                _generate_rows_BH_exp(L, m_0, m, mode, prob_alt_hypo, cell_seed, None, 0, data[block])
+        else:
+            rng.standard_normal(out=data, dtype=data.dtype)
+            for block, m_0, (_, mode) in zip(blocks, m_0s, cells):
+                _generator_BH_exp(L, m_0, m, mode, prob_alt_hypo, rng).shift_means(data[block])
+    with stage('pvalue'): p_values = _p_values_in_place(data, pvalue=pvalue)
+
+    # Run each method once on the whole batch
+    output = {cell: {method: dict() for method in methods} for cell in cells}
+    scale = 'z' if pvalue == 'z' else 'p'
+    for method, decision in MultiTest.SharedMethodsInPlace(p_values, alpha, methods, workspace, scale=scale):
+        with stage('reduce'):
+            for block, m_0, cell in zip(blocks, m_0s, cells):
+                ground_truth = np.array([0]*m_0+[1]*(m-m_0))
+                output[cell][method] = compare_reject_result(ground_truth, decision[block], criteria=criteria)
+
+    # Save the per-cell outputs
+    if saving:
+        RawStore(RAW_OUTPUT_DIR).append_many([(L, m_0, m, mode, num_rep, method, crit, output[r, mode][method][crit])
+                                              for m_0, (r, mode) in zip(m_0s, cells)
+                                              for method in methods for crit in criteria])
+    return output
+
+def _main_simulation_L(params, L=None, results=None):
     '''
     Inner function to be called by the main function `main_simulation`.
     Generates all parameterset from `params` dictionary and runs all of them.
@@ -68,23 +316,258 @@ def _main_simulation_L(params, L=None):
     L : Optional (list or float)
         Input parameter L.
         If not None, use this argument instead of `params['L']`
+    results : Optional (ExperimentResults)
+        If not None, records the outputs of all cells in it.
+        If `params['async_save']`, the raw store is then written in a background thread.
+
+    RETURNS
+    -------
+    `results`
     '''
     # Handling input parameter L
     if L is None: Ls = params['L_s']
     elif not isinstance(L, list): Ls = [L]
     else: Ls = L
 
-    # Main loop
-    generator = generate_params_BH_exp(Ls, params['m_s'], params['ratio_s'], 
-                                       params['mode_s'], params['methods'])
-    for (l, m, r, mode, method) in tqdm(list(generator)):
-        m_0 = int(np.rint(m*float(r)).astype('int'))
-        simulate_BH_exp(l, m_0, m, mode, params['num_rep'], method, params['criterion'], 
-                        alpha=params['alpha'], saving=True, seed=params['seed'],
-                        vectorize=params['vectorize'], prob_alt_hypo=params['prob_alt_hypo'])
+    # Main loop, sharing generated data and buffers across methods when vectorized
+    writer = ThreadPoolExecutor(max_workers=1) if results is not None and params.get('async_save') else None
+    try:
+        streaming = params.get('chunk_size') is not None or params.get('se_tol') is not None
+        if params.get('batch') and params['vectorize'] and not streaming and not params.get('save_decisions'):
+            _main_simulation_L_batched(params, Ls, results=results, writer=writer)
+            return results
+        workspaces = dict() # Buffers reused across cells with the same m
+        size = min(params.get('chunk_size') or ADAPTIVE_BATCH_SIZE, params['num_rep']) if streaming else params['num_rep']
+        generator = generate_cells_BH_exp(Ls, params['m_s'], params['ratio_s'], params['mode_s'])
+        for cell in tqdm(list(generator)):
+            m = cell[1]
+            if params['vectorize'] and m not in workspaces:
+                workspaces[m] = MultiTestWorkspace(size, m, dtype=params.get('dtype', 'float64'))
+            _simulate_task_BH_exp(params, cell, params['seed'], params['methods'], workspace=workspaces.get(m),
+                                  results=results, writer=writer)
+    finally:
+        if writer is not None: writer.shutdown(wait=True)
+    return results
+
+def _main_simulation_L_batched(params, Ls, results=None, writer=None):
+    '''
+    Batched version of the main loop of `_main_simulation_L`, when `params['batch']`:
+    simulates the cells of each (L, m) with `simulate_batch_BH_exp`, in batches of at most
+    `BATCH_ELEMENTS` simulated statistics (and at least one cell).
+    Cells evaluated exactly (see `_use_analytic_BH_exp`) are left out of the batches.
+    If `params['cache']`, the cells drawn from their own streams (`params['seeding']` 'stream') are looked up
+    in the result cache one by one, with the keys of `_simulate_task_BH_exp`, and only the missing ones are batched.
+    Otherwise, the draws of a cell depend on its batch, so a batch is reused only if all its cells
+    are cached with the same batch.
+    '''
+    workspaces = dict() # Buffers reused across batches with the same m
+    stream = params.get('seeding', 'legacy') == 'stream'
+    cache = ResultCache(max_bytes=params.get('cache_size_mb', 1024)*2**20) if params.get('cache') else None
+    def seed(cell):
+        if not stream: return params['seed']
+        l, m, r, mode = cell
+        return cell_stream_seed(params['seed'], l, int(np.rint(m*float(r)).astype('int')), m, mode,
+                                params['prob_alt_hypo'])
+    def record(cell, cell_output):
+        if results is not None: results.add(cell[0], cell[2], cell[3], cell[1], cell_output, 'reps')
+        if params.get('saving', True): _save_output_BH_exp(params, cell, cell_output, 'reps', writer=writer)
+    for L in Ls:
+        for m in tqdm(params['m_s']):
+            cells = []
+            for r in params['ratio_s']:
+                for mode in params['mode_s']:
+                    m_0 = int(np.rint(m*float(r)).astype('int'))
+                    if _use_analytic_BH_exp(params, L, m_0, m, mode, params['methods']):
+                        _simulate_task_BH_exp(params, (L, m, r, mode), params['seed'], params['methods'],
+                                              results=results, writer=writer)
+                        continue
+                    cached = None
+                    if cache is not None and stream:
+                        keys = _cache_keys_BH_exp(params, (L, m, r, mode), seed((L, m, r, mode)), params['methods'],
+                                                  'reps')
+                        with stage('cache'): cached = cache.get_all(keys)
+                    if cached is None: cells.append((r, mode))
+                    else: record((L, m, r, mode), cached)
+            per_batch = max(BATCH_ELEMENTS // (params['num_rep']*m), 1)
+            for start in range(0, len(cells), per_batch):
+                batch = cells[start:start+per_batch]
+                output, keys = None, dict()
+                if cache is not None:
+                    options = None if stream else {'batch': [list(cell) for cell in batch]}
+                    keys = {cell: _cache_keys_BH_exp(params, (L, m, *cell), seed((L, m, *cell)), params['methods'],
+                                                     'reps', options=options) for cell in batch}
+                    if not stream:
+                        with stage('cache'): output = {cell: cache.get_all(keys[cell]) for cell in batch}
+                        if any(cell_output is None for cell_output in output.values()): output = None
+                if output is None:
+                    if m not in workspaces or workspaces[m].s < len(batch)*params['num_rep']:
+                        workspaces[m] = MultiTestWorkspace(len(batch)*params['num_rep'], m,
+                                                           dtype=params.get('dtype', 'float64'))
+                    output = simulate_batch_BH_exp(L, m, batch, params['num_rep'], params['methods'],
+                                                   params['criterion'], alpha=params['alpha'], saving=False,
+                                                   seed=params['seed'], prob_alt_hypo=params['prob_alt_hypo'],
+                                                   workspace=workspaces[m], pvalue=params.get('pvalue', 'cdf'),
+                                                   dtype=params.get('dtype', 'float64'),
+                                                   seeding=params.get('seeding', 'legacy'))
+                    for cell, cell_keys in keys.items(): cache.put_all(cell_keys, output[cell])
+                for (r, mode), cell_output in output.items(): record((L, m, r, mode), cell_output)
+
+def _cell_cost_BH_exp(num_rep, m, num_methods=1):
+    '''
+    Estimated relative cost of simulating a cell, proportional to num_rep * m log m
+    '''
+    return num_rep * m * np.log2(max(m, 2)) * num_methods
+
+def _use_analytic_BH_exp(params, L, m_0, m, mode, methods):
+    '''
+    Whether to evaluate a cell exactly (see `analytic.py`) instead of simulating it:
+    only with the deterministic generator, if `params['analytic']`, when it is estimated faster, and not in adaptive
+    mode (an exact cell would report `num_rep` replications instead of those needed to reach `params['se_tol']`)
+    '''
+    if not params.get('analytic', False) or params['prob_alt_hypo'] or params.get('se_tol') is not None: return False
+    if not analytic_applies(methods): return False
+    return analytic_cost(L, m_0, m, mode, methods) <= simulation_cost(params['num_rep'], m, len(methods))
+
+def _save_output_BH_exp(params, cell, output, kind, writer=None):
+    '''
+    Appends the outputs {method: {criterion: values}} of one cell to the raw store,
+    in the background if `writer` (a single-thread executor) is given
+    '''
+    l, m, r, mode = cell
+    m_0 = int(np.rint(m*float(r)).astype('int'))
+    records = [(l, m_0, m, mode, params['num_rep'], method, crit, values, kind)
+               for method, method_output in output.items() for crit, values in method_output.items()]
+    with stage('save'):
+        if writer is None: RawStore(RAW_OUTPUT_DIR).append_many(records)
+        else: writer.submit(RawStore(RAW_OUTPUT_DIR).append_many, records)
+
+def _cache_keys_BH_exp(params, cell, seed, methods, kind, options=None):
+    '''
+    Result cache keys (see `cache_key_BH_exp`) of the outputs of `methods` on one cell (L, m, ratio, mode),
+    as a dictionary keyed by (method, criterion). `options` are other options changing the outputs.
+    '''
+    l, m, r, mode = cell
+    m_0 = int(np.rint(m*float(r)).astype('int'))
+    generator = 'NormalMeanHypothesesProbabilistic' if params['prob_alt_hypo'] else 'NormalMeanHypotheses'
+    if params.get('chunk_size') is not None or params.get('se_tol') is not None:
+        options = dict(options or {}, se_tol=params.get('se_tol'), chunk_size=params.get('chunk_size'))
+    if params['vectorize'] and (params.get('pvalue', 'cdf'), params.get('dtype', 'float64')) != ('cdf', 'float64'):
+        options = dict(options or {}, pvalue=params.get('pvalue', 'cdf'), dtype=params.get('dtype', 'float64'))
+    return {(method, crit): cache_key_BH_exp(generator, l, m_0, m, mode, params['num_rep'], method, crit,
+                                             params['alpha'], seed, kind=kind, options=options)
+            for method in methods for crit in parse_criteria(params['criterion'])}
+
+def _simulate_task_BH_exp(params, cell, seed, methods, workspace=None, results=None, writer=None):
+    '''
+    Simulates `methods` on one cell (L, m, ratio, mode) with the given seed,
+    sharing the generated data across methods when vectorized.
+    If `params['seeding']` is 'stream', the cell is instead drawn from its own streams, keyed by
+    `params['seed']` and the cell (see `src/seeding.py`), whatever the schedule, chunks or jobs.
+    Cells selected by `_use_analytic_BH_exp` are evaluated exactly, and saved as sufficient statistics.
+    If `params['cache']`, a cell whose raw outputs are all in the result cache is not simulated:
+    its cached outputs are written to the raw store instead. Otherwise its outputs are cached.
+    The outputs are recorded in `results` (an `ExperimentResults`) if given,
+    and saved to the raw store unless `params['saving']` is False, through `writer` if given.
+
+    RETURNS
+    -------
+    Dictionary mapping each method to its outputs, a dictionary keyed by criterion,
+    and the kind of these outputs: 'reps' (per-replication values) or 'stats' (sufficient statistics)
+    '''
+    l, m, r, mode = cell
+    m_0 = int(np.rint(m*float(r)).astype('int'))
+    saving = params.get('saving', True)
+    chunk_size = params.get('chunk_size')
+    se_tol = params.get('se_tol')
+    kind = 'reps' if chunk_size is None and se_tol is None else 'stats'
+    save_decisions = params.get('save_decisions', False)
+    output = None
+    if params.get('seeding', 'legacy') == 'stream':
+        seed = cell_stream_seed(params['seed'], l, m_0, m, mode, params['prob_alt_hypo'])
+    PROFILER.set_cell(l, m_0, m, mode, params['num_rep'])
+
+    # Exact evaluation
+    if not save_decisions and _use_analytic_BH_exp(params, l, m_0, m, mode, methods):
+        with stage('analytic'):
+            output = simulate_cell_analytic(l, m_0, m, mode, params['num_rep'], methods,
+                                            parse_criteria(params['criterion']), alpha=params['alpha'])
+        kind = 'stats'
+
+    # Cache look up
+    use_cache = params.get('cache') and not save_decisions and output is None
+    if use_cache:
+        cache = ResultCache(max_bytes=params.get('cache_size_mb', 1024)*2**20)
+        keys = _cache_keys_BH_exp(params, cell, seed, methods, kind)
+        with stage('cache'): output = cache.get_all(keys)
+        use_cache = output is None
 
+    # Simulation (decisions can only be saved by the simulation itself, with its outputs)
+    if output is None:
+        if params['vectorize']:
+            output = simulate_cell_BH_exp(l, m_0, m, mode, params['num_rep'], methods, params['criterion'],
+                                          alpha=params['alpha'], saving=saving and save_decisions, seed=seed,
+                                          prob_alt_hypo=params['prob_alt_hypo'], chunk_size=chunk_size,
+                                          workspace=workspace, se_tol=se_tol, pvalue=params.get('pvalue', 'cdf'),
+                                          dtype=params.get('dtype', 'float64'), save_decisions=save_decisions)
+        else:
+            output = {method: simulate_BH_exp(l, m_0, m, mode, params['num_rep'], method, params['criterion'],
+                                              alpha=params['alpha'], saving=False, seed=seed,
+                                              vectorize=params['vectorize'], prob_alt_hypo=params['prob_alt_hypo'],
+                                              chunk_size=chunk_size, se_tol=se_tol)
+                      for method in methods}
+        if use_cache: cache.put_all(keys, output)
+        if save_decisions: saving = False # Already saved
+
+    # Hand-off
+    if results is not None: results.add(l, r, mode, m, output, kind)
+    if saving: _save_output_BH_exp(params, cell, output, kind, writer=writer)
+    return output, kind
+
+def _main_simulation_grid(params, results=None):
+    '''
+    Inner function to be called by the main function `main_simulation`
+    when `params['schedule']` is 'grid'.
+    Spreads the whole (L, m, ratio, mode) grid over a pool of `params['n_jobs']` processes.
+    Each cell gets its own independent seed, spawned from `params['seed']`
+    according to its position in the grid (and shared by all methods of the cell),
+    so that results do not depend on `n_jobs` nor on the execution order
+    (with `params['seeding']` 'stream', the streams of each cell are used instead).
+    Tasks are dispatched from the most to the least expensive
+    (estimated by `_cell_cost_BH_exp`) to balance the load of the workers.
+    If `results` (an `ExperimentResults`) is given, the outputs are also recorded in it.
+
+    RETURNS
+    -------
+    Dictionary mapping each cell (L, m, ratio, mode) to the outputs of its methods
+    (per-replication values or sufficient statistics, as recorded in `results`)
+    '''
+    cells = list(generate_cells_BH_exp(params['L_s'], params['m_s'], params['ratio_s'], params['mode_s']))
+    seeds = np.random.SeedSequence(params['seed']).spawn(len(cells))
+    if params['vectorize']:
+        tasks = [(cell, seed, None) for cell, seed in zip(cells, seeds)]
+    else:
+        tasks = [(cell, seed, method) for cell, seed in zip(cells, seeds) for method in params['methods']]
+    tasks.sort(key=lambda task: -_cell_cost_BH_exp(params['num_rep'], task[0][1],
+                                                   len(params['methods']) if task[2] is None else 1))
+    n_jobs = params['n_jobs'] if params['n_jobs'] not in [0, None] else 1
+    outputs = Parallel(n_jobs=n_jobs, batch_size=1)(delayed(_simulate_task_BH_exp)(params, cell, seed,
+                                                            params['methods'] if method is None else [method])
+                                                    for cell, seed, method in tqdm(tasks))
+    grid_results = dict()
+    for (cell, _, _), (output, kind) in zip(tasks, outputs):
+        grid_results.setdefault(cell, dict()).update(output)
+        if results is not None: results.add(cell[0], cell[2], cell[3], cell[1], output, kind)
+    return grid_results
+
+def simulate_L(params, L, results=None):
+    '''
+    Simulates all cells of one value of L, as a stage of the pipelined experiment
+    (see `main_experiment_pipelined` in `run_experiment.py`), recording them in `results` if given
+    '''
+    os.makedirs(RAW_OUTPUT_DIR, exist_ok=True)
+    return _main_simulation_L(params=params, L=L, results=results)
 
-def main_simulation(filename='params.json', params=None, print_params=True):
+def main_simulation(filename='params.json', params=None, print_params=True, results=None):
     '''
     Main function to simulate and generate raw output.
     Will be run by the `if __name__ == '__main__'` of this script.
@@ -98,6 +581,8 @@ def main_simulation(filename='params.json', params=None, print_params=True):
         if None: load json file from filename as params.
     print_params : Optional (bool)
         prints parameters
+    results : Optional (ExperimentResults)
+        if not None: records the outputs of all cells in it, to be passed to the analysis in memory
 
     RETURNS
     -------
@@ -115,14 +600,25 @@ def main_simulation(filename='params.json', params=None, print_params=True):
         print(' ratio_s: ', params['ratio_s'])
         print(' num_rep: ', params['num_rep'])
         print(' methods: ', params['methods'])
-        print(f" criterion: {params['criterion']}")
+        print(f" criteria: {', '.join(parse_criteria(params['criterion']))}")
         print(f" alpha: {params['alpha']}")
+        if params.get('chunk_size'): print(f" chunk_size: {params['chunk_size']}")
+        if params.get('se_tol'): print(f" se_tol: {params['se_tol']} (num_rep is the maximum)")
+        print(f" schedule: {params.get('schedule', 'L')} (n_jobs: {params['n_jobs']})")
+        if params.get('cache'): print(f" cache: {CACHE_DIR} ({params.get('cache_size_mb', 1024)} MB)")
+        if params.get('analytic', False) and not params['prob_alt_hypo']: print(' analytic: exact evaluation of cheap cells')
+        if params['vectorize']: print(f" p values: {params.get('pvalue', 'cdf')} ({params.get('dtype', 'float64')})")
+        if params.get('batch'): print(' batch: cells with the same L and m simulated at once')
         print('================================================')
     time2 = time.perf_counter()
-    if params['n_jobs'] not in [0, 1]:
-        parallel_function = lambda L: _main_simulation_L(params=params, L=L)
-        Parallel(n_jobs=params['n_jobs'])(delayed(parallel_function)(L) for L in params['L_s'])
-    else: _main_simulation_L(params=params)
+    if params.get('schedule', 'L') == 'grid': _main_simulation_grid(params, results=results)
+    elif params['n_jobs'] not in [0, 1]:
+        parallel_function = lambda L: _main_simulation_L(params=params, L=L,
+                                                         results=None if results is None else ExperimentResults())
+        for L_results in Parallel(n_jobs=params['n_jobs'])(delayed(parallel_function)(L) for L in params['L_s']):
+            if results is not None: results.update(L_results)
+    else: _main_simulation_L(params=params, results=results)
+    if params.get('cache'): ResultCache(max_bytes=params.get('cache_size_mb', 1024)*2**20).evict()
     time3 = time.perf_counter()
     return [['Set ups', time2-time1], ['Main loop', time3-time2]]
         
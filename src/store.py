@@ -0,0 +1,138 @@
+import os
+import json
+import fcntl
+import numpy as np
+from src.methods import PackedDecisions
+from src.constants import RAW_OUTPUT_DIR
+
+class RawStore:
+    '''
+    Append-friendly columnar store of the raw outputs of the BH experiment.
+    Each criterion has a single binary file `store_<criterion>.bin` holding the arrays of all cells
+    back to back, and the index table `store_index.jsonl` records for each array its parameter tuple
+    (L, m_0, m, mode, num_rep, method, criterion), its kind ('reps' for per-replication values,
+    'stats' for sufficient statistics), dtype, byte offset, length and scale.
+    Power is stored as integer counts out of m-m_0 (the scale), and numbers of errors and fwer indicators as integers.
+    Decisions (criterion 'decisions', kind 'packed') are stored as `PackedDecisions` rows,
+    the scale being the number of bytes per row.
+    Appends are serialized with a file lock, so that parallel workers can share a store;
+    when a parameter tuple is appended several times, the last entry is used.
+    '''
+    def __init__(self, directory=RAW_OUTPUT_DIR):
+        self.directory = directory
+        self.index_path = f'{directory}/store_index.jsonl'
+
+    def data_path(self, criterion):
+        return f'{self.directory}/store_{criterion}.bin'
+
+    @staticmethod
+    def key(L, m_0, m, mode, num_rep, method, criterion):
+        return (float(np.round(float(L), 1)), int(m_0), int(m), mode, int(num_rep), method, criterion)
+
+    @staticmethod
+    def _encode(values, m_0, m, criterion, kind):
+        '''
+        Returns the array to write and its scale
+        '''
+        if kind == 'packed': return values.bits.reshape(-1), values.bits.shape[-1]
+        values = np.asarray(values)
+        if kind == 'stats': return values.astype('float64'), 1
+        count_dtype = 'uint16' if m < 2**16 else 'uint32'
+        if criterion == 'power': return np.rint(values*(m-m_0)).astype(count_dtype), m-m_0
+        if criterion in ('type1', 'type2', 'fwer'): return values.astype(count_dtype), 1
+        return values.astype('float64'), 1
+
+    def append(self, L, m_0, m, mode, num_rep, method, criterion, values, kind='reps'):
+        '''
+        Appends the array `values` (per-replication values, sufficient statistics if kind is 'stats',
+        or `PackedDecisions` if kind is 'packed') of one parameter tuple to the store
+        '''
+        self.append_many([(L, m_0, m, mode, num_rep, method, criterion, values, kind)])
+
+    def append_many(self, records):
+        '''
+        Appends several arrays at once, holding the lock and opening each file only once.
+        `records` is a list of the arguments (L, m_0, m, mode, num_rep, method, criterion, values[, kind]) of `append`.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        with open(f'{self.directory}/store.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            files, lines = dict(), []
+            try:
+                for L, m_0, m, mode, num_rep, method, criterion, values, *kind in records:
+                    kind = kind[0] if kind else 'reps'
+                    data, scale = RawStore._encode(values, m_0, m, criterion, kind)
+                    entry = dict(zip(('L', 'm_0', 'm', 'mode', 'num_rep', 'method', 'criterion'),
+                                     RawStore.key(L, m_0, m, mode, num_rep, method, criterion)))
+                    if criterion not in files: files[criterion] = open(self.data_path(criterion), 'ab')
+                    file = files[criterion]
+                    offset = file.tell()
+                    padding = -offset % 8 # Keep every array aligned
+                    file.write(b'\0'*padding)
+                    file.write(data.tobytes())
+                    entry.update(kind=kind, dtype=data.dtype.str, offset=offset+padding, length=len(data), scale=scale)
+                    lines.append(json.dumps(entry)+'\n')
+            finally:
+                for file in files.values(): file.close()
+            with open(self.index_path, 'a') as file:
+                file.write(''.join(lines))
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def open(self, index=None):
+        '''
+        Opens the store for reading: loads the index (unless given, see `read_index`)
+        and memory-maps each criterion file once
+        '''
+        return RawStoreReader(self, index=index)
+
+    def read_index(self, offset=0):
+        '''
+        Reads the index from byte `offset` (the end of the previously read entries, the index being append-only).
+        Returns the entries read, keyed by parameter tuple (the last entry of each tuple),
+        the offset of the end of the last complete line, and that line.
+        '''
+        index, last = dict(), None
+        if not os.path.exists(self.index_path): return index, 0, last
+        with open(self.index_path, 'rb') as file:
+            file.seek(offset)
+            data = file.read()
+        data = data[:data.rfind(b'\n')+1] # A line may be being appended
+        for line in data.decode().splitlines():
+            entry = json.loads(line)
+            index[RawStore.key(*[entry[field] for field in ('L', 'm_0', 'm', 'mode', 'num_rep', 'method',
+                                                              'criterion')])] = entry
+            last = line
+        return index, offset+len(data), last
+
+class RawStoreReader:
+    '''
+    Read access to a `RawStore`, returning memory-mapped views of the stored arrays
+    '''
+    def __init__(self, store, index=None):
+        self.index = index if index is not None else store.read_index()[0]
+        self.data = dict()
+        for criterion in {key[-1] for key in self.index}:
+            self.data[criterion] = np.memmap(store.data_path(criterion), dtype='uint8', mode='r')
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def view(self, key):
+        '''
+        Memory-mapped view of the stored array of `key` (see `RawStore.key`) and its index entry
+        '''
+        entry = self.index[key]
+        dtype = np.dtype(entry['dtype'])
+        start = entry['offset']
+        return self.data[key[-1]][start:start+entry['length']*dtype.itemsize].view(dtype), entry
+
+    def get(self, key):
+        '''
+        Decoded array of `key`: per-replication values, sufficient statistics, or `PackedDecisions`
+        '''
+        values, entry = self.view(key)
+        if entry['kind'] == 'stats': return values
+        if entry['kind'] == 'packed': return PackedDecisions(values.reshape(-1, entry['scale']), entry['m'])
+        if entry['criterion'] == 'power': return values / entry['scale']
+        if entry['criterion'] in ('type1', 'type2', 'fwer'): return values.astype('int64')
+        return values
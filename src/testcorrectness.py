@@ -1,8 +1,34 @@
+import os
+import sys
+import json
 import pytest
+import subprocess
 import random
+import shutil
+import tracemalloc
 import numpy as np
-from src.methods import MultiTest
-from src.utils import divide_0div0, compare_reject_result
+from scipy.stats import norm
+from src.methods import MultiTest, MultiTestWorkspace, NormalMeanHypothesesProbabilistic, PackedDecisions
+from src.utils import divide_0div0, compare_reject_result, mean_and_se, \
+                      sufficient_stats, mean_and_se_from_stats, reject_stats, merge_stats, generate_cells_BH_exp, \
+                      generate_plotname_BH_exp
+from src.store import RawStore
+from src.results import ExperimentResults
+from src.constants import RAW_OUTPUT_DIR, PROCESSED_OUTPUT_DIR, PLOTTING_DIR, SHARD_DIR
+from src.run_experiment import main_experiment, main_experiment_pipelined
+from src import analyze, simulation
+from src.analyze import main_analyze, summary_from_store
+from src.cache import ResultCache, cache_key_BH_exp
+from src.simulation import simulate_BH_exp, simulate_cell_BH_exp, _generator_BH_exp, _main_simulation_grid, _p_values_in_place, \
+                           simulate_batch_BH_exp, _simulate_task_BH_exp, _use_analytic_BH_exp, \
+                           simulate_BH_exp_streaming, MIN_ADAPTIVE_REPLICATIONS
+from src.analytic import simulate_cell_analytic, rejection_probability
+from src.plotting import figures_L, plot_figures
+from src.profiling import PROFILER
+from src.seeding import cell_stream_seed, generate_rows
+from src.shards import merge_shards, run_shard
+from src.run_benchmark import time_function, compare_benchmarks
+from src.run_complexity import fit_power_law
 
 # Import implemented functions
 
@@ -59,8 +85,10 @@ class TestMethodologyFunctionCorrectness:
         expected_output = np.array([[1, 0, 1, 1, 0, 0, 0, 1, 0]])
         for method in [MultiTest.HochbergMethod,
                        MultiTest.HochbergMethodFast,
+                       MultiTest.HochbergMethodPartial,
                        MultiTest.BHMethod,
-                       MultiTest.BHMethodFast]:
+                       MultiTest.BHMethodFast,
+                       MultiTest.BHMethodPartial]:
             test_output = method(p_values, alpha)
             assert (test_output == expected_output).all(), \
                 f'Method {method.__name__} gives {test_output} but expect {expected_output}'
@@ -78,12 +106,102 @@ class TestMethodologyFunctionCorrectness:
                                     [1, 0, 0, 1, 0, 0, 0, 1, 0]])
         for method in [MultiTest.HochbergMethod,
                        MultiTest.HochbergMethodFast,
+                       MultiTest.HochbergMethodPartial,
                        MultiTest.BHMethod,
-                       MultiTest.BHMethodFast]:
+                       MultiTest.BHMethodFast,
+                       MultiTest.BHMethodPartial]:
             test_output = method(p_values, alpha)
             assert (test_output == expected_output).all(), \
                 f'Method {method.__name__} gives {test_output} but expect {expected_output}'
 
+    def test_partial_selection(self):
+        '''
+        Test that the partial-selection step-up methods agree with the simple implementations
+        on random p values with ties and with few or many rejections
+        '''
+        rng = np.random.default_rng(4)
+        for upper in (1., 0.2, 0.01):
+            p_values = rng.uniform(0, upper, size=(50, 20))
+            p_values[:, :4] = np.round(p_values[:, :4], 2) # Ties
+            for alpha in (0.01, 0.05, 0.2):
+                assert (MultiTest.BHMethodPartial(p_values, alpha) == MultiTest.BHMethod(p_values, alpha)).all(), \
+                       f'Partial-selection BH method differs from simple one with alpha {alpha}'
+                assert (MultiTest.HochbergMethodPartial(p_values, alpha) == \
+                        MultiTest.HochbergMethod(p_values, alpha)).all(), \
+                       f'Partial-selection Hochberg method differs from simple one with alpha {alpha}'
+
+    def test_in_place(self):
+        '''
+        Test that the in-place methods reusing one workspace agree with the simple versions,
+        including on fewer rows than the workspace, with ties and with uint8 outputs
+        '''
+        rng = np.random.default_rng(6)
+        workspace = MultiTestWorkspace(100, 12)
+        out = np.empty((100, 12), dtype='uint8')
+        pairs = [(MultiTest.HochbergMethodInPlace, MultiTest.HochbergMethod),
+                 (MultiTest.BHMethodInPlace, MultiTest.BHMethod)]
+        for rows, upper in ((100, 1.), (37, 0.1), (100, 0.01)):
+            p_values = rng.uniform(0, upper, size=(rows, 12))
+            p_values[:, :3] = p_values[:, 3:6] # Ties
+            for alpha in (0.01, 0.05, 0.2):
+                for in_place, fast in pairs:
+                    decision = in_place(p_values, alpha, workspace)
+                    assert decision.dtype == bool and (decision == fast(p_values, alpha)).all(), \
+                           f'{in_place.__name__} differs from {fast.__name__} with alpha {alpha}'
+                    assert (in_place(p_values, alpha, workspace, out=out[:rows]) == fast(p_values, alpha)).all(), \
+                           f'{in_place.__name__} gives unexpected uint8 output with alpha {alpha}'
+                assert (MultiTest.BonferroniMethodInPlace(p_values, alpha, out[:rows]) == \
+                        MultiTest.BonferroniMethod(p_values, alpha)).all(), \
+                       f'In-place Bonferroni method gives unexpected output with alpha {alpha}'
+
+    def test_procedures(self):
+        '''
+        Test the procedure engine: Holm against a loop implementation, BY and Storey against BH
+        with the corresponding levels, and the in-place and z scale versions against `ProcedureMethod`
+        '''
+        rng = np.random.default_rng(8)
+        p_values = rng.uniform(0, 0.2, size=(300, 10))
+        p_values[:, 5:] = rng.uniform(0, 1, size=(300, 5))
+        workspace = MultiTestWorkspace(300, 10)
+        methods = ['Bonferroni', 'Hochberg', 'BH', 'Holm', 'BY', 'Storey']
+        for alpha in (0.01, 0.05, 0.2):
+            holm = np.zeros((300, 10), dtype='int')
+            for row, p in enumerate(p_values):
+                for i, index in enumerate(np.argsort(p)):
+                    if p[index] > alpha/(10-i): break
+                    holm[row, index] = 1
+            assert (MultiTest.ProcedureMethod(p_values, alpha, 'Holm') == holm).all(), 'Holm procedure is wrong'
+            c = np.sum(1/np.arange(1, 11))
+            assert (MultiTest.ProcedureMethod(p_values, alpha, 'BY') == MultiTest.BHMethodFast(p_values, alpha/c)).all()
+            pi0 = np.minimum((np.sum(p_values > 0.5, axis=1)+1)/5, 1)
+            storey = np.array([MultiTest.BHMethodFast(p, alpha/q)[0] for p, q in zip(p_values, pi0)])
+            assert (MultiTest.ProcedureMethod(p_values, alpha, 'Storey') == storey).all(), 'Storey procedure is wrong'
+            assert (MultiTest.ProcedureMethod(p_values, alpha, 'BH') == MultiTest.BHMethod(p_values, alpha)).all()
+            expected = {method: MultiTest.ProcedureMethod(p_values, alpha, method) for method in methods}
+            stats = -norm.isf(p_values/2) # Statistics -|z| with these p values
+            for scale, values in (('p', p_values), ('z', stats)):
+                for method, decision in MultiTest.SharedMethodsInPlace(values, alpha, methods, workspace, scale=scale):
+                    assert (decision == expected[method]).all(), f'In-place {method} differs on the {scale} scale'
+        with pytest.raises(ValueError):
+            MultiTest.ProcedureMethod(p_values, 0.05, 'Unknown')
+
+    def test_probabilistic_generator(self):
+        '''
+        Test that the probabilistic generator is reproducible given its rng
+        and puts the alternative means in the right columns
+        '''
+        alt_means, alt_probs = [1., 2., 3., 4.], [.1, .2, .3, .4]
+        outputs = []
+        for _ in range(2):
+            generator = NormalMeanHypothesesProbabilistic(4, 12, alt_means, alt_probs,
+                                                          rng=np.random.default_rng(7))
+            outputs.append(generator.generate_data(size=20000))
+        assert (outputs[0] == outputs[1]).all(), 'Probabilistic generator is not reproducible'
+        assert outputs[0].shape == (20000, 16), 'Probabilistic generator gives unexpected shape'
+        assert abs(outputs[0][:, :4].mean()) < 0.05, 'Null hypotheses should have mean 0'
+        assert abs(outputs[0][:, 4:].mean()-np.dot(alt_means, alt_probs)) < 0.05, \
+               'Alternative hypotheses have unexpected mean'
+
 class TestUtilFunctionCorrectness:
     '''
     Class of functions that test correctness of
@@ -135,3 +253,602 @@ class TestUtilFunctionCorrectness:
         output_0 = divide_0div0(numerator, denominator, alt_value=0.)
         assert (abs(output_1-expected_output_1) < 1e-9).all(), '0div0 function not consistent with alt. value 1.'
         assert (abs(output_0-expected_output_0) < 1e-9).all(), '0div0 function not consistent with alt. value 0.'
+
+    def test_sufficient_stats(self):
+        '''Tests that merged sufficient statistics give the same mean and se as `mean_and_se`'''
+        nums = np.random.default_rng(0).uniform(0, 1, 1001)
+        stats = sufficient_stats(nums[:300]) + sufficient_stats(nums[300:])
+        mean, se = mean_and_se(nums)
+        mean_stats, se_stats = mean_and_se_from_stats(stats)
+        assert abs(mean-mean_stats) < 1e-12, 'Mean from sufficient statistics is inconsistent'
+        assert abs(se-se_stats) < 1e-12, 'Se from sufficient statistics is inconsistent'
+
+    def test_reject_stats(self):
+        '''Tests the fused reducer against `compare_reject_result` followed by `sufficient_stats`'''
+        criteria = ('power', 'type1', 'type2', 'fdr', 'fwer')
+        rng = np.random.default_rng(8)
+        m_0, m = 3, 10
+        ground_truth = np.array([0]*m_0+[1]*(m-m_0))
+        decisions = rng.uniform(0, 1, size=(500, m)) < 0.3
+        results = compare_reject_result(ground_truth, decisions, criteria=criteria)
+        fused = merge_stats(reject_stats(decisions[:123], m_0, criteria),
+                            reject_stats(decisions[123:].astype('int'), m_0, criteria))
+        for crit in criteria:
+            assert np.allclose(fused[crit], sufficient_stats(results[crit]), rtol=1e-12), \
+                   f'Fused reducer gives unexpected statistics for {crit}'
+
+class TestSimulationCorrectness:
+    '''
+    Class of functions that test correctness of
+    functions in `simulation.py`
+    '''
+    def test_streaming(self):
+        '''Tests that the chunked streaming mode agrees with the full simulation'''
+        for method in ('Bonferroni', 'Hochberg', 'BH'):
+            full = simulate_BH_exp(5.0, 4, 16, 'E', 1000, method, 'power', saving=False,
+                                   vectorize=True, prob_alt_hypo=False, seed=3)
+            streamed = simulate_BH_exp(5.0, 4, 16, 'E', 1000, method, 'power', saving=False,
+                                       vectorize=True, prob_alt_hypo=False, seed=3, chunk_size=128)
+            mean, se = mean_and_se(full['power'])
+            mean_stream, se_stream = mean_and_se_from_stats(streamed['power'])
+            assert streamed['power'][0] == 1000, 'Streaming mode lost replications'
+            assert abs(mean-mean_stream) < 1e-12 and abs(se-se_stream) < 1e-12, \
+                   f'Streaming mode of {method} gives unexpected mean or se'
+        seed = cell_stream_seed(3, 5.0, 4, 16, 'E', True, block_size=100)
+        full = simulate_BH_exp(5.0, 4, 16, 'E', 1000, 'BH', 'power', saving=False,
+                               vectorize=True, prob_alt_hypo=True, seed=seed)
+        for chunk_size in (128, 1000):
+            streamed = simulate_BH_exp(5.0, 4, 16, 'E', 1000, 'BH', 'power', saving=False,
+                                       vectorize=True, prob_alt_hypo=True, seed=seed, chunk_size=chunk_size)
+            assert np.allclose(mean_and_se(full['power']), mean_and_se_from_stats(streamed['power']),
+                               rtol=0, atol=1e-12), \
+                   f'Streaming mode of the probabilistic generation depends on the chunks ({chunk_size})'
+
+    def test_shared_draw(self):
+        '''Tests that the shared-draw cell engine agrees with the per-method simulation'''
+        methods = ['Bonferroni', 'Hochberg', 'BH']
+        for prob_alt_hypo in (False, True):
+            shared = simulate_cell_BH_exp(10.0, 8, 32, 'D', 500, methods, 'power', saving=False,
+                                          prob_alt_hypo=prob_alt_hypo, seed=5)
+            for method in methods:
+                single = simulate_BH_exp(10.0, 8, 32, 'D', 500, method, 'power', saving=False,
+                                         vectorize=True, prob_alt_hypo=prob_alt_hypo, seed=5)
+                assert (shared[method]['power'] == single['power']).all(), \
+                       f'Shared-draw engine gives unexpected {method} output'
+
+    def test_multi_criteria(self):
+        '''Tests that one pass over several criteria matches one pass per criterion'''
+        criteria = ('power', 'type1', 'type2', 'fdr')
+        together = simulate_cell_BH_exp(5.0, 8, 16, 'I', 300, ['BH'], 'power,type1,type2,fdr', saving=False,
+                                        prob_alt_hypo=False, seed=2)
+        for crit in criteria:
+            alone = simulate_cell_BH_exp(5.0, 8, 16, 'I', 300, ['BH'], crit, saving=False,
+                                         prob_alt_hypo=False, seed=2)
+            assert (together['BH'][crit] == alone['BH'][crit]).all(), \
+                   f'Criterion {crit} differs when computed together with other criteria'
+
+    def test_grid_schedule(self):
+        '''Tests that the grid scheduler gives bit-identical results for any number of jobs'''
+        params = {'L_s': [5.0, 10.0], 'm_s': [4, 16], 'ratio_s': ['0.25', '0.75'], 'mode_s': ['D', 'I'],
+                  'methods': ['Bonferroni', 'Hochberg', 'BH'], 'num_rep': 200, 'criterion': 'power,fdr',
+                  'alpha': 0.05, 'seed': 11, 'vectorize': True, 'prob_alt_hypo': False, 'saving': False}
+        serial = _main_simulation_grid(dict(params, n_jobs=1))
+        parallel = _main_simulation_grid(dict(params, n_jobs=2))
+        assert serial.keys() == parallel.keys(), 'Grid scheduler misses some cells'
+        for cell, output in serial.items():
+            for method in params['methods']:
+                for crit in ('power', 'fdr'):
+                    assert (output[method][crit] == parallel[cell][method][crit]).all(), \
+                           f'Grid scheduler is not reproducible in cell {cell} for {method}'
+
+    def test_grid_kinds(self):
+        '''Tests that the grid scheduler records the kind of outputs each unvectorized task actually used'''
+        params = {'L_s': [5.0], 'm_s': [8], 'ratio_s': ['0.00'], 'mode_s': ['D'],
+                  'methods': ['Bonferroni', 'Hochberg', 'BH'], 'num_rep': 2000, 'criterion': 'power',
+                  'alpha': 0.05, 'seed': 17, 'vectorize': False, 'prob_alt_hypo': False, 'analytic': True,
+                  'saving': False, 'n_jobs': 1}
+        results = ExperimentResults()
+        _main_simulation_grid(params, results=results)
+        for method in params['methods']:
+            mean, _, nrep = results.summary(ExperimentResults.key(5.0, '0.00', 'D', method, 8), 'power')
+            assert 0 <= mean <= 1 and nrep == 2000, f'Grid scheduler misrecorded {method}: {mean}, {nrep}'
+
+class TestStoreCorrectness:
+    '''
+    Class of functions that test correctness of
+    the raw output store in `store.py`
+    '''
+    def test_round_trip(self, tmp_path):
+        '''Tests that stored arrays are read back unchanged, with the last append winning'''
+        store = RawStore(str(tmp_path))
+        rng = np.random.default_rng(9)
+        S = rng.integers(0, 13, size=101)
+        arrays = {'power': S/12, 'type1': rng.integers(0, 4, size=101),
+                  'fdr': rng.uniform(0, 1, size=101), 'type2': 12-S}
+        for crit, values in arrays.items():
+            store.append(5.0, 4, 16, 'E', 101, 'BH', crit, np.zeros_like(values))
+            store.append(5.0, 4, 16, 'E', 101, 'BH', crit, values)
+        store.append(10.0, 4, 16, 'E', 101, 'BH', 'power', np.array([101., 50., 30.]), kind='stats')
+        reader = store.open()
+        for crit, values in arrays.items():
+            assert (reader.get(RawStore.key(5.0, 4, 16, 'E', 101, 'BH', crit)) == values).all(), \
+                   f'Store does not give back the {crit} array'
+        stats, entry = reader.view(RawStore.key(10., 4, 16, 'E', 101, 'BH', 'power'))
+        assert entry['kind'] == 'stats' and (stats == [101., 50., 30.]).all(), \
+               'Store does not give back the sufficient statistics'
+        assert reader.view(RawStore.key(5.0, 4, 16, 'E', 101, 'BH', 'power'))[0].dtype == np.uint16, \
+               'Power should be stored as integer counts'
+
+class TestCacheCorrectness:
+    '''
+    Class of functions that test correctness of
+    the result cache in `cache.py`
+    '''
+    def test_keys(self):
+        '''Tests that cache keys change with every parameter'''
+        args = ['NormalMeanHypotheses', 5.0, 4, 16, 'E', 100, 'BH', 'power', 0.05, 17]
+        keys = {cache_key_BH_exp(*args)}
+        for i, value in enumerate(['NormalMeanHypothesesProbabilistic', 10.0, 8, 32, 'D', 200,
+                                   'Hochberg', 'fdr', 0.1, np.random.SeedSequence(17).spawn(1)[0]]):
+            keys.add(cache_key_BH_exp(*(args[:i]+[value]+args[i+1:])))
+        keys.add(cache_key_BH_exp(*args, kind='stats'))
+        assert len(keys) == len(args)+2, 'Different parameters should give different cache keys'
+
+    def test_streaming_keys(self):
+        '''Tests that the cache keys of streamed cells depend on the chunk size'''
+        params = {'num_rep': 1000, 'alpha': 0.05, 'criterion': 'power', 'vectorize': True, 'prob_alt_hypo': True}
+        keys = [simulation._cache_keys_BH_exp(dict(params, chunk_size=chunk_size), (5.0, 16, '0.50', 'E'), 17,
+                                              ['BH'], 'stats') for chunk_size in (128, 1000)]
+        assert keys[0] != keys[1], 'Streamed outputs with different chunk sizes share cache keys'
+
+    def test_eviction(self, tmp_path):
+        '''Tests that the least recently used entries are evicted first'''
+        cache = ResultCache(str(tmp_path), max_bytes=2000)
+        for i in range(4):
+            cache.put(f'key{i}', np.zeros(100))
+            os.utime(cache.path(f'key{i}'), (i, i))
+        cache.get('key0') # Refreshes key0
+        assert cache.evict() == 2, 'Cache should evict two entries to fit its size bound'
+        assert cache.get('key1') is None and cache.get('key2') is None, 'Cache evicts the wrong entries'
+        assert (cache.get('key0') == 0).all() and (cache.get('key3') == 0).all(), 'Cache lost recent entries'
+
+class TestAdaptiveCorrectness:
+    '''
+    Class of functions that test correctness of
+    the adaptive number of replications in `simulation.py`
+    '''
+    def test_early_stopping(self):
+        '''Tests that adaptive mode stops once the se is below tolerance, within the maximum'''
+        methods = ['Bonferroni', 'BH']
+        output = simulate_cell_BH_exp(5.0, 8, 16, 'E', 50000, methods, 'power,fdr', saving=False,
+                                      prob_alt_hypo=False, seed=1, chunk_size=500, se_tol=0.005)
+        for method in methods:
+            for crit in ('power', 'fdr'):
+                n = output[method][crit][0]
+                assert n < 50000 and n % 500 == 0, f'Adaptive mode used {n} replications'
+                assert mean_and_se_from_stats(output[method][crit])[1] < 0.005, \
+                       f'Adaptive mode stopped before the se of {crit} of {method} is below tolerance'
+        capped = simulate_cell_BH_exp(5.0, 8, 16, 'E', 2000, methods, 'power', saving=False,
+                                      prob_alt_hypo=False, seed=1, chunk_size=500, se_tol=1e-6)
+        assert capped['BH']['power'][0] == 2000, 'Adaptive mode should stop at the maximum replications'
+
+    def test_degenerate_batch(self):
+        '''Tests that a first batch with se 0 (power exactly 1) does not stop adaptive mode'''
+        for stream in (False, True):
+            if stream:
+                output = {'Bonferroni': simulate_BH_exp_streaming(50.0, 8, 16, 'E', 50000, 'Bonferroni',
+                                                                  criterion='power', saving=False, prob_alt_hypo=False,
+                                                                  seed=1, chunk_size=500, se_tol=0.005)}
+            else:
+                output = simulate_cell_BH_exp(50.0, 8, 16, 'E', 50000, ['Bonferroni'], 'power', saving=False,
+                                              prob_alt_hypo=False, seed=1, chunk_size=500, se_tol=0.005)
+            stats = output['Bonferroni']['power']
+            assert mean_and_se_from_stats(stats)[1] == 0, 'The cell should have power exactly 1'
+            assert stats[0] == MIN_ADAPTIVE_REPLICATIONS, \
+                   f'Adaptive mode stopped after {stats[0]} instead of {MIN_ADAPTIVE_REPLICATIONS} replications'
+
+class TestAnalyticCorrectness:
+    '''
+    Class of functions that test correctness of
+    the exact evaluation in `analytic.py`
+    '''
+    def test_known_values(self):
+        '''Tests the exact evaluation against closed forms'''
+        alpha = 0.05
+        output = simulate_cell_analytic(5.0, 8, 8, 'E', 100, ['Bonferroni', 'BH'], ['fdr', 'fwer'], alpha)
+        assert np.isclose(output['BH']['fdr'][1]/100, alpha), 'BH has fdr alpha under the global null'
+        assert np.isclose(output['BH']['fwer'][1]/100, alpha), 'BH has fwer alpha under the global null'
+        assert np.isclose(output['Bonferroni']['fwer'][1]/100, 1-(1-alpha/8)**8), 'Bonferroni fwer is wrong'
+        output = simulate_cell_analytic(4.0, 0, 4, 'E', 100, ['Bonferroni'], ['power'], alpha)
+        expected = np.mean(rejection_probability(np.array([1., 2., 3., 4.]), alpha/4))
+        assert np.isclose(output['Bonferroni']['power'][1]/100, expected), 'Bonferroni power is wrong'
+
+    def test_against_simulation(self):
+        '''Tests that the exact means are within the simulation error'''
+        methods, criteria = ['Bonferroni', 'Hochberg', 'BH'], ('power', 'type1', 'fdr', 'fwer')
+        exact = simulate_cell_analytic(5.0, 4, 12, 'D', 20000, methods, criteria)
+        simulated = simulate_cell_BH_exp(5.0, 4, 12, 'D', 20000, methods, ','.join(criteria), saving=False,
+                                         prob_alt_hypo=False, seed=3, chunk_size=20000)
+        for method in methods:
+            for crit in criteria:
+                mean, se = mean_and_se_from_stats(simulated[method][crit])
+                assert abs(exact[method][crit][1]/20000 - mean) < 5*se, f'Exact {crit} of {method} is off'
+
+    def test_path_choice(self):
+        '''Tests that the exact evaluation is only chosen where it is faster than simulating the cell'''
+        methods = ['Bonferroni', 'Hochberg', 'BH']
+        params = {'analytic': True, 'prob_alt_hypo': False, 'num_rep': 2000}
+        for m, m_0 in [(4, 3), (16, 8), (64, 48)]:
+            assert not _use_analytic_BH_exp(params, 5.0, m_0, m, 'D', methods), f'Exact evaluation chosen for m={m}'
+        exact = time_function(lambda: simulate_cell_analytic(5.0, 3, 4, 'D', 50000, methods, ['power']), repeat=3)
+        simulated = time_function(lambda: simulate_cell_BH_exp(5.0, 3, 4, 'D', 50000, methods, 'power', saving=False,
+                                                               prob_alt_hypo=False, seed=17), repeat=3)
+        assert _use_analytic_BH_exp(dict(params, num_rep=50000), 5.0, 3, 4, 'D', methods), 'Exact evaluation not chosen'
+        assert exact['min'] < simulated['min'], 'Exact evaluation chosen where it is slower'
+        assert not _use_analytic_BH_exp(dict(params, num_rep=50000, se_tol=0.01), 5.0, 3, 4, 'D', methods), \
+               'Exact evaluation chosen in adaptive mode'
+
+class TestPValueCorrectness:
+    '''
+    Class of functions that test correctness of
+    the p value layer in `simulation.py`
+    '''
+    def test_modes(self):
+        '''Tests that all p value modes and precisions give the same decisions on the same data'''
+        data = np.random.default_rng(2).normal(1., 1.5, size=(300, 20))
+        data[:, 0] = 40. # p value underflowing with the cdf
+        expected = 2*norm.sf(np.abs(data))
+        assert np.allclose(_p_values_in_place(data.copy(), 'erfc'), expected, rtol=1e-12, atol=0)
+        methods = ['Bonferroni', 'Hochberg', 'BH']
+        for dtype in ('float64', 'float32'):
+            workspace = MultiTestWorkspace(300, 20, dtype=dtype)
+            decisions = dict()
+            for pvalue in ('cdf', 'erfc', 'z'):
+                stats = _p_values_in_place(data.astype(dtype), pvalue)
+                scale = 'z' if pvalue == 'z' else 'p'
+                for method, decision in MultiTest.SharedMethodsInPlace(stats, 0.05, methods, workspace, scale):
+                    decisions[method, pvalue] = decision.copy()
+            for method in methods:
+                assert (decisions[method, 'erfc'] == decisions[method, 'cdf']).all() and \
+                       (decisions[method, 'z'] == decisions[method, 'cdf']).all(), \
+                       f'P value modes give different decisions for {method} in {dtype}'
+
+class TestPackedCorrectness:
+    '''
+    Class of functions that test correctness of
+    the bitpacked decisions in `methods.py`
+    '''
+    def test_counts(self):
+        '''Tests that popcount reductions on packed decisions agree with the unpacked ones'''
+        criteria = ('power', 'type1', 'type2', 'fdr', 'fwer')
+        decisions = np.random.default_rng(5).uniform(0, 1, size=(400, 21)) < 0.4
+        ground_truth = np.array([0]*6+[1]*15)
+        packed = PackedDecisions.pack(decisions)
+        assert packed.bits.shape == (400, 3) and (packed.unpack() == decisions).all(), 'Packing is not lossless'
+        expected = compare_reject_result(ground_truth, decisions.astype('int'), criteria=criteria)
+        output = compare_reject_result(ground_truth, packed, criteria=criteria)
+        fused = reject_stats(packed, 6, criteria)
+        for crit in criteria:
+            assert (output[crit] == expected[crit]).all(), f'Packed decisions give unexpected {crit}'
+            assert np.allclose(fused[crit], sufficient_stats(expected[crit])), f'Packed reducer is off for {crit}'
+
+    def test_saved_decisions(self, tmp_path, monkeypatch):
+        '''Tests that the saved decisions give back the saved criteria'''
+        monkeypatch.chdir(tmp_path)
+        output = simulate_cell_BH_exp(5.0, 4, 16, 'E', 300, ['BH'], 'power', seed=2, save_decisions=True)
+        store = RawStore(RAW_OUTPUT_DIR).open()
+        decisions = store.get(RawStore.key(5.0, 4, 16, 'E', 300, 'BH', 'decisions'))
+        assert decisions.shape == (300, 16), 'Saved decisions have the wrong shape'
+        ground_truth = np.array([0]*4+[1]*12)
+        assert (compare_reject_result(ground_truth, decisions, ('power', ))['power'] == output['BH']['power']).all()
+
+class TestBatchCorrectness:
+    '''
+    Class of functions that test correctness of
+    the batched simulation of cells with the same m in `simulation.py`
+    '''
+    def test_batch(self):
+        '''Tests the batched cells against the per-cell simulation'''
+        methods = ['Bonferroni', 'Hochberg', 'BH']
+        cells = [('0.25', 'D'), ('0.50', 'I'), ('0.00', 'E')]
+        batch = simulate_batch_BH_exp(5.0, 16, cells, 4000, methods, 'power,fdr', saving=False,
+                                      prob_alt_hypo=False, seed=9)
+        for index, (r, mode) in enumerate(cells):
+            m_0 = int(16*float(r))
+            single = simulate_cell_BH_exp(5.0, m_0, 16, mode, 4000, methods, 'power,fdr', saving=False,
+                                          prob_alt_hypo=False, seed=9)
+            for method in methods:
+                for crit in ('power', 'fdr'):
+                    if index == 0: # The first cell gets the same draws
+                        assert (batch[r, mode][method][crit] == single[method][crit]).all(), \
+                               f'First batched cell differs for {crit} of {method}'
+                    mean, se = mean_and_se(batch[r, mode][method][crit])
+                    mean_single, se_single = mean_and_se(single[method][crit])
+                    assert abs(mean-mean_single) <= 5*np.hypot(se, se_single)+1e-12, \
+                           f'Batched cell {r, mode} is off for {crit} of {method}'
+
+    def test_batch_cache(self, tmp_path, monkeypatch):
+        '''Tests that the batched simulation reads and fills the result cache'''
+        monkeypatch.chdir(tmp_path)
+        params = {'L_s': [5.0], 'm_s': [16], 'ratio_s': ['0.00', '0.50'], 'mode_s': ['E', 'D'],
+                  'methods': ['Bonferroni', 'BH'], 'seed': 17, 'num_rep': 300, 'criterion': 'power',
+                  'alpha': 0.05, 'vectorize': True, 'n_jobs': 1, 'prob_alt_hypo': False, 'batch': True,
+                  'cache': True, 'saving': False}
+        batches = []
+        batch_function = simulation.simulate_batch_BH_exp
+        monkeypatch.setattr(simulation, 'simulate_batch_BH_exp', lambda *args, **kwargs: batches.append(args) or
+                            batch_function(*args, **kwargs))
+        for seeding in ('legacy', 'stream'):
+            runs, results = [], [ExperimentResults(), ExperimentResults()]
+            for run_results in results:
+                batches.clear()
+                simulation.main_simulation(params=dict(params, seeding=seeding), print_params=False,
+                                           results=run_results)
+                runs.append(batches[:])
+            assert runs[0] and not runs[1], f'Batched cells not read from the cache ({seeding} seeding)'
+            for r in params['ratio_s']:
+                for mode in params['mode_s']:
+                    for method in params['methods']:
+                        key = ExperimentResults.key(5.0, r, mode, method, 16)
+                        assert results[0].summary(key, 'power') == results[1].summary(key, 'power'), \
+                               f'Cached batched cell {r, mode} differs ({seeding} seeding)'
+        batches.clear()
+        simulation.main_simulation(params=dict(params, seeding='stream', batch=False, ratio_s=['0.50']),
+                                   print_params=False, results=ExperimentResults())
+        simulation.main_simulation(params=dict(params, seeding='stream', ratio_s=['0.50', '0.75']),
+                                   print_params=False, results=ExperimentResults())
+        assert [args[2] for args in batches] == [[('0.75', 'E'), ('0.75', 'D')]], \
+               'Stream-seeded cells not looked up one by one'
+
+class TestSeedingCorrectness:
+    '''
+    Class of functions that test correctness of
+    the stream seeding in `seeding.py`
+    '''
+    def test_blocks(self):
+        '''Tests that any rows of a cell are regenerated identically, in any chunks and order'''
+        for prob_alt_hypo in (False, True):
+            seed = cell_stream_seed(17, 5.0, 4, 16, 'D', prob_alt_hypo, block_size=100)
+            make = lambda rng: _generator_BH_exp(5.0, 4, 16, 'D', prob_alt_hypo, rng)
+            full = generate_rows(seed, make, 0, np.empty((450, 16)))
+            for start, stop in ((350, 450), (130, 270), (0, 1), (99, 101)):
+                assert (generate_rows(seed, make, start, np.empty((stop-start, 16))) == full[start:stop]).all(), \
+                       f'Rows {start} to {stop} are not regenerated identically'
+            other = cell_stream_seed(17, 5.0, 4, 16, 'E', prob_alt_hypo, block_size=100)
+            assert not (generate_rows(other, make, 0, np.empty((100, 16))) == full[:100]).all(), \
+                   'Different cells should have different streams'
+
+    def test_schedules(self):
+        '''Tests that with stream seeding the outputs do not depend on chunks, batches or vectorization'''
+        methods = ['Bonferroni', 'BH']
+        cells = [('0.25', 'D'), ('0.50', 'I')]
+        batch = simulate_batch_BH_exp(5.0, 16, cells, 2500, methods, 'power', saving=False, prob_alt_hypo=True,
+                                      seed=9, seeding='stream')
+        for r, mode in cells:
+            m_0 = int(16*float(r))
+            seed = cell_stream_seed(9, 5.0, m_0, 16, mode, True)
+            single = simulate_cell_BH_exp(5.0, m_0, 16, mode, 2500, methods, 'power', saving=False,
+                                          prob_alt_hypo=True, seed=seed)
+            chunked = simulate_cell_BH_exp(5.0, m_0, 16, mode, 2500, methods, 'power', saving=False,
+                                           prob_alt_hypo=True, seed=seed, chunk_size=700)
+            for method in methods:
+                assert (batch[r, mode][method]['power'] == single[method]['power']).all(), 'Batch changed outputs'
+                assert np.allclose(chunked[method]['power'], sufficient_stats(single[method]['power'])), \
+                       'Chunks changed outputs'
+                unvectorized = simulate_BH_exp(5.0, m_0, 16, mode, 2500, method, 'power', saving=False,
+                                               prob_alt_hypo=True, seed=seed)
+                assert (unvectorized['power'] == single[method]['power']).all(), 'Vectorization changed outputs'
+
+class TestShardCorrectness:
+    '''
+    Class of functions that test correctness of
+    the sharded sweeps in `shards.py`
+    '''
+    def test_shards(self, tmp_path, monkeypatch):
+        '''Tests that shards run as separate processes and merged give the outputs of a single run'''
+        monkeypatch.chdir(tmp_path)
+        grid = {'L_s': [5.0], 'm_s': [4, 16], 'ratio_s': ['0.00', '0.50'], 'mode_s': ['E', 'D'],
+                'methods': ['Bonferroni', 'BH']}
+        with open('params.json', 'w') as file: json.dump(grid, file)
+        params = dict(grid, seed=17, num_rep=300, criterion='power', alpha=0.05, vectorize=True, n_jobs=1,
+                      prob_alt_hypo=False, seeding='stream', analytic=False, saving=False)
+        cells = generate_cells_BH_exp(grid['L_s'], grid['m_s'], grid['ratio_s'], grid['mode_s'])
+        single = {cell: _simulate_task_BH_exp(params, cell, 17, grid['methods'])[0] for cell in cells}
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        for shard in range(2):
+            subprocess.run([sys.executable, '-m', 'src.run_experiment', '-n', '300', '--seeding', 'stream',
+                            '--no_analytic', '--shard', f'{shard}/2'], check=True, env=env, capture_output=True)
+        subprocess.run([sys.executable, '-m', 'src.shards', 'merge'], check=True, env=env, capture_output=True)
+        reader = RawStore(RAW_OUTPUT_DIR).open()
+        for (L, m, r, mode), output in single.items():
+            m_0 = int(np.rint(m*float(r)))
+            for method in grid['methods']:
+                stats, entry = reader.view(RawStore.key(L, m_0, m, mode, 300, method, 'power'))
+                assert entry['kind'] == 'stats' and np.allclose(stats, sufficient_stats(output[method]['power'])), \
+                       f'Merged shards differ from a single run for {method} in cell {L, m, r, mode}'
+        with pytest.raises(ValueError):
+            merge_shards([f'{SHARD_DIR}/shard_0_of_2.json'])
+
+    def test_shard_kinds(self, tmp_path, monkeypatch):
+        '''Tests that a shard saves exact cells as they are, even if decisions are to be saved'''
+        monkeypatch.chdir(tmp_path)
+        params = {'L_s': [5.0], 'm_s': [8], 'ratio_s': ['0.00'], 'mode_s': ['D'], 'methods': ['Bonferroni', 'BH'],
+                  'seed': 17, 'num_rep': 50000, 'criterion': 'power', 'alpha': 0.05, 'vectorize': True, 'n_jobs': 1,
+                  'prob_alt_hypo': False, 'analytic': True, 'save_decisions': True}
+        with open(run_shard(params, 0, 1), 'r') as file: records = json.load(file)['records']
+        for record in records:
+            assert record['stats'][0] == 50000 and 0 <= record['stats'][1]/record['stats'][0] <= 1, \
+                   f"Shard misrecorded {record['method']}: {record['stats']}"
+
+class TestPipelineCorrectness:
+    '''
+    Class of functions that test correctness of
+    the pipelined experiment in `run_experiment.py`
+    '''
+    def test_pipeline(self, tmp_path, monkeypatch):
+        '''Tests that the pipelined experiment gives the same processed outputs and plots as the sequential one'''
+        monkeypatch.chdir(tmp_path)
+        params = {'L_s': [5.0, 10.0], 'm_s': [4, 8], 'ratio_s': ['0.00', '0.50'], 'mode_s': ['E', 'D'], 'methods': ['BH'],
+                  'seed': 17, 'num_rep': 200, 'criterion': 'power', 'alpha': 0.05, 'vectorize': True,
+                  'n_jobs': 2, 'prob_alt_hypo': False}
+        main_experiment(dict(params, n_jobs=1), printing=False) # Reused joblib workers would not see the chdir
+        sequential = {name: open(f'{PROCESSED_OUTPUT_DIR}/{name}').read() for name in os.listdir(PROCESSED_OUTPUT_DIR)}
+        for name in os.listdir(RAW_OUTPUT_DIR): os.remove(f'{RAW_OUTPUT_DIR}/{name}')
+        for name in os.listdir(PLOTTING_DIR): os.remove(f'{PLOTTING_DIR}/{name}')
+        main_experiment_pipelined(params, printing=False)
+        for name, content in sequential.items():
+            assert open(f'{PROCESSED_OUTPUT_DIR}/{name}').read() == content, f'Pipelined experiment changed {name}'
+        assert len(os.listdir(PLOTTING_DIR)) == 4, 'Pipelined experiment did not plot every L'
+
+    def test_in_memory(self, tmp_path, monkeypatch):
+        '''Tests that the in-memory hand-off gives the same processed outputs as the raw store'''
+        monkeypatch.chdir(tmp_path)
+        params = {'L_s': [5.0], 'm_s': [4, 8], 'ratio_s': ['0.00', '0.50'], 'mode_s': ['E', 'D'],
+                  'methods': ['Bonferroni', 'BH'], 'seed': 17, 'num_rep': 200, 'criterion': 'power,fdr',
+                  'alpha': 0.05, 'vectorize': True, 'n_jobs': 1, 'prob_alt_hypo': False, 'analytic': True,
+                  'async_save': True}
+        main_experiment(params, printing=False)
+        in_memory = {name: open(f'{PROCESSED_OUTPUT_DIR}/{name}').read() for name in os.listdir(PROCESSED_OUTPUT_DIR)}
+        main_analyze(params=params, print_params=False)
+        for name, content in in_memory.items():
+            assert open(f'{PROCESSED_OUTPUT_DIR}/{name}').read() == content, f'In-memory hand-off changed {name}'
+
+class TestIncrementalAnalysisCorrectness:
+    '''
+    Class of functions that test correctness of
+    the incremental analysis in `analyze.py`
+    '''
+    def test_grid_extension(self, tmp_path, monkeypatch):
+        '''Tests that after a grid extension only the new outputs are read, with the outputs of a full analysis'''
+        monkeypatch.chdir(tmp_path)
+        params = {'L_s': [5.0], 'm_s': [4], 'ratio_s': ['0.00', '0.50'], 'mode_s': ['E', 'D'],
+                  'methods': ['Bonferroni', 'BH'], 'seed': 17, 'num_rep': 200, 'criterion': 'power,fdr',
+                  'alpha': 0.05, 'vectorize': True, 'n_jobs': 1, 'prob_alt_hypo': False}
+        main_experiment(params, printing=False)
+        main_analyze(params=params, print_params=False)
+        main_experiment(dict(params, m_s=[8]), printing=False)
+        reads = []
+        monkeypatch.setattr(analyze, 'summary_from_store', lambda reader, key: reads.append(key) or
+                            summary_from_store(reader, key))
+        main_analyze(params=dict(params, m_s=[4, 8]), print_params=False)
+        assert len(reads) == 16 and all(key[2] == 8 for key in reads), 'Incremental analysis read known outputs'
+        incremental = {name: open(f'{PROCESSED_OUTPUT_DIR}/{name}').read() for name in os.listdir(PROCESSED_OUTPUT_DIR)}
+        main_analyze(params=dict(params, m_s=[4, 8], incremental=False), print_params=False)
+        for name, content in incremental.items():
+            assert open(f'{PROCESSED_OUTPUT_DIR}/{name}').read() == content, f'Incremental analysis changed {name}'
+        reads.clear()
+        main_analyze(params=dict(params, m_s=[4, 8]), print_params=False)
+        assert not reads, 'Incremental analysis read outputs without new raw outputs'
+
+    def test_subset_first(self, tmp_path, monkeypatch):
+        '''Tests that the outputs outside of the grid of an earlier analysis are still analyzed later'''
+        monkeypatch.chdir(tmp_path)
+        params = {'L_s': [5.0, 10.0], 'm_s': [4], 'ratio_s': ['0.00', '0.50'], 'mode_s': ['E', 'D'], 'methods': ['BH'],
+                  'seed': 17, 'num_rep': 200, 'criterion': 'power,fdr', 'alpha': 0.05, 'vectorize': True,
+                  'n_jobs': 1, 'prob_alt_hypo': False}
+        main_experiment(params, printing=False)
+        full = {name: open(f'{PROCESSED_OUTPUT_DIR}/{name}').read() for name in os.listdir(PROCESSED_OUTPUT_DIR)}
+        for name in full: os.remove(f'{PROCESSED_OUTPUT_DIR}/{name}')
+        main_analyze(params=dict(params, L_s=[5.0], criterion='power'), print_params=False)
+        main_analyze(params=params, print_params=False)
+        for name, content in full.items():
+            assert open(f'{PROCESSED_OUTPUT_DIR}/{name}').read() == content, f'Incremental analysis changed {name}'
+
+    def test_recreated_store(self, tmp_path, monkeypatch):
+        '''Tests that a raw store recreated with the same grid but another seed is analyzed again'''
+        monkeypatch.chdir(tmp_path)
+        params = {'L_s': [5.0], 'm_s': [16], 'ratio_s': ['0.25', '0.50'], 'mode_s': ['E', 'D'], 'methods': ['BH'],
+                  'seed': 17, 'num_rep': 200, 'criterion': 'power', 'alpha': 0.05, 'vectorize': True,
+                  'n_jobs': 1, 'prob_alt_hypo': False}
+        simulation.main_simulation(params=params, print_params=False)
+        main_analyze(params=params, print_params=False)
+        shutil.rmtree(RAW_OUTPUT_DIR)
+        simulation.main_simulation(params=dict(params, seed=18), print_params=False)
+        main_analyze(params=params, print_params=False)
+        incremental = {name: open(f'{PROCESSED_OUTPUT_DIR}/{name}').read() for name in os.listdir(PROCESSED_OUTPUT_DIR)}
+        main_analyze(params=dict(params, incremental=False), print_params=False)
+        for name, content in incremental.items():
+            assert open(f'{PROCESSED_OUTPUT_DIR}/{name}').read() == content, \
+                   f'Incremental analysis kept the outputs of the deleted store in {name}'
+
+class TestPlottingCorrectness:
+    '''
+    Class of functions that test correctness of
+    the lazy plotting in `plotting.py`
+    '''
+    def test_lazy(self, tmp_path, monkeypatch):
+        '''Tests that only the figures whose inputs changed are rendered, in a process pool or not'''
+        monkeypatch.chdir(tmp_path)
+        params = {'L_s': [5.0], 'm_s': [4, 8], 'ratio_s': ['0.00', '0.50'], 'mode_s': ['E', 'D'], 'methods': ['BH'],
+                  'criterion': 'power,fdr'}
+        nested = lambda value: {r: {mode: {'BH': [value, value]} for mode in params['mode_s']}
+                                for r in params['ratio_s']}
+        processed_L = ({crit: nested(0.5) for crit in ['power', 'fdr']}, {crit: nested(0.01) for crit in
+                                                                          ['power', 'fdr']}, nested(200))
+        figures = figures_L(params, 5.0, processed_L)
+        assert len(plot_figures(figures, n_jobs=2)) == 4, 'Lazy plotting did not render new figures'
+        assert not plot_figures(figures_L(params, 5.0, processed_L)), 'Lazy plotting rendered unchanged figures'
+        processed_L[1]['fdr']['0.50']['D']['BH'][1] = 0.02
+        rendered = plot_figures(figures_L(params, 5.0, processed_L))
+        assert rendered == [f'{PLOTTING_DIR}/{generate_plotname_BH_exp(5.0, pdf=False, criterion="fdr")[1]}'], \
+               'Lazy plotting did not render exactly the changed figure'
+        assert len(plot_figures(figures, lazy=False)) == 4, 'Plotting skipped figures when not lazy'
+
+class TestProfilingCorrectness:
+    '''
+    Class of functions that test correctness of
+    the stage profiler in `profiling.py`
+    '''
+    def test_stages(self, tmp_path):
+        '''Tests that the stages of a cell are recorded and saved, and that outputs are unchanged'''
+        methods = ['Bonferroni', 'BH']
+        expected = simulate_cell_BH_exp(5.0, 8, 16, 'E', 500, methods, 'power', saving=False,
+                                        prob_alt_hypo=False, seed=3)
+        PROFILER.enable()
+        try:
+            PROFILER.set_cell(5.0, 8, 16, 'E', 500)
+            output = simulate_cell_BH_exp(5.0, 8, 16, 'E', 500, methods, 'power', saving=False,
+                                          prob_alt_hypo=False, seed=3)
+        finally:
+            PROFILER.disable()
+        for method in methods:
+            assert (output[method]['power'] == expected[method]['power']).all(), 'Profiling changed the outputs'
+        rows = {row['stage']: row for row in PROFILER.report()}
+        assert set(rows) == {'generate', 'pvalue', 'sort', 'step-up', 'reduce'}, 'Unexpected profiled stages'
+        assert rows['step-up']['calls'] == len(methods), 'Step-up stage not recorded once per method'
+        assert all(row['m'] == 16 and row['seconds'] >= 0 and row['peak_bytes'] >= 0 for row in rows.values())
+        PROFILER.save(f'{tmp_path}/profile')
+        assert os.path.exists(f'{tmp_path}/profile.json') and os.path.exists(f'{tmp_path}/profile.csv')
+        PROFILER.enable(memory=False)
+        try:
+            assert not tracemalloc.is_tracing(), 'Allocations traced without memory profiling'
+            simulate_cell_BH_exp(5.0, 8, 16, 'E', 500, methods, 'power', saving=False, prob_alt_hypo=False, seed=3)
+        finally:
+            PROFILER.disable()
+        assert PROFILER.report() and all(row['peak_bytes'] == 0 for row in PROFILER.report()), \
+               'Unexpected stage records without memory profiling'
+
+class TestBenchmarkCorrectness:
+    '''
+    Class of functions that test correctness of
+    the benchmark suite in `run_benchmark.py`
+    '''
+    def test_timing_and_compare(self):
+        '''Tests the timing records and the regression flags of two runs'''
+        calls = []
+        record = time_function(lambda x: calls.append(np.ones(x)), lambda: (1000, ), repeat=5, warmup=2)
+        assert len(calls) == 5+2+1, 'Unexpected number of calls (warmup, timed, memory)'
+        assert record['repeat'] == 5 and 0 <= record['min'] <= record['median'] <= record['max']
+        assert record['iqr'] >= 0 and record['peak_bytes'] >= 8000, 'Peak memory of the call not measured'
+        old = {'benchmarks': {'a': {'median': 1.}, 'b': {'median': 1.}, 'c': {'median': 1.}}}
+        new = {'benchmarks': {'a': {'median': 1.05}, 'b': {'median': 1.5}, 'd': {'median': 1.}}}
+        rows, regressions = compare_benchmarks(old, new, threshold=0.1)
+        assert [row[0] for row in rows] == ['a', 'b'] and regressions == ['b'], 'Unexpected regressions'
+
+    def test_power_law_fit(self):
+        '''Tests the exponent and confidence interval of the power law fit'''
+        x = np.array([100, 300, 1000, 3000, 10000])
+        fit = fit_power_law(x, 2e-6*x**1.5)
+        assert abs(fit['exponent']-1.5) < 1e-9 and abs(fit['prefactor']-2e-6) < 1e-12, 'Exact power law not recovered'
+        noisy = fit_power_law(x, 2e-6*x**1.5*np.exp(np.random.default_rng(0).normal(0, 0.1, len(x))))
+        assert noisy['ci_low'] < noisy['exponent'] < noisy['ci_high'] and noisy['ci_low'] < 1.5 < noisy['ci_high']
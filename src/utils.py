@@ -1,5 +1,6 @@
 import math
 import numpy as np
+from src.methods import PackedDecisions
 
 def divide_0div0(numerator, denominator, alt_value=0):
     '''
@@ -18,16 +19,22 @@ def compare_reject_result(true_result, test_result, criteria=('power')):
     indicating not null and null hypotheses
     with rows of test result
     each row is 1 for rejection and 0 for not rejecting
-    supported criteria are: 'power', 'type1', 'type2', 'fdr', 'm', 'm_0'
+    supported criteria are: 'power', 'type1', 'type2', 'fdr', 'fwer', 'm', 'm_0'
+    'fwer' for the indicator of at least one false rejection
     'm' for the number of ground truth hypotheses
     'm_0' for the number of groud truth null hypotheses
     true_result and test_result could be 1d or 2d; the row length must be the same
+    test_result could also be `PackedDecisions`, whose rejections are counted with popcounts
     '''
     output = dict()
     m = true_result.shape[0]
     m_0 = m - np.sum(true_result, axis=-1)
-    R = np.sum(test_result, axis=-1)
-    S = np.sum(test_result & true_result, axis=-1)
+    if isinstance(test_result, PackedDecisions):
+        R = test_result.count()
+        S = test_result.count(true_result)
+    else:
+        R = np.sum(test_result, axis=-1)
+        S = np.sum(test_result & true_result, axis=-1)
     T = m - m_0 - S
     U = m - R - T
     V = R - S
@@ -37,6 +44,7 @@ def compare_reject_result(true_result, test_result, criteria=('power')):
     if 'type1' in criteria: output['type1'] = V
     if 'type2' in criteria: output['type2'] = T
     if 'fdr' in criteria: output['fdr'] = divide_0div0(V, R, 0)
+    if 'fwer' in criteria: output['fwer'] = (V > 0).astype(int)
     if 'm_0' in criteria: output['m_0'] = m_0
     if 'm' in criteria: output['m'] = m
     return output
@@ -98,6 +106,83 @@ def mean_and_se(nums):
     se = std/np.sqrt(l)
     return mean, se
 
+def sufficient_stats(nums):
+    '''
+    Return the sufficient statistics [count, sum, sum of squares] of number in nums.
+    Statistics of disjoint batches are merged by simple addition.
+    '''
+    nums = np.asarray(nums, dtype=float)
+    assert len(nums.shape) == 1, 'Input has dimension not equal 1'
+    return np.array([nums.shape[0], nums.sum(), np.dot(nums, nums)])
+
+def merge_stats(*stats_dicts):
+    '''
+    Merges dictionaries mapping criteria to sufficient statistics computed on disjoint
+    batches of replications (e.g. chunks or workers) into one such dictionary
+    '''
+    output = dict()
+    for stats_dict in stats_dicts:
+        for crit, stats in stats_dict.items():
+            output[crit] = output[crit] + stats if crit in output else np.array(stats, dtype=float)
+    return output
+
+def reject_stats(test_result, m_0, criteria=('power',)):
+    '''
+    Fused version of `sufficient_stats` applied to the outputs of `compare_reject_result`.
+    Assumes the ground truth puts the m_0 null hypotheses first (as in `NormalMeanHypotheses`),
+    so that false and true rejections are counted on column slices of the test result.
+    test_result could be 1d or 2d, with boolean or 0/1 integer entries, or `PackedDecisions`.
+    Returns a dictionary mapping each criterion in `criteria` to [count, sum, sum of squares]
+    '''
+    if isinstance(test_result, PackedDecisions):
+        m = test_result.m
+        null = np.arange(m) < m_0
+        V = test_result.count(null).reshape(-1)
+        S = test_result.count(~null).reshape(-1)
+        s = V.shape[0]
+    else:
+        test_result = test_result.reshape(-1, test_result.shape[-1])
+        s, m = test_result.shape
+        V = np.count_nonzero(test_result[:, :m_0], axis=1)
+        S = np.count_nonzero(test_result[:, m_0:], axis=1)
+    output = dict()
+    for crit in criteria:
+        if crit == 'power':
+            assert m_0 < m, 'No non-null hypothesis, cannot calculate power'
+            output[crit] = np.array([s, S.sum()/(m-m_0), np.dot(S, S)/(m-m_0)**2])
+        elif crit == 'type1': output[crit] = np.array([s, V.sum(), np.dot(V, V)], dtype=float)
+        elif crit == 'type2':
+            T = (m-m_0) - S
+            output[crit] = np.array([s, T.sum(), np.dot(T, T)], dtype=float)
+        elif crit == 'fdr':
+            fdr = V / np.maximum(V+S, 1)
+            output[crit] = np.array([s, fdr.sum(), np.dot(fdr, fdr)])
+        elif crit == 'fwer':
+            num_false = np.count_nonzero(V)
+            output[crit] = np.array([s, num_false, num_false], dtype=float)
+        else: raise ValueError(f'Unsupported criterion: {crit}')
+    return output
+
+def mean_and_se_from_stats(stats):
+    '''
+    Return the mean and empirical se from sufficient statistics [count, sum, sum of squares]
+    Agrees with `mean_and_se` on the array the statistics were computed from
+    '''
+    l, total, total_sq = stats
+    assert l > 1, 'Need at least 2 samples to compute se'
+    mean = total/l
+    var = max(total_sq - total*mean, 0.)/(l-1)
+    se = np.sqrt(var)/np.sqrt(l)
+    return mean, se
+
+def stats_converged(stats_dict, se_tol, min_rep=2):
+    '''
+    Whether the se of every criterion of a dictionary of sufficient statistics is below se_tol,
+    with at least min_rep samples (a degenerate first batch, e.g. of power exactly 1, has se 0)
+    '''
+    return all(stats[0] >= max(min_rep, 2) and mean_and_se_from_stats(stats)[1] < se_tol
+               for stats in stats_dict.values())
+
 def distribute_means_BH_exp(m_1, L, mode):
     '''
     Distributes alternative hypotheses mean for BH paper's experiment
@@ -111,16 +196,16 @@ def distribute_means_BH_exp(m_1, L, mode):
             output.append(val)
     return output
 
-def generate_filename_BH_exp(L, m_0, m, mode, num_rep, method, criterion):
-    L = np.round(float(L), 1)
-    return f'exp_output_L{L}_mo{m_0}_m{m}_mode{mode}_nrep{num_rep}_method{method}_criterion{criterion}.npy'
+def generate_jsonname_BH_exp(L, criterion='power'):
+    return f'exp_proceeded_output_means_L{L}_criterion{criterion}.json', \
+           f'exp_proceeded_output_ses_L{L}_criterion{criterion}.json'
 
-def generate_jsonname_BH_exp(L):
-    return f'exp_proceeded_output_means_L{L}.json', f'exp_proceeded_output_ses_L{L}.json'
+def generate_nrepsname_BH_exp(L):
+    return f'exp_proceeded_output_nreps_L{L}.json'
 
-def generate_plotname_BH_exp(L, pdf=False):
-    if not pdf: return f'exp_plot_means_L{L}.png', f'exp_plot_ses_L{L}.png'
-    return f'exp_plot_means_L{L}.pdf', f'exp_plot_ses_L{L}.pdf'
+def generate_plotname_BH_exp(L, pdf=False, criterion='power'):
+    ext = 'pdf' if pdf else 'png'
+    return f'exp_plot_means_L{L}_criterion{criterion}.{ext}', f'exp_plot_ses_L{L}_criterion{criterion}.{ext}'
 
 def generate_params_BH_exp(L_s, m_s, ratio_s, mode_s, method_s):
     for L in L_s:
@@ -129,3 +214,26 @@ def generate_params_BH_exp(L_s, m_s, ratio_s, mode_s, method_s):
                 for method in method_s:
                     for m in m_s: # Intentionally put m last to help parsing
                         yield (L, m, r, mode, method)
+
+def generate_cells_BH_exp(L_s, m_s, ratio_s, mode_s):
+    '''
+    Same as `generate_params_BH_exp` without the methods:
+    each cell (L, m, ratio, mode) shares its generated data across all methods
+    '''
+    for L in L_s:
+        for r in ratio_s:
+            for mode in mode_s:
+                for m in m_s:
+                    yield (L, m, r, mode)
+
+def parse_criteria(criterion):
+    '''
+    Parses one or several per-replication criteria, given either as a list
+    or as a comma-separated string such as 'power,fdr', into a tuple.
+    Supported criteria are: 'power', 'type1', 'type2', 'fdr', 'fwer'
+    '''
+    if isinstance(criterion, str): criterion = criterion.split(',')
+    criteria = tuple(crit.strip() for crit in criterion)
+    for crit in criteria:
+        assert crit in ('power', 'type1', 'type2', 'fdr', 'fwer'), f'Unsupported criterion: {crit}'
+    return criteria